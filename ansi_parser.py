@@ -1,4 +1,7 @@
-from ansi_to_html import parse_style_codes
+import re
+import codecs
+
+from ansi_to_html import apply_style_codes
 
 
 # https://www.man7.org/linux/man-pages/man4/console_codes.4.html
@@ -6,217 +9,419 @@ from ansi_to_html import parse_style_codes
 # https://gist.github.com/fnky/458719343aabd01cfb17a3a4f7296797
 # https://notes.burke.libbey.me/ansi-escape-codes/
 
+# the parser is the DEC/Paul Williams VT500 state machine:  https://vt100.net/emu/dec_ansi_parser
+
 
 ESC = '\x1b'
 BELL = '\x07'
 BACKSPACE = '\x08'
+TAB = '\t'
+NEWLINE = '\n'
+CARRIAGE_RETURN = '\r'
+
+
+# parser states
+GROUND = 0
+ESCAPE = 1
+ESCAPE_INTERMEDIATE = 2
+CSI_ENTRY = 3
+CSI_PARAM = 4
+CSI_INTERMEDIATE = 5
+CSI_IGNORE = 6
+DCS_ENTRY = 7
+DCS_PARAM = 8
+DCS_INTERMEDIATE = 9
+DCS_PASSTHROUGH = 10
+DCS_IGNORE = 11
+OSC_STRING = 12
+SOS_PM_APC_STRING = 13
+
+# actions performed while taking a transition
+NONE = 0
+EXECUTE = 1
+COLLECT = 2
+PARAM = 3
+ESC_DISPATCH = 4
+CSI_DISPATCH = 5
+OSC_PUT = 6
+PRINT = 7
+
+# entering these states throws away whatever was collected for the previous sequence
+CLEAR_ON_ENTRY = (ESCAPE, CSI_ENTRY, DCS_ENTRY)
+
+# every character from U+00A0 up is treated the same way, so the table only needs this many columns
+HIGH = 0xa0
+
+
+# builds TRANSITIONS[state][char] = (action << 4) | next_state
+def build_transition_table():
+    table = [[(NONE << 4) | state] * (HIGH + 1) for state in range(14)]
+
+    def add(states, chars, action, next_state=None):
+        for state in states:
+            for char in chars:
+                table[state][char] = (action << 4) | (state if next_state is None else next_state)
+
+    c0 = [*range(0x00, 0x18), 0x19, *range(0x1c, 0x20)]
+    intermediates = range(0x20, 0x30)
+    digits = [*range(0x30, 0x3a), 0x3a, 0x3b]  # colons are accepted as separators too, ex: 38:2:r:g:b
+    private_markers = range(0x3c, 0x40)
+    finals = range(0x40, 0x7f)
+
+    add([GROUND], c0, EXECUTE)
+    add([GROUND], [*range(0x20, 0x7f), HIGH], PRINT)
+
+    add([ESCAPE], c0, EXECUTE)
+    add([ESCAPE], intermediates, COLLECT, ESCAPE_INTERMEDIATE)
+    add([ESCAPE], [*range(0x30, 0x50), *range(0x51, 0x58), 0x59, 0x5a, 0x5c, *range(0x60, 0x7f)], ESC_DISPATCH, GROUND)
+    add([ESCAPE], [0x5b], NONE, CSI_ENTRY)
+    add([ESCAPE], [0x5d], NONE, OSC_STRING)
+    add([ESCAPE], [0x50], NONE, DCS_ENTRY)
+    add([ESCAPE], [0x58, 0x5e, 0x5f], NONE, SOS_PM_APC_STRING)
+
+    add([ESCAPE_INTERMEDIATE], c0, EXECUTE)
+    add([ESCAPE_INTERMEDIATE], intermediates, COLLECT)
+    add([ESCAPE_INTERMEDIATE], range(0x30, 0x7f), ESC_DISPATCH, GROUND)
+
+    add([CSI_ENTRY], c0, EXECUTE)
+    add([CSI_ENTRY], intermediates, COLLECT, CSI_INTERMEDIATE)
+    add([CSI_ENTRY], digits, PARAM, CSI_PARAM)
+    add([CSI_ENTRY], private_markers, COLLECT, CSI_PARAM)
+    add([CSI_ENTRY], finals, CSI_DISPATCH, GROUND)
+
+    add([CSI_PARAM], c0, EXECUTE)
+    add([CSI_PARAM], digits, PARAM)
+    add([CSI_PARAM], private_markers, NONE, CSI_IGNORE)
+    add([CSI_PARAM], intermediates, COLLECT, CSI_INTERMEDIATE)
+    add([CSI_PARAM], finals, CSI_DISPATCH, GROUND)
+
+    add([CSI_INTERMEDIATE], c0, EXECUTE)
+    add([CSI_INTERMEDIATE], intermediates, COLLECT)
+    add([CSI_INTERMEDIATE], range(0x30, 0x40), NONE, CSI_IGNORE)
+    add([CSI_INTERMEDIATE], finals, CSI_DISPATCH, GROUND)
+
+    add([CSI_IGNORE], c0, EXECUTE)
+    add([CSI_IGNORE], finals, NONE, GROUND)
+
+    # device control strings are recognized so that they can be skipped, but nothing is done with them
+    add([DCS_ENTRY], intermediates, COLLECT, DCS_INTERMEDIATE)
+    add([DCS_ENTRY], digits, PARAM, DCS_PARAM)
+    add([DCS_ENTRY], private_markers, COLLECT, DCS_PARAM)
+    add([DCS_ENTRY], finals, NONE, DCS_PASSTHROUGH)
+
+    add([DCS_PARAM], digits, PARAM)
+    add([DCS_PARAM], private_markers, NONE, DCS_IGNORE)
+    add([DCS_PARAM], intermediates, COLLECT, DCS_INTERMEDIATE)
+    add([DCS_PARAM], finals, NONE, DCS_PASSTHROUGH)
+
+    add([DCS_INTERMEDIATE], intermediates, COLLECT)
+    add([DCS_INTERMEDIATE], range(0x30, 0x40), NONE, DCS_IGNORE)
+    add([DCS_INTERMEDIATE], finals, NONE, DCS_PASSTHROUGH)
+
+    # xterm also accepts BEL as the end of an OSC string
+    add([OSC_STRING], [*range(0x20, 0x7f), HIGH], OSC_PUT)
+    add([OSC_STRING], [0x07], NONE, GROUND)
+
+    # these transitions apply no matter what state the parser is in
+    every_state = range(14)
+    add(every_state, [0x18, 0x1a, *range(0x80, 0x90), *range(0x91, 0x98), 0x99, 0x9a], EXECUTE, GROUND)
+    add(every_state, [0x1b], NONE, ESCAPE)
+    add(every_state, [0x90], NONE, DCS_ENTRY)
+    add(every_state, [0x9b], NONE, CSI_ENTRY)
+    add(every_state, [0x9c], NONE, GROUND)
+    add(every_state, [0x9d], NONE, OSC_STRING)
+    add(every_state, [0x98, 0x9e, 0x9f], NONE, SOS_PM_APC_STRING)
+
+    return table
+
+
+TRANSITIONS = build_transition_table()
+
+# a run of plain text, up to the next control character, and the color sequence after it if there is one
+# colors are most of the escape sequences in ordinary output, so they skip the dispatch table
+TEXT_RUN = re.compile('([^\x00-\x1f\x7f-\x9f]*)(?:\x1b\\[([0-9:;]*)m)?')
+
+# complete sequences are matched in one go, the state machine only has to step through incomplete or unusual ones
+CSI_SEQUENCE = re.compile('\x1b\\[([<=>?]?)([0-9:;]*)([ -/]*)([@-~])')
+# DEL and C1 controls are not part of an OSC string in the state machine either - C1 controls end it
+OSC_SEQUENCE = re.compile('\x1b\\]([^\x00-\x1f\x7f-\x9f]*)(?:\x07|\x1b\\\\)')
+
+
+# the same few parameter strings show up over and over again, so their results are remembered
+PARAMS_CACHE = {}
+
+
+# ESC [ num ; num letter  ->  (num, num)
+def parse_params(params):
+    codes = PARAMS_CACHE.get(params)
+    if codes is None:
+        codes = tuple(int(param) if param else 0 for param in params.replace(':', ';').split(';')) if params else ()
+        if len(PARAMS_CACHE) < 4096:
+            PARAMS_CACHE[params] = codes
+    return codes
 
 
 class AnsiParser:
 
-    def __init__(self, style):
+    def __init__(self, style, screen):
         # this maps a type of ansi code to a function to handle it
+        # CSI sequences are keyed by any private marker or intermediates followed by the final character, ex:  'm'  '?h'
+        # other escape sequences are keyed by 'ESC' followed by the rest of the sequence, ex:  'ESC7'  'ESC(B'
         self.sequence_type_functions = {
             'm': self.handle_color_codes,
 
             '?l': self.handle_private_modes,
             '?h': self.handle_private_modes,
 
+            'A': lambda: screen.cursor_up(self.count()),
+            'B': lambda: screen.cursor_down(self.count()),
+            'C': lambda: screen.cursor_forward(self.count()),
+            'D': lambda: screen.cursor_back(self.count()),
+            'E': self.handle_next_line,
+            'F': self.handle_previous_line,
+            'G': lambda: screen.move_cursor(screen.cursor_row, self.count() - 1),
+            '`': lambda: screen.move_cursor(screen.cursor_row, self.count() - 1),
+            'd': lambda: screen.move_cursor(self.count() - 1, screen.cursor_col),
+            'H': self.handle_cursor_position,
+            'f': self.handle_cursor_position,
+
+            'J': lambda: screen.erase_in_display(self.code(0, 0)),
+            'K': lambda: screen.erase_in_line(self.code(0, 0)),
+            'X': lambda: screen.erase_chars(self.count()),
+            '@': lambda: screen.insert_chars(self.count()),
+            'P': lambda: screen.delete_chars(self.count()),
+            'L': lambda: screen.insert_lines(self.count()),
+            'M': lambda: screen.delete_lines(self.count()),
+            'S': lambda: screen.scroll_up(self.count()),
+            'T': lambda: screen.scroll_down(self.count()),
+            'r': self.handle_scroll_region,
+
+            's': screen.save_cursor,
+            'u': screen.restore_cursor,
+            'ESC7': screen.save_cursor,
+            'ESC8': screen.restore_cursor,
+            'ESCD': screen.linefeed,
+            'ESCE': self.handle_next_line,
+            'ESCM': screen.reverse_index,
+            'ESCc': screen.reset,
+            'ESC=': lambda: setattr(screen, 'app_keypad', True),
+            'ESC>': lambda: setattr(screen, 'app_keypad', False),
+
             'OSC': self.handle_os_commands,
         }
 
-        self.text = ''
-        self.output = ''
-        self.idx = 0
-        self.style = style
-        self.codes = []
-        self.code_type = ''
-
+        # control characters that move the cursor
+        self.control_functions = {
+            BACKSPACE: screen.backspace,
+            TAB: screen.tab,
+            NEWLINE: screen.linefeed,
+            '\x0b': screen.linefeed,
+            '\x0c': screen.linefeed,
+            CARRIAGE_RETURN: screen.carriage_return,
+        }
 
-    # this resets all parsing variables to prepare for a new parse
-    def new(self, text):
-        self.text = text #  .replace('\r\n', '\n')  # might be easier to just delete carriage returns that appear with a newline
-        self.output = ''
-        self.idx = 0
-        self.codes = []
+        # everything that is parsed ends up on this screen - the current style lives there too, see HtmlStyle.key()
+        self.screen = screen
+        screen.style_id = style.key()
+        self.codes = ()
         self.code_type = ''
 
+        # everything below is kept between calls to feed(), since the pty is read in chunks that can end anywhere
+        # a utf-8 character cut in half waits in the decoder, and an escape sequence cut in half waits in the state machine
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.state = GROUND
+        self.collected = ''
+        self.params = ''
+        self.osc = ''
+
+
+    # decodes the next chunk of pty output and applies it to the screen
+    def feed(self, data):
+        self.parse_ansi(self.decoder.decode(data))
+
+
+    def parse_ansi(self, text):
+        length = len(text)
+        screen = self.screen
+        draw = screen.draw
+        transitions = TRANSITIONS
+        idx = 0
+        state = self.state
+
+        while idx < length:
+            if state == GROUND:
+                # copy everything up to the next control character in one go
+                match = TEXT_RUN.match(text, idx)
+                run, params = match.groups()
+                if run:
+                    draw(run)
+                idx = match.end()
+                if params is not None:
+                    # ESC [ m  is the same as  ESC [ 0 m
+                    screen.style_id = apply_style_codes(screen.style_id, parse_params(params) or (0,))
+                    continue
+                if idx == length:
+                    break
+
+                char = text[idx]
+                if char == ESC:
+                    match = CSI_SEQUENCE.match(text, idx)
+                    if match:
+                        marker, params, intermediates, final = match.groups()
+                        self.dispatch(marker + intermediates + final, parse_params(params))
+                        idx = match.end()
+                        continue
+
+                    match = OSC_SEQUENCE.match(text, idx)
+                    if match:
+                        self.dispatch_os_command(match.group(1))
+                        idx = match.end()
+                        continue
+
+                # line endings are by far the most common control characters
+                elif char == CARRIAGE_RETURN and text.startswith(NEWLINE, idx + 1):
+                    screen.carriage_return()
+                    screen.linefeed()
+                    idx += 2
+                    continue
+
+            # step through the state machine one character at a time
+            char = text[idx]
+            code = ord(char)
+            transition = transitions[state][code if code < HIGH else HIGH]
+            action = transition >> 4
+            next_state = transition & 15
+
+            if action == EXECUTE:
+                self.execute(char)
+            elif action == PRINT:
+                draw(char)
+            elif action == COLLECT:
+                self.collected += char
+            elif action == PARAM:
+                self.params += char
+            elif action == OSC_PUT:
+                self.osc += char
+            elif action == CSI_DISPATCH:
+                self.dispatch(self.collected + char, parse_params(self.params))
+            elif action == ESC_DISPATCH:
+                self.dispatch('ESC' + self.collected + char, ())
+
+            if next_state != state:
+                # leaving an OSC string, by either BEL or ESC \, ends the command
+                if state == OSC_STRING:
+                    self.dispatch_os_command(self.osc)
+                if next_state in CLEAR_ON_ENTRY:
+                    self.collected = ''
+                    self.params = ''
+                elif next_state == OSC_STRING:
+                    self.osc = ''
+                state = next_state
+
+            idx += 1
+
+        self.state = state
+
+
+    # C0 and C1 control characters
+    def execute(self, char):
+        func = self.control_functions.get(char)
+        if func:
+            func()
+
+
+    def dispatch(self, code_type, codes):
+        func = self.sequence_type_functions.get(code_type)
+        if func:
+            self.code_type = code_type
+            self.codes = codes
+            func()
+
+            # reset current codes before parsing the next one
+            self.codes = ()
+            self.code_type = ''
 
-    # TODO: STDOUT/STDERR is read in chunks - need to detect + handle if the border of a chunk cuts off an ANSI sequence
-    # find and handle all ansi codes in a string of text
-    # return the result of handling each code within the text
-    def parse_ansi(self):
-
-        while self.idx < len(self.text):
-            # read one character at a time
-            char = self.text[self.idx]
-
-            # TODO: in terminals, carriage return means "move cursor all the way left", then any printed characters will overwrite existing text
-            # TODO:  echo -e '12345\rabc'  ->  abc45
-            #if char == '\r':
-            #    last_newline = self.output.rfind('\n')
-            #    if last_newline == -1:
-            #        self.output = ''
-            #    else:
-            #        self.output = self.output[:last_newline + 1]
-            #    self.idx += 1
-            #    continue
-
-            if char == BACKSPACE:
-                self.output = self.output[:-1]
-                self.idx += 1
-                continue
 
-            # TODO: I currently use the bell to help organize tab-completion output, otherwise it can just be skipped here
-            #if char == BELL:
-            #   print('\a')
-            #    self.idx += 1
-            #    continue
-
-            # ansi sequences begin with an ESC
-            if char == ESC:
-                self.parse_sequence()
-
-                # parsing the sequence results in a sequence type, which is associated with handler function for that particular ansi code
-                if self.code_type and self.code_type in self.sequence_type_functions.keys():
-                    self.sequence_type_functions[self.code_type]()
-
-                # reset current codes before parsing the next one
-                self.codes = []
-                self.code_type = ''
-
-            # regular characters are just added to the output string as-is
-            else:
-                self.output += char
-
-            self.idx += 1
-
-        return self.output
-
-
-    # each type of sequence begins with ESC
-    # the second character in the sequence determines what kind of code it is
-    def parse_sequence(self):
-        # increment idx to skip over ESC character
-        self.idx += 1
+    # ESC ] num ; text ESC \
+    # ESC ] num ; text BEL
+    def dispatch_os_command(self, command):
+        num, _, text = command.partition(';')
+        codes = [int(num) if num.isdigit() else num]
+        if text:
+            codes.append(text)
+        self.dispatch('OSC', codes)
 
-        if self.text[self.idx] == ']':
-            self.parse_os_command()
 
-        elif self.text[self.idx] != '[':
-            self.parse_private_cursor_control()
+    # the code at a given position, or a default if it was left out
+    def code(self, idx, default):
+        codes = self.codes
+        if idx < len(codes):
+            return codes[idx]
+        return default
 
-        # all sequences from this point on begin with ESC [
-        elif self.text[self.idx + 1] == '=':
-            self.parse_screen_mode()
 
-        elif self.text[self.idx + 1] == '?':
-            self.parse_private_mode()
+    # most cursor movements treat a missing or 0 count as 1
+    def count(self):
+        return self.code(0, 0) or 1
 
-        else:
-            self.parse_control_sequence()
 
+    def handle_color_codes(self):
+        # ESC [ m  is the same as  ESC [ 0 m
+        screen = self.screen
+        screen.style_id = apply_style_codes(screen.style_id, self.codes or (0,))
 
-    # ESC [ num letter
-    # ESC [ num ; num letter
-    # includes colors and styles
-    def parse_control_sequence(self):
-        self.idx += 1
 
-        current_code = ''
-        while self.idx < len(self.text):
-            char = self.text[self.idx]
+    # ESC [ row ; col H
+    def handle_cursor_position(self):
+        self.screen.move_cursor((self.code(0, 1) or 1) - 1, (self.code(1, 1) or 1) - 1)
 
-            # numbers are part of a code
-            if char.isnumeric():
-                current_code += char
 
-            # ; separates multiple codes
-            elif char == ';':
-                self.codes.append(int(current_code))
-                current_code = ''
+    def handle_next_line(self):
+        self.screen.cursor_down(self.count())
+        self.screen.carriage_return()
 
-            else:
-                if current_code:
-                    self.codes.append(int(current_code))
-                self.code_type = char
-                return
 
-            self.idx += 1
+    def handle_previous_line(self):
+        self.screen.cursor_up(self.count())
+        self.screen.carriage_return()
 
 
-    # ESC [= num h
-    # ESC [= num l
-    def parse_screen_mode(self):
-        pass
+    # ESC [ top ; bottom r
+    def handle_scroll_region(self):
+        bottom = self.code(1, 0)
+        self.screen.set_scroll_region((self.code(0, 1) or 1) - 1, bottom - 1 if bottom else None)
 
 
     # ESC [? num h
     # ESC [? num l
-    def parse_private_mode(self):
-        self.idx += 2
-
-        current_code = ''
-        while self.idx < len(self.text):
-            char = self.text[self.idx]
-
-            # numbers are part of a code
-            if char.isnumeric():
-                current_code += char
-
-            else:
-                if current_code:
-                    self.codes.append(int(current_code))
-                self.code_type = '?' + char
-                return
-
-            self.idx += 1
-
-
-    # ESC ] num ; text ESC \
-    # ESC ] num ; text BEL
-    def parse_os_command(self):
-        self.idx += 1
-
-        current_code = ''
-        while self.idx < len(self.text):
-            char = self.text[self.idx]
-
-            # this code expects only one ; seperator
-            # note that only the first code in this sequence is necessarily numeric
-            if char == ';' and len(self.codes) == 0:
-                self.codes.append(int(current_code))
-                current_code = ''
-
-            # this sequence ends when it encounters the BEL character or ESC \  (backslash)
-            elif char in [BELL, '\\']:
-                if current_code:
-                    self.codes.append(current_code)
-                self.code_type = 'OSC'
-                return
-
-            # all other characters are captured by this code
-            else:
-                current_code += char
-
-            self.idx += 1
-
-
-    # ESC M
-    # ESC 7
-    # ESC 8
-    def parse_private_cursor_control(self):
-        pass
-
-
-    def handle_color_codes(self):
-        parse_style_codes(self.codes, self.style)
-        self.output += str(self.style)
-
-
     def handle_private_modes(self):
-        pass
-
-
+        screen = self.screen
+        enable = self.code_type == '?h'
+        for code in self.codes:
+            if code == 25:
+                screen.cursor_visible = enable
+            elif code == 1:
+                screen.app_cursor_keys = enable
+            elif code == 7:
+                screen.auto_wrap = enable
+            elif code == 2026:
+                screen.synchronized = enable
+            elif code == 2004:
+                screen.bracketed_paste = enable
+            elif code in (47, 1047, 1049):
+                # the cursor position is part of the main screen's state, so it comes back along with it
+                if enable:
+                    screen.enter_alternate()
+                else:
+                    screen.exit_alternate()
+            elif code == 6:
+                # TODO: origin mode is not supported
+                pass
+
+
+    # ESC ] 133 ; kind ; args BEL   shell integration marks, see CommandBlocks
     def handle_os_commands(self):
-        pass
+        codes = self.codes
+        if codes[0] == 133 and len(codes) > 1:
+            kind, _, args = codes[1].partition(';')
+            self.screen.mark(kind, args)
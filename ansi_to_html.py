@@ -1,4 +1,5 @@
 import html
+from functools import lru_cache
 
 # https://www.man7.org/linux/man-pages/man4/console_codes.4.html
 
@@ -9,113 +10,227 @@ import html
 # echo -e "default\e[31mred\e[32mgreen\e[33myellow\e[34mblue\e[35mmagenta\e[36mcyan\e[30mblack\e[37mwhite\e[0mdefault"
 # echo -e "default\e[91mred\e[92mgreen\e[93myellow\e[94mblue\e[95mmagenta\e[96mcyan\e[90mblack\e[97mwhite\e[0mdefault"
 # echo -e "\e[38;2;50;100;150m\e[48;2;250;200;150mhello world"
+# echo -e "\e[38;5;208morange\e[48;5;236m on dark gray"
 
+
+# TODO: base settings should be configurable - the defaults should probably detect dark/light desktop themes and adjust themselves
+DEFAULT_TEXT_COLOR = 'GhostWhite'
+DEFAULT_BACKGROUND_COLOR = 'transparent'
+
+# the 16 basic colors - codes 30-37 and 90-97 for text, 40-47 and 100-107 for backgrounds
+PALETTE = [
+    'black', 'Crimson', 'LimeGreen', 'LemonChiffon', 'DeepSkyBlue', 'Orchid', 'Aqua', 'GhostWhite',
+    'LightSlateGray', 'LightCoral', 'LightGreen', 'LightYellow', 'LightSkyBlue', 'LightPink', 'LightCyan', 'LightGray',
+]
+
+# a style is packed into a single int, which doubles as its style_id:
+#   bits  0-7   attributes
+#   bits  8-33  text color
+#   bits 34-59  background color
+# each color is a 2 bit kind followed by 24 bits of data - a palette index or an rgb value
+BOLD = 1
+ITALIC = 2
+UNDERLINE = 4
+INVERSE = 8
+
+DEFAULT = 0
+INDEXED = 1
+RGB = 2
+
+TEXT_SHIFT = 8
+BACKGROUND_SHIFT = 34
+COLOR_MASK = (1 << 26) - 1
+
+DEFAULT_STYLE = 0
+
+
+def indexed_color(idx):
+    return (INDEXED << 24) | (idx & 255)
+
+
+def rgb_color(r, g, b):
+    return (RGB << 24) | ((r & 255) << 16) | ((g & 255) << 8) | (b & 255)
+
+
+# the css color for one packed color
+def color_to_css(color, default):
+    kind = color >> 24
+    if kind == DEFAULT:
+        return default
+
+    if kind == RGB:
+        return f'rgb({(color >> 16) & 255},{(color >> 8) & 255},{color & 255})'
+
+    # 256 color mode - 16 basic colors, then a 6x6x6 color cube, then 24 shades of gray
+    idx = color & 255
+    if idx < 16:
+        return PALETTE[idx]
+    if idx < 232:
+        idx -= 16
+        levels = [0 if level == 0 else 55 + level * 40 for level in (idx // 36, (idx // 6) % 6, idx % 6)]
+        return f'rgb({levels[0]},{levels[1]},{levels[2]})'
+    gray = 8 + (idx - 232) * 10
+    return f'rgb({gray},{gray},{gray})'
+
+
+# a style that can be changed code by code - key() packs it into a style_id
 class HtmlStyle:
+    __slots__ = ('text_color', 'background_color', 'attributes')
+
     def __init__(self):
-        self.background_color = 'transparent'
-        self.text_color = 'GhostWhite'
-        self.is_bold = False
-        self.is_italic = False
-
-        self.code_map = {
-            # TODO: base settings should be configurable - the defaults should probably detect dark/light desktop themes and adjust themselves
-            0: lambda: self.set_default(),
-            1: lambda: self.set_is_bold('bold'),
-            3: lambda: self.set_is_italic('italic'),
-
-            30: lambda: self.set_text_color('black'),
-            31: lambda: self.set_text_color('Crimson'),
-            32: lambda: self.set_text_color('LimeGreen'),
-            33: lambda: self.set_text_color('LemonChiffon'),  # yellow
-            34: lambda: self.set_text_color('DeepSkyBlue'),
-            35: lambda: self.set_text_color('Orchid'),  # magenta
-            36: lambda: self.set_text_color('Aqua'),  # cyan
-            37: lambda: self.set_text_color('GhostWhite'),
-            39: lambda: self.set_text_color('GhostWhite'),  # default
-
-            40: lambda: self.set_background_color('black'),
-            41: lambda: self.set_background_color('Crimson'),
-            42: lambda: self.set_background_color('LimeGreen'),
-            43: lambda: self.set_background_color('LemonChiffon'),
-            44: lambda: self.set_background_color('DeepSkyBlue'),
-            45: lambda: self.set_background_color('Orchid'),
-            46: lambda: self.set_background_color('Aqua'),
-            47: lambda: self.set_background_color('GhostWhite'),
-            49: lambda: self.set_background_color('transparent'),  # default
-
-            90: lambda: self.set_text_color('LightSlateGray'),
-            91: lambda: self.set_text_color('LightCoral'),
-            92: lambda: self.set_text_color('LightGreen'),
-            93: lambda: self.set_text_color('LightYellow'),
-            94: lambda: self.set_text_color('LightSkyBlue'),
-            95: lambda: self.set_text_color('LightPink'),
-            96: lambda: self.set_text_color('LightCyan'),
-            97: lambda: self.set_text_color('LightGray'),
-
-            100: lambda: self.set_background_color('LightSlateGray'),
-            101: lambda: self.set_background_color('LightCoral'),
-            102: lambda: self.set_background_color('LightGreen'),
-            103: lambda: self.set_background_color('LightYellow'),
-            104: lambda: self.set_background_color('LightSkyBlue'),
-            105: lambda: self.set_background_color('LightPink'),
-            106: lambda: self.set_background_color('LightCyan'),
-            107: lambda: self.set_background_color('LightGray'),
-
-            # these are used in combination with other codes to construct colors
-            38: lambda rgb : self.set_text_color(rgb),
-            48: lambda rgb : self.set_background_color(rgb),
-        }
+        self.set_default()
 
-    def __str__(self):
-        if self.is_bold:
-            bold = 'bold'
-        else:
-            bold = 'normal'
+    def key(self):
+        return self.attributes | (self.text_color << TEXT_SHIFT) | (self.background_color << BACKGROUND_SHIFT)
 
-        if self.is_italic:
-            italic = 'italic'
-        else:
-            italic = 'normal'
+    @classmethod
+    def from_key(cls, style_id):
+        style = cls()
+        style.attributes = style_id & 255
+        style.text_color = (style_id >> TEXT_SHIFT) & COLOR_MASK
+        style.background_color = (style_id >> BACKGROUND_SHIFT) & COLOR_MASK
+        return style
 
-        return f'<span style="white-space:pre;color:{self.text_color};background-color:{self.background_color};font-weight:{bold};font-style:{italic}">'
+    def __str__(self):
+        return style_span(self.key())
 
     def set_default(self):
-        self.background_color = 'transparent'
-        self.text_color = 'GhostWhite'
-        self.is_bold = False
-        self.is_italic = False
+        self.background_color = DEFAULT
+        self.text_color = DEFAULT
+        self.attributes = 0
 
     def set_background_color(self, color):  self.background_color = color
     def set_text_color(self, color):        self.text_color = color
-    def set_is_bold(self, is_bold):         self.is_bold = is_bold
-    def set_is_italic(self, is_italic):     self.is_italic = is_italic
+    def set_attribute(self, attribute):     self.attributes |= attribute
+    def clear_attribute(self, attribute):   self.attributes &= ~attribute
 
     def map_code(self, code):
-        code_func = self.code_map.get(code)
+        code_func = CODE_MAP.get(code)
         if code_func:
-            code_func()
-
-    def map_256_color(self, codes):
-        # TODO: 256 color mapping
-        pass
-
-    def map_rgb_color(self, codes):
-        self.code_map.get(codes[0])(f'rgb({codes[2]},{codes[3]},{codes[4]})')
+            code_func(self)
+
+    def map_256_color(self, code, idx):
+        self.map_color(code, indexed_color(idx))
+
+    def map_rgb_color(self, code, r, g, b):
+        self.map_color(code, rgb_color(r, g, b))
+
+    def map_color(self, code, color):
+        if code == 38:
+            self.text_color = color
+        elif code == 48:
+            self.background_color = color
+
+
+# this maps each style code to what it does to a style - it is shared by every HtmlStyle
+CODE_MAP = {
+    0: HtmlStyle.set_default,
+    1: lambda style: style.set_attribute(BOLD),
+    3: lambda style: style.set_attribute(ITALIC),
+    4: lambda style: style.set_attribute(UNDERLINE),
+    7: lambda style: style.set_attribute(INVERSE),
+    22: lambda style: style.clear_attribute(BOLD),
+    23: lambda style: style.clear_attribute(ITALIC),
+    24: lambda style: style.clear_attribute(UNDERLINE),
+    27: lambda style: style.clear_attribute(INVERSE),
+
+    39: lambda style: style.set_text_color(DEFAULT),
+    49: lambda style: style.set_background_color(DEFAULT),
+}
+for i in range(8):
+    CODE_MAP[30 + i] = lambda style, color=indexed_color(i): style.set_text_color(color)
+    CODE_MAP[40 + i] = lambda style, color=indexed_color(i): style.set_background_color(color)
+    CODE_MAP[90 + i] = lambda style, color=indexed_color(8 + i): style.set_text_color(color)
+    CODE_MAP[100 + i] = lambda style, color=indexed_color(8 + i): style.set_background_color(color)
+
+
+# (text color, background color) of a style as css, with inverse already applied
+@lru_cache(maxsize=1024)
+def style_colors(style_id):
+    text_color = color_to_css((style_id >> TEXT_SHIFT) & COLOR_MASK, DEFAULT_TEXT_COLOR)
+    background_color = color_to_css((style_id >> BACKGROUND_SHIFT) & COLOR_MASK, DEFAULT_BACKGROUND_COLOR)
+    if style_id & INVERSE:
+        if background_color == DEFAULT_BACKGROUND_COLOR:
+            background_color = 'black'
+        text_color, background_color = background_color, text_color
+    return text_color, background_color
+
+
+@lru_cache(maxsize=1024)
+def style_css(style_id):
+    text_color, background_color = style_colors(style_id)
+    bold = 'bold' if style_id & BOLD else 'normal'
+    italic = 'italic' if style_id & ITALIC else 'normal'
+    css = f'white-space:pre;color:{text_color};background-color:{background_color};font-weight:{bold};font-style:{italic}'
+    if style_id & UNDERLINE:
+        css += ';text-decoration:underline'
+    return css
+
+
+@lru_cache(maxsize=1024)
+def style_span(style_id):
+    return f'<span style="{style_css(style_id)}">'
 
 
 def parse_style_codes(codes, style):
-    # TODO: is it valid to chain style codes together in the same escape sequence?
-    #       ex:  \x1b[38;5;{id};48;5;{id}m   <- is this valid for setting both foreground and background colors via 256 color?
-
-    # \x1b[38;5;{id}m  \x1b[48;5;{id}m    256 Color  foreground/background
-    if len(codes) == 3 and codes[1] == 5:
-        style.map_256_color(codes)
-        return
-
-    # \x1b[38;2;{r};{g};{b}m  \x1b[48;2;{r};{g};{b}m    true color RGB foreground/background
-    if len(codes) == 5 and codes[1] == 2:
-        style.map_rgb_color(codes)
-        return
-
-    for code in codes:
+    # several codes can be chained together in the same escape sequence, including extended colors
+    #   \x1b[38;5;{id}m  \x1b[48;5;{id}m    256 Color  foreground/background
+    #   \x1b[38;2;{r};{g};{b}m  \x1b[48;2;{r};{g};{b}m    true color RGB foreground/background
+    i = 0
+    count = len(codes)
+    while i < count:
+        code = codes[i]
+        if code in (38, 48, 58) and i + 1 < count:
+            if codes[i + 1] == 5 and i + 2 < count:
+                style.map_256_color(code, codes[i + 2])
+                i += 3
+                continue
+            if codes[i + 1] == 2 and i + 4 < count:
+                style.map_rgb_color(code, codes[i + 2], codes[i + 3], codes[i + 4])
+                i += 5
+                continue
         style.map_code(code)
+        i += 1
+
+
+# the style_id that results from applying a sequence of style codes to a style
+# only a handful of (style, codes) combinations show up in practice, so this rarely has to build an HtmlStyle
+@lru_cache(maxsize=4096)
+def apply_style_codes(style_id, codes):
+    style = HtmlStyle.from_key(style_id)
+    parse_style_codes(codes, style)
+    return style.key()
+
+
+# html export of (style_id, text) runs
+# every span is closed before the next one starts, runs that share a style are merged, and default text gets no span at all
+# the whole chunk is wrapped in one default-styled span, so the output never nests more than two spans deep
+def runs_to_html(runs):
+    output = [style_span(DEFAULT_STYLE)]
+    current_style = DEFAULT_STYLE
+    texts = []
+
+    for style_id, text in runs:
+        if not text:
+            continue
+        if style_id != current_style:
+            append_html_run(output, current_style, texts)
+            current_style = style_id
+            texts = []
+        texts.append(text)
+
+    append_html_run(output, current_style, texts)
+    output.append('</span>')
+    return ''.join(output)
+
+
+def append_html_run(output, style_id, texts):
+    if not texts:
+        return
+    text = html.escape(''.join(texts), False)
+    if style_id == DEFAULT_STYLE:
+        output.append(text)
+    else:
+        output.append(style_span(style_id))
+        output.append(text)
+        output.append('</span>')
@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from PySide6.QtCore import QCoreApplication
+except ImportError:
+    QCoreApplication = None
+
+
+# compares dterm's two ways of getting pty output to the screen, with a real shell and a real qt event loop (no window)
+#   threaded       - ShellHandler.thread_handle_io and a QueueReader, each on their own thread  (the default)
+#   single thread  - PtyNotifier on the qt event loop  (dterm.py --single-thread)
+#   python bench/bench_io_modes.py [MB]
+# throughput is a flood of base64 output until it is all on the screen, and latency is the time from a key press until its
+# echo has been handed to the gui thread - the median of KEYS presses while the shell is idle
+# needs PySide6, and skips itself without it
+
+
+KEYS = 50
+TIMEOUT = 120
+DONE = '__dterm_bench_done__'
+
+
+# keeps the qt event loop going until cond() is true - frames from either mode are delivered through it
+def wait_until(app, cond, timeout=TIMEOUT):
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > end:
+            raise TimeoutError('the shell did not answer in time')
+        app.processEvents()
+        time.sleep(0.0002)
+
+
+class Frames:
+    def __init__(self, screen):
+        self.screen = screen
+        self.count = 0
+        self.cursor_text = ''
+
+    # runs on the gui thread with every frame
+    def show(self, damage):
+        self.count += 1
+        with self.screen.lock:
+            self.cursor_text = self.screen.grid[self.screen.cursor_row].text()
+
+
+def start(mode):
+    from screen import Screen
+    from ansi_parser import AnsiParser
+    from ansi_to_html import HtmlStyle
+    from output_limiter import OutputLimiter
+    from output_pipeline import OutputPipeline, InlineSink, FRAME_RATE
+    from shell_handler import ShellHandler
+
+    shell = ShellHandler()
+    screen = Screen(50, 200)
+    shell.resize(screen.rows, screen.cols)
+    pipeline = OutputPipeline(screen, AnsiParser(HtmlStyle(), screen), OutputLimiter())
+    frames = Frames(screen)
+
+    if mode == 'single thread':
+        from pty_notifier import PtyNotifier
+        sink = InlineSink(frames.show)
+        notifier = PtyNotifier(shell, lambda data: pipeline.process(data, sink), FRAME_RATE)
+        stop = lambda: notifier.read_notifier.setEnabled(False)
+    else:
+        from dterm import QueueReader
+        threading.Thread(target=shell.thread_handle_io, daemon=True).start()
+        reader = QueueReader(shell.q_stdout, pipeline, frames.show)
+        threading.Thread(target=reader.run, daemon=True).start()
+        stop = reader.stop
+
+    def close():
+        stop()
+        shell.stop()
+        if shell.proc.poll() is None:
+            shell.proc.kill()
+    return shell, screen, frames, close
+
+
+def screen_text(screen):
+    with screen.lock:
+        return '\n'.join(line.text() for line in screen.grid)
+
+
+def measure(app, mode, size):
+    shell, screen, frames, close = start(mode)
+    try:
+        # the prompt is up once the first frame is in and the shell has gone quiet
+        wait_until(app, lambda: frames.count > 0)
+        time.sleep(0.5)
+        app.processEvents()
+
+        # the marker is split in the command, so that the echo of the command line does not match it
+        count = frames.count
+        start_time = time.perf_counter()
+        shell.run_command(f'head -c {size * 3 // 4} /dev/zero | base64 -w 76; echo {DONE[:8]}""{DONE[8:]}')
+        wait_until(app, lambda: DONE in screen_text(screen))
+        seconds = time.perf_counter() - start_time
+        flood_frames = frames.count - count
+
+        time.sleep(0.5)
+        app.processEvents()
+        latencies = []
+        for _ in range(KEYS):
+            echoed = frames.cursor_text.count('#') + 1
+            start_time = time.perf_counter()
+            shell.write_key(b'#')
+            wait_until(app, lambda: frames.cursor_text.count('#') >= echoed, 5)
+            latencies.append(time.perf_counter() - start_time)
+            time.sleep(0.02)
+        shell.write_key(b'\x15')
+        latencies.sort()
+        return seconds, flood_frames, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.9)]
+    finally:
+        close()
+
+
+def main():
+    if QCoreApplication is None:
+        print('skipped - PySide6 is not installed')
+        return
+
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 50 * 10 ** 6
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+    print(f'{size / 1e6:.0f} MB of base64, then {KEYS} key presses')
+    for mode in ['threaded', 'single thread']:
+        seconds, flood_frames, median, p90 = measure(app, mode, size)
+        print(f'{mode:14} {size / seconds / 1e6:6.2f} MB/s  {flood_frames} frames  '
+              f'key echo median {median * 1000:.2f} ms, 90th percentile {p90 * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
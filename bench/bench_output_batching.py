@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import queue
+import random
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from screen import Screen
+from ansi_parser import AnsiParser
+from ansi_to_html import HtmlStyle
+from output_buffer import OutputBuffer
+from output_limiter import OutputLimiter
+from output_pipeline import OutputPipeline, FrameBatcher
+
+
+# how fast a flood of small pty reads gets on screen, with and without frame batching, without Qt
+#   python bench/bench_output_batching.py [MB] [paint ms]
+# the gui thread is played by a thread that takes paint ms (4 by default) for each frame it is sent
+#   per chunk  - every read is parsed and painted on its own, the way output was handled before FrameBatcher
+#   batched    - a reader thread puts reads into an OutputBuffer, and a FrameBatcher drains it and sends at most one
+#                frame per display frame, like QueueReader
+# throughput is counted until the last frame has been painted
+
+
+ROWS = 50
+COLS = 200
+
+# find / and make -j come out of the pty a few hundred bytes at a time
+CHUNK_SIZES = [64, 128, 256, 512, 1024, 4096]
+
+
+def find_output(rnd, size):
+    words = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz_.-') for _ in range(rnd.randint(2, 12))) for _ in range(500)]
+    lines = []
+    total = 0
+    while total < size:
+        line = '/' + '/'.join(rnd.choice(words) for _ in range(rnd.randint(1, 8)))
+        lines.append(line)
+        total += len(line) + 2
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def chunks_of(rnd, data):
+    chunks = []
+    idx = 0
+    while idx < len(data):
+        size = rnd.choice(CHUNK_SIZES)
+        chunks.append(data[idx:idx + size])
+        idx += size
+    return chunks
+
+
+def new_pipeline():
+    screen = Screen(ROWS, COLS)
+    return OutputPipeline(screen, AnsiParser(HtmlStyle(), screen), OutputLimiter())
+
+
+# stands in for the gui thread - paints each frame, then lets the sender know it is done
+class Painter:
+    def __init__(self, paint_time):
+        self.paint_time = paint_time
+        self.frames = queue.Queue()
+        self.painted = 0
+        self.on_painted = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            damage = self.frames.get()
+            time.sleep(self.paint_time)
+            self.painted += 1
+            if self.on_painted:
+                self.on_painted()
+
+
+class SerialSink:
+    def __init__(self, painter):
+        self.painter = painter
+        self.done = threading.Event()
+        painter.on_painted = self.done.set
+
+    def ready(self):
+        return True
+
+    # one signal per read - the next read is only handled once the gui thread got through this one
+    def send(self, damage):
+        self.done.clear()
+        self.painter.frames.put(damage)
+        self.done.wait()
+
+
+def per_chunk(chunks, paint_time):
+    painter = Painter(paint_time)
+    pipeline = new_pipeline()
+    sink = SerialSink(painter)
+    start = time.perf_counter()
+    for chunk in chunks:
+        pipeline.process(chunk, sink)
+    return time.perf_counter() - start, painter.painted
+
+
+def batched(chunks, paint_time):
+    painter = Painter(paint_time)
+    buffer = OutputBuffer(on_drain=lambda: resumed.set())
+    resumed = threading.Event()
+    pipeline = new_pipeline()
+    batcher = FrameBatcher(buffer, pipeline, painter.frames.put)
+
+    # counts what has been through the pipeline, to know when everything is on screen
+    processed = [0]
+    process = pipeline.process
+
+    def counted(data, sink):
+        process(data, sink)
+        processed[0] += len(data)
+    pipeline.process = counted
+
+    painter.on_painted = batcher.delivered.set
+    thread = threading.Thread(target=batcher.run, daemon=True)
+    thread.start()
+
+    start = time.perf_counter()
+    # the pty reader - it stops at the high watermark until the buffer has drained, like ShellHandler
+    for chunk in chunks:
+        if buffer.put(chunk):
+            resumed.clear()
+            resumed.wait()
+    # everything is on screen once the last batch is processed and its frame painted
+    total = sum(len(chunk) for chunk in chunks)
+    while processed[0] < total or pipeline.dirty or not batcher.delivered.is_set():
+        time.sleep(0.001)
+    seconds = time.perf_counter() - start
+    batcher.stop()
+    return seconds, painter.painted
+
+
+# how long a single keystroke's echo takes to reach the painter when nothing else is going on
+def echo_latency(paint_time):
+    painter = Painter(paint_time)
+    buffer = OutputBuffer()
+    batcher = FrameBatcher(buffer, new_pipeline(), painter.frames.put)
+    painted = threading.Event()
+    painter.on_painted = lambda: (batcher.delivered.set(), painted.set())
+    threading.Thread(target=batcher.run, daemon=True).start()
+    latencies = []
+    for _ in range(20):
+        time.sleep(0.05)
+        painted.clear()
+        start = time.perf_counter()
+        buffer.put(b'x')
+        painted.wait()
+        latencies.append(time.perf_counter() - start - paint_time)
+    batcher.stop()
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 5 * 10 ** 6
+    paint_time = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.004
+    rnd = random.Random(1)
+    data = find_output(rnd, size)
+    chunks = chunks_of(rnd, data)
+    print(f'{len(data) / 1e6:.1f} MB in {len(chunks)} reads, {paint_time * 1000:.1f} ms to paint a frame')
+
+    for name, run in [('per chunk', per_chunk), ('batched', batched)]:
+        seconds, frames = run(chunks, paint_time)
+        print(f'{name:10} {len(data) / seconds / 1e6:6.2f} MB/s  {seconds:6.2f} s  {frames} frames')
+    print(f'keystroke echo reaches the painter in {echo_latency(paint_time) * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
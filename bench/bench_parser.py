@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from screen import Screen
+from ansi_parser import AnsiParser
+from ansi_to_html import HtmlStyle
+
+
+# how fast pty output goes through AnsiParser and Screen, without Qt
+#   python bench/bench_parser.py [MB]
+# each workload is fed in 64 KiB reads like the pty reader does, and the best of a few runs is reported
+
+
+READ_SIZE = 65536
+RUNS = 3
+
+
+def file_name(rnd):
+    return ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz_.-0123456789') for _ in range(rnd.randint(3, 16)))
+
+
+# ls --color: a handful of colored names per line
+def ls_color(rnd, size):
+    colors = ['\x1b[0m', '\x1b[01;34m', '\x1b[01;32m', '\x1b[01;36m', '\x1b[40;33;01m', '\x1b[01;31m']
+    lines = []
+    total = 0
+    while total < size:
+        line = '  '.join(rnd.choice(colors) + file_name(rnd) + '\x1b[0m' for _ in range(rnd.randint(1, 8)))
+        lines.append(line)
+        total += len(line) + 2
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+# cat of a log file: long plain lines
+def plain_text(rnd, size):
+    words = [file_name(rnd) for _ in range(500)]
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join(rnd.choice(words) for _ in range(rnd.randint(2, 25)))
+        lines.append(line)
+        total += len(line) + 2
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+# compiler output: colored file:line prefixes, some wrapping, an occasional progress line redrawn with \r and erase
+def build_log(rnd, size):
+    words = [file_name(rnd) for _ in range(500)]
+    lines = []
+    total = 0
+    while total < size:
+        kind = rnd.random()
+        if kind < 0.1:
+            line = f'\r\x1b[K[{rnd.randint(0, 100):3d}%] \x1b[32mBuilding\x1b[0m {rnd.choice(words)}.o'
+        elif kind < 0.2:
+            line = (f'\x1b[1m{rnd.choice(words)}.c:{rnd.randint(1, 999)}:{rnd.randint(1, 80)}: \x1b[1;35mwarning:\x1b[0m '
+                    + ' '.join(rnd.choice(words) for _ in range(rnd.randint(5, 40))))
+        else:
+            line = ' '.join(rnd.choice(words) for _ in range(rnd.randint(2, 30)))
+        lines.append(line)
+        total += len(line) + 2
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+WORKLOADS = [('ls --color', ls_color), ('plain text', plain_text), ('build log', build_log)]
+
+
+def feed(data):
+    screen = Screen(50, 200)
+    parser = AnsiParser(HtmlStyle(), screen)
+    start = time.perf_counter()
+    for idx in range(0, len(data), READ_SIZE):
+        parser.feed(data[idx:idx + READ_SIZE])
+        screen.take_damage()
+    return time.perf_counter() - start
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 10 ** 7
+    for name, make in WORKLOADS:
+        data = make(random.Random(1), size)
+        seconds = min(feed(data) for _ in range(RUNS))
+        print(f'{name:12} {len(data) / 1e6:6.1f} MB  {len(data) / seconds / 1e6:6.2f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import random
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from screen import Screen
+from scrollback import ScrollbackStore, PAGE_SIZE
+from ansi_to_html import HtmlStyle, parse_style_codes
+
+
+# how much memory scrollback takes for a long session, without Qt
+#   python bench/bench_scrollback.py [lines] [--spill]
+# lines (10 million by default) are written to the screen and scrolled off into a ScrollbackStore that is big enough
+# to keep all of them, then a few old pages are read back the way scrolling or searching would
+
+
+ROWS = 50
+COLS = 200
+
+
+# resident memory right now, in bytes
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def make_style(codes):
+    style = HtmlStyle()
+    parse_style_codes(codes, style)
+    return style.key()
+
+
+def make_words(rnd):
+    return [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz_./') for _ in range(rnd.randint(2, 12))) for _ in range(2000)]
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    lines = int(float(args[0])) if args else 10 ** 7
+    spill = '--spill' in sys.argv
+
+    rnd = random.Random(1)
+    words = make_words(rnd)
+    styles = [make_style(codes) for codes in [(0,), (1,), (32,), (1, 31), (33,), (36,)]]
+    texts = [' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 20))) for _ in range(4096)]
+
+    store = ScrollbackStore(max_lines=lines + PAGE_SIZE, max_bytes=1 << 62, spill=spill)
+    screen = Screen(ROWS, COLS, scrollback=store)
+    before = rss()
+    start = time.perf_counter()
+
+    # build-log-like lines - a colored counter now and then, so that not every line is the same as one before it
+    for idx in range(lines):
+        if idx % 8 == 0:
+            screen.style_id = styles[idx % len(styles)]
+            screen.draw(f'[{idx}] ')
+            screen.style_id = styles[0]
+        screen.draw(texts[idx % len(texts)])
+        screen.carriage_return()
+        screen.linefeed()
+        if idx % 1000 == 0:
+            screen.take_damage()
+        if idx and idx % 1000000 == 0:
+            print(f'{idx} lines, {(rss() - before) / 1048576:.0f} MiB', flush=True)
+
+    seconds = time.perf_counter() - start
+    used = rss() - before
+
+    # scrolling back to old output unpacks one page at a time
+    pages = store.page_count()
+    read_start = time.perf_counter()
+    for _ in range(100):
+        store.page(rnd.randrange(pages - 1))
+    read_time = (time.perf_counter() - read_start) / 100
+
+    print(f'{lines} lines of output in {seconds:.1f} s, {lines / seconds:.0f} lines/s - '
+          f'{len(store)} lines of scrollback, since a few wrap')
+    print(f'compressed pages: {store.block_bytes / 1048576:.1f} MiB' + (' in the spill file' if spill else ''))
+    print(f'resident memory grew by {used / 1048576:.1f} MiB, {used / len(store):.1f} bytes per line')
+    print(f'peak resident memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+    print(f'reading back an old page takes {read_time * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
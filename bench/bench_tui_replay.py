@@ -0,0 +1,111 @@
+import os
+import sys
+import pty
+import time
+import fcntl
+import select
+import struct
+import marshal
+import termios
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from screen import Screen
+from ansi_parser import AnsiParser
+from ansi_to_html import HtmlStyle
+
+
+# replays a recorded full-screen program through AnsiParser and Screen, without Qt, and reports the cpu time it takes
+# for each second of the program's refreshing - the cost of keeping something like htop on screen
+#   python bench/bench_tui_replay.py [recording]
+#   python bench/bench_tui_replay.py --record out.rec htop -d 1
+# a recording is every read from the pty with the time it came in, so frames arrive the same way they did for real
+# bench/recordings/top.rec is `top -d 0.1` at 80x24 for 5 seconds - htop is not always installed, top nearly always is
+
+
+RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings')
+ROWS = 24
+COLS = 80
+
+# the renderer shows at most this many frames a second, see OutputPipeline - anything in between is batched together
+FRAME_TIME = 1 / 60
+RUNS = 5
+
+
+def record(path, argv, seconds):
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.environ['TERM'] = 'xterm-256color'
+        os.environ['LINES'] = str(ROWS)
+        os.environ['COLUMNS'] = str(COLS)
+        os.execvp(argv[0], argv)
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', ROWS, COLS, 0, 0))
+
+    chunks = []
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        if select.select([fd], [], [], 0.1)[0]:
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            chunks.append((time.monotonic() - start, data))
+    try:
+        os.write(fd, b'q')
+        os.kill(pid, 9)
+    except OSError:
+        pass
+    os.waitpid(pid, 0)
+
+    with open(path, 'wb') as f:
+        marshal.dump(chunks, f)
+    print(f'{len(chunks)} reads, {sum(len(data) for _, data in chunks)} bytes, {chunks[-1][0]:.1f} seconds')
+
+
+# feeds the recording a frame at a time, and collects what TerminalView would repaint - the runs of every damaged line
+# returns (cpu seconds, frames, damaged cells)
+def replay(chunks):
+    screen = Screen(ROWS, COLS)
+    parser = AnsiParser(HtmlStyle(), screen)
+    frames = 0
+    cells = 0
+    frame_end = 0.0
+    start = time.process_time()
+    for idx, (when, data) in enumerate(chunks):
+        parser.feed(data)
+        if idx + 1 < len(chunks) and chunks[idx + 1][0] < frame_end:
+            continue
+        frame_end = when + FRAME_TIME
+
+        damaged = screen.take_damage()
+        if damaged is None:
+            damaged = {screen.offset() + row: [0, COLS] for row in range(ROWS)}
+        for line_idx, (first, last) in damaged.items():
+            screen.line(line_idx).runs()
+            cells += last - first
+        frames += 1
+    return time.process_time() - start, frames, cells
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--record':
+        record(sys.argv[2], sys.argv[3:], float(os.environ.get('RECORD_SECONDS', 5)))
+        return
+
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(RECORDINGS, 'top.rec')
+    with open(path, 'rb') as f:
+        chunks = marshal.load(f)
+    duration = chunks[-1][0] - chunks[0][0]
+    size = sum(len(data) for _, data in chunks)
+
+    seconds, frames, cells = min(replay(chunks) for _ in range(RUNS))
+    print(f'{os.path.basename(path)}: {size} bytes in {len(chunks)} reads over {duration:.1f} seconds')
+    print(f'{frames} frames, {cells / frames:.0f} of {ROWS * COLS} cells repainted per frame')
+    print(f'{seconds * 1000:.1f} ms cpu in total, {seconds / duration * 1000:.2f} ms cpu per second of refresh, '
+          f'{seconds / frames * 1000:.3f} ms per frame')
+
+
+if __name__ == '__main__':
+    main()
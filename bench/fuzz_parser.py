@@ -0,0 +1,143 @@
+import os
+import sys
+import random
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from screen import Screen
+from ansi_parser import AnsiParser
+from ansi_to_html import HtmlStyle
+
+
+# feeds mutated pty output from bench/corpus through AnsiParser and Screen, without Qt
+#   python bench/fuzz_parser.py [iterations] [seed]
+# every input is fed twice, once whole and once cut into random pieces, and both screens have to end up the same
+# - output can be cut anywhere by a pty read, in the middle of an escape sequence or a utf-8 character
+# the window is resized at a few random points along the way, the same points in both runs
+# failing inputs are written to bench/crashes/
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+CRASHES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crashes')
+
+# bytes that are worth splicing in, since they change the parser's state
+INTERESTING = [b'\x1b', b'\x1b[', b'\x1b]', b'\x1bP', b'\x07', b'\x1b\\', b'\r', b'\n', b'\r\n', b'\x08', b'\t', b';', b'?',
+               b'9999999999', b'\xc2\x9b', b'\xe6\x97', b'\xff', b'm', b'H', b'h', b'l', b'J', b'K', b'r', b'@', b'P',
+               b'\x1b[?1049h', b'\x1b[?1049l', b'\x1b[2;4r', b'\x1b[L', b'\x1b[T', b'\x1bM']
+
+SIZES = [(24, 80), (5, 10), (1, 1), (50, 200)]
+
+
+def load_corpus():
+    corpus = []
+    for name in sorted(os.listdir(CORPUS)):
+        with open(os.path.join(CORPUS, name), 'rb') as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def mutate(rnd, data, corpus):
+    data = bytearray(data)
+    for _ in range(rnd.randint(1, 8)):
+        kind = rnd.random()
+        pos = rnd.randint(0, len(data))
+        if kind < 0.3 and data:
+            data[min(pos, len(data) - 1)] = rnd.randrange(256)
+        elif kind < 0.6:
+            data[pos:pos] = rnd.choice(INTERESTING)
+        elif kind < 0.75:
+            del data[pos:pos + rnd.randint(1, 16)]
+        elif kind < 0.9:
+            other = rnd.choice(corpus)
+            start = rnd.randint(0, len(other))
+            data[pos:pos] = other[start:start + rnd.randint(1, 200)]
+        else:
+            data[pos:pos] = data[pos:pos + rnd.randint(1, 64)] * rnd.randint(2, 20)
+    return bytes(data)
+
+
+# pieces are bytes to feed, or (rows, cols) to resize to
+def run(pieces, rows, cols):
+    screen = Screen(rows, cols)
+    parser = AnsiParser(HtmlStyle(), screen)
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            screen.resize(*piece)
+        else:
+            parser.feed(piece)
+        screen.take_damage()
+        check(screen)
+    return snapshot(screen)
+
+
+def check(screen):
+    assert 0 <= screen.cursor_row < screen.rows, f'cursor row {screen.cursor_row}'
+    assert 0 <= screen.cursor_col < screen.cols, f'cursor col {screen.cursor_col}'
+    assert 0 <= screen.scroll_top <= screen.scroll_bottom < screen.rows, 'scroll region'
+    assert len(screen.grid) == screen.rows, f'{len(screen.grid)} rows'
+    for line in screen.grid:
+        assert len(line.chars) == screen.cols and len(line.styles) == screen.cols, 'line width'
+
+
+def snapshot(screen):
+    lines = [screen.line(idx).runs() for idx in range(screen.line_count())]
+    return lines, screen.cursor_row, screen.cursor_col, screen.style_id, screen.alternate
+
+
+# the input with resizes at a few points - ((rows, cols), offset) pairs
+def add_resizes(data, resizes):
+    pieces = []
+    idx = 0
+    for size, offset in resizes:
+        pieces.append(data[idx:offset])
+        pieces.append(size)
+        idx = offset
+    pieces.append(data[idx:])
+    return pieces
+
+
+def split(rnd, pieces):
+    split_pieces = []
+    for data in pieces:
+        if isinstance(data, tuple):
+            split_pieces.append(data)
+            continue
+        idx = 0
+        while idx < len(data):
+            size = rnd.choice([1, 1, 2, 3, rnd.randint(1, 64)])
+            split_pieces.append(data[idx:idx + size])
+            idx += size
+    return split_pieces
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rnd = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    corpus = load_corpus()
+    failures = 0
+
+    for iteration in range(iterations):
+        data = mutate(rnd, rnd.choice(corpus), corpus)
+        rows, cols = rnd.choice(SIZES)
+        resizes = sorted(((rnd.choice(SIZES), rnd.randint(0, len(data))) for _ in range(rnd.randint(0, 3))),
+                         key=lambda resize: resize[1])
+        try:
+            whole = run(add_resizes(data, resizes), rows, cols)
+            pieces = run(split(rnd, add_resizes(data, resizes)), rows, cols)
+            assert whole == pieces, 'feeding the input in pieces changed the result'
+        except Exception:
+            failures += 1
+            os.makedirs(CRASHES, exist_ok=True)
+            path = os.path.join(CRASHES, f'{iteration}-{rows}x{cols}.bin')
+            with open(path, 'wb') as f:
+                f.write(data)
+            print(path, 'resized', resizes)
+            traceback.print_exc()
+
+    print(f'{iterations} inputs, {failures} failures')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
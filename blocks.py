@@ -0,0 +1,185 @@
+import time
+from bisect import bisect_left, bisect_right
+
+
+# shell integration marks, sent by the prompt set up in dterm_init.bash
+#   ESC ] 133 ; A BEL     the prompt is about to be printed
+#   ESC ] 133 ; B BEL     the prompt is done, the command is typed after this
+#   ESC ] 133 ; C BEL     the command was entered, its output follows
+#   ESC ] 133 ; D ; n BEL the command finished with exit code n
+PROMPT = 'A'
+COMMAND = 'B'
+OUTPUT = 'C'
+FINISHED = 'D'
+
+
+# every command that has been run, as parallel lists of line numbers that are sorted because output only ever grows downward
+# line numbers here count every line ever written, the same as Searcher, so they do not move when old scrollback is dropped
+# everything is looked up by bisecting these lists - nothing ever walks the lines themselves
+class CommandBlocks:
+    def __init__(self):
+        self.prompts = []       # line of the A mark
+        self.commands = []      # line of the B mark - the line the command was typed on
+        self.outputs = []       # line of the C mark, or None if the command has not been entered yet
+        self.ends = []          # first line after the output, or None while the command is still running
+        self.exit_codes = []
+        self.started = []       # time.monotonic() when the command was entered
+        self.durations = []     # seconds, or None while the command is still running
+
+        # folded line ranges [start, end), sorted and never overlapping
+        self.fold_starts = []
+        self.fold_ends = []
+        # fold_hidden[i] is how many lines are hidden by folds 0 through i
+        self.fold_hidden = []
+        # fold_rows[i] is the display row that fold i is collapsed into, if nothing was hidden before the first line
+        self.fold_rows = []
+
+
+    def __len__(self):
+        return len(self.prompts)
+
+
+    def mark(self, kind, args, line, col):
+        if kind == PROMPT:
+            # a prompt that is reprinted on the same line replaces the one that was there
+            if self.prompts and self.prompts[-1] == line and self.outputs[-1] is None:
+                return
+            self.prompts.append(line)
+            self.commands.append(line)
+            self.outputs.append(None)
+            self.ends.append(None)
+            self.exit_codes.append(None)
+            self.started.append(None)
+            self.durations.append(None)
+
+        elif not self.prompts:
+            return
+
+        elif kind == COMMAND:
+            self.commands[-1] = line
+
+        elif kind == OUTPUT:
+            self.outputs[-1] = line
+            self.started[-1] = time.monotonic()
+
+        elif kind == FINISHED and self.outputs[-1] is not None and self.ends[-1] is None:
+            # output that did not end with a newline still counts the line the cursor is on
+            self.ends[-1] = line + 1 if col else line
+            self.durations[-1] = time.monotonic() - self.started[-1]
+            try:
+                self.exit_codes[-1] = int(args.split(';')[0])
+            except ValueError:
+                pass
+
+
+    # forgets commands whose lines have all been dropped from the scrollback
+    def prune(self, first_line):
+        count = 0
+        while count < len(self.prompts) and self.ends[count] is not None and self.ends[count] <= first_line:
+            count += 1
+        if count:
+            for values in (self.prompts, self.commands, self.outputs, self.ends, self.exit_codes, self.started, self.durations):
+                del values[:count]
+
+        count = bisect_right(self.fold_ends, first_line)
+        if count:
+            del self.fold_starts[:count]
+            del self.fold_ends[:count]
+            self.update_folds()
+
+
+    ### lookups
+
+    # the index of the command whose prompt is at or above a line, or -1
+    def block_at(self, line):
+        return bisect_right(self.prompts, line) - 1
+
+
+    # the prompt line of the nearest command above a line, or None
+    def previous_prompt(self, line):
+        idx = bisect_left(self.prompts, line) - 1
+        return self.prompts[idx] if idx >= 0 else None
+
+
+    def next_prompt(self, line):
+        idx = bisect_right(self.prompts, line)
+        return self.prompts[idx] if idx < len(self.prompts) else None
+
+
+    # the newest command that has finished, or -1
+    def last_finished(self):
+        idx = len(self.prompts) - 1
+        while idx >= 0 and self.ends[idx] is None:
+            idx -= 1
+        return idx
+
+
+    # the [start, end) lines of a command's output, or None if it has not finished
+    def output_range(self, idx):
+        if not 0 <= idx < len(self.prompts) or self.ends[idx] is None:
+            return None
+        return self.outputs[idx], self.ends[idx]
+
+
+    ### folding
+
+    def is_folded(self, idx):
+        output = self.output_range(idx)
+        if output is None:
+            return False
+        fold = bisect_left(self.fold_starts, output[0])
+        return fold < len(self.fold_starts) and self.fold_starts[fold] == output[0]
+
+
+    # hides or shows a finished command's output
+    def toggle_fold(self, idx):
+        output = self.output_range(idx)
+        if output is None or output[0] >= output[1]:
+            return False
+        start, end = output
+        fold = bisect_left(self.fold_starts, start)
+        if fold < len(self.fold_starts) and self.fold_starts[fold] == start:
+            del self.fold_starts[fold]
+            del self.fold_ends[fold]
+        else:
+            self.fold_starts.insert(fold, start)
+            self.fold_ends.insert(fold, end)
+        self.update_folds()
+        return True
+
+
+    def update_folds(self):
+        hidden = 0
+        self.fold_hidden = []
+        self.fold_rows = []
+        for start, end in zip(self.fold_starts, self.fold_ends):
+            self.fold_rows.append(start - hidden)
+            hidden += end - start
+            self.fold_hidden.append(hidden)
+
+
+    # how many lines above a line are hidden by folds
+    def hidden_before(self, line):
+        fold = bisect_right(self.fold_starts, line) - 1
+        if fold < 0:
+            return 0
+        hidden = self.fold_hidden[fold]
+        if line < self.fold_ends[fold]:
+            # the line is inside this fold
+            hidden -= self.fold_ends[fold] - line
+        return hidden
+
+
+    def is_hidden(self, line):
+        fold = bisect_right(self.fold_starts, line) - 1
+        return fold >= 0 and line < self.fold_ends[fold]
+
+
+    # the line shown on a display row - rows count from 0 at line 0, as if nothing had ever been dropped
+    def line_at_row(self, row):
+        fold = bisect_right(self.fold_rows, row) - 1
+        return row + (self.fold_hidden[fold] if fold >= 0 else 0)
+
+
+    def row_of_line(self, line):
+        return line - self.hidden_before(line)
@@ -0,0 +1,336 @@
+import os
+import queue
+import selectors
+import shlex
+import subprocess
+import threading
+from collections import OrderedDict
+
+from PySide6.QtCore import QObject, Signal
+
+
+# how many helper shells are kept running, ready to answer
+POOL_SIZE = 2
+
+# a helper that takes longer than this is killed and replaced, and the completion comes back empty
+TIMEOUT = 2.0
+
+# completions that are remembered, newest last
+CACHE_SIZE = 256
+
+# loaded into each helper if it is installed, so commands complete the same way they do in an ordinary terminal
+BASH_COMPLETION = '/usr/share/bash-completion/bash_completion'
+
+# ends the candidates of each answer
+END = b'\x01'
+
+# the function each helper runs for a completion, with the cwd, PATH and the words of the command line
+# it prints whether the candidates are file names, then each candidate, all separated by NUL
+HELPER_SCRIPT = r'''
+__dterm_complete() {
+    cd -- "$1" 2>/dev/null || cd /
+    PATH=$2
+    COMP_LINE=$3
+    COMP_POINT=${#COMP_LINE}
+    COMP_WORDS=("${@:4}")
+    COMP_CWORD=$(( ${#COMP_WORDS[@]} - 1 ))
+    local cur=${COMP_WORDS[COMP_CWORD]} cmd=${COMP_WORDS[0]} spec func files=
+    COMPREPLY=()
+    if (( COMP_CWORD == 0 )) && [[ $cur != */* ]]; then
+        mapfile -t COMPREPLY < <(compgen -c -- "$cur")
+    elif (( COMP_CWORD > 0 )); then
+        spec=$(complete -p -- "$cmd" 2>/dev/null)
+        if [[ -z $spec ]] && declare -F _completion_loader >/dev/null; then
+            _completion_loader "$cmd" 2>/dev/null
+            spec=$(complete -p -- "$cmd" 2>/dev/null)
+        fi
+        if [[ $spec == *' -F '* ]]; then
+            func=${spec##* -F }
+            func=${func%% *}
+            "$func" "$cmd" "$cur" "${COMP_WORDS[COMP_CWORD-1]}" </dev/null 2>/dev/null
+            [[ $spec == *'-o filenames'* ]] && files=1
+        fi
+    fi
+    if (( ${#COMPREPLY[@]} == 0 )) && { (( COMP_CWORD > 0 )) || [[ $cur == */* ]]; }; then
+        mapfile -t COMPREPLY < <(compgen -f -- "$cur")
+        files=1
+    fi
+    printf '%s\0' "$files" "${COMPREPLY[@]}"
+    printf '\1\0'
+}
+
+# the live shell's functions complete as command names - the helper only needs their names, and never replaces a function
+# it already has, like the ones from bash-completion
+__dterm_stub_functions() {
+    local name
+    for name in "${__dterm_functions[@]}"; do
+        [[ -n $name ]] && ! declare -F -- "$name" >/dev/null && eval "$name() { :; }"
+    done
+    unset __dterm_functions
+}
+'''
+
+
+# splits a command line into words the way the shell would, for completing the last one
+# quotes and backslashes are taken out, and a line that ends in a space gets an empty word to complete
+def split_words(line):
+    words = []
+    word = None
+    quote = ''
+    escape = False
+    for char in line:
+        if escape:
+            word = (word or '') + char
+            escape = False
+        elif char == '\\' and quote != "'":
+            escape = True
+        elif quote:
+            if char == quote:
+                quote = ''
+            else:
+                word += char
+        elif char in '\'"':
+            quote = char
+            word = word or ''
+        elif char.isspace():
+            if word is not None:
+                words.append(word)
+            word = None
+        else:
+            word = (word or '') + char
+    words.append(word or '')
+    return words
+
+
+# backslash-escapes the characters the shell would otherwise treat specially, for file names
+def escape_name(text):
+    return ''.join('\\' + char if char in ' \t\'"\\$`!&;|<>()[]{}*?#~' else char for char in text)
+
+
+# one completion of a command line
+class Completion:
+    def __init__(self, line, cwd, words, candidates, filenames):
+        self.line = line
+        self.cwd = cwd
+        self.words = words
+        self.candidates = candidates
+        self.filenames = filenames
+
+    # the text to add to the command line - as much as all of the candidates have in common
+    # a single candidate is finished off with a space, or a slash if it is a directory
+    def insertion(self):
+        if not self.candidates:
+            return ''
+        current = self.words[-1]
+        common = os.path.commonprefix(self.candidates)
+        text = common[len(current):] if common.startswith(current) else ''
+        if self.filenames:
+            text = escape_name(text)
+        if len(self.candidates) == 1:
+            if self.filenames and os.path.isdir(os.path.join(self.cwd, os.path.expanduser(common))):
+                text += '' if common.endswith('/') else '/'
+            else:
+                text += ' '
+        return text
+
+
+# a non-interactive bash that stays running between completions, so asking it costs one round trip instead of a fork and a
+# shell startup - it never touches the user's shell or its pty
+# it loads the live shell's environment from env_file (see dterm_init.bash), and env_mtime is the version it loaded
+class Helper:
+    def __init__(self, env, env_file=None, env_mtime=None):
+        self.proc = subprocess.Popen(['/bin/bash', '--norc', '--noprofile'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     start_new_session=True,
+                                     env=env)
+        self.stdout = self.proc.stdout.fileno()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.stdout, selectors.EVENT_READ)
+        script = HELPER_SCRIPT
+        if os.path.exists(BASH_COMPLETION):
+            script += f'source {shlex.quote(BASH_COMPLETION)} >/dev/null 2>&1\n'
+        # sourced at the top level, since declare -x inside a function would only make local variables
+        self.env_mtime = env_mtime
+        if env_file:
+            script += f'source {shlex.quote(env_file)} >/dev/null 2>&1; __dterm_stub_functions\n'
+        self.write(script)
+
+    def write(self, script):
+        self.proc.stdin.write(script.encode(errors='surrogateescape'))
+        self.proc.stdin.flush()
+
+    # returns (candidates, filenames), or raises OSError if the helper died or took too long
+    def complete(self, cwd, path, line, words):
+        args = ' '.join(shlex.quote(arg) for arg in [cwd, path, line] + words)
+        self.write(f'__dterm_complete {args}\n')
+
+        data = b''
+        while not data.endswith(END + b'\x00'):
+            if not self.selector.select(TIMEOUT):
+                raise OSError('completion timed out')
+            chunk = os.read(self.stdout, 65536)
+            if not chunk:
+                raise OSError('completion helper exited')
+            data += chunk
+
+        fields = data[:-2].split(b'\x00')
+        fields.pop()
+        filenames = fields[0] == b'1'
+        candidates = sorted({field.decode(errors='surrogateescape') for field in fields[1:] if field})
+        return candidates, filenames
+
+    def close(self):
+        self.selector.close()
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+
+
+# completes command lines without going anywhere near the live shell
+# a small pool of helper shells is started right away, and each one runs on its own thread, taking requests from a queue
+# results are cached by (cwd, PATH, words), and thrown out once a directory they came from has changed
+class Completer(QObject):
+    # (generation, Completion) - generation is bumped by every request, so a late answer to an old one can be dropped
+    completed = Signal(int, object)
+
+    def __init__(self, shell, pool_size=POOL_SIZE):
+        super().__init__()
+        self.shell = shell
+        self.generation = 0
+        self.requests = queue.Queue()
+        self.done = False
+        self.pool_size = pool_size
+
+        # (cwd, path, words) -> (Completion, directories, mtimes)
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        # the version of the shell's environment that the cache was filled with - aliases and functions can come and go
+        self.env_mtime = shell.env_mtime()
+
+        for _ in range(pool_size):
+            threading.Thread(target=self.run_helper, daemon=True).start()
+
+
+    # returns the generation of the request - the Completion comes back through the completed signal,
+    # right away if it is cached
+    def request(self, line):
+        self.generation += 1
+        cwd = self.shell.cwd()
+        path = self.shell.path()
+        words = split_words(line)
+        env_mtime = self.shell.env_mtime()
+        if env_mtime != self.env_mtime:
+            self.env_mtime = env_mtime
+            with self.cache_lock:
+                self.cache.clear()
+        completion = self.cached(cwd, path, line, words)
+        if completion is not None:
+            self.completed.emit(self.generation, completion)
+        else:
+            self.requests.put((self.generation, cwd, path, line, words))
+        return self.generation
+
+
+    def stop(self):
+        self.done = True
+        for _ in range(self.pool_size):
+            self.requests.put(None)
+
+
+    # runs on a background thread, one per helper
+    def run_helper(self):
+        env = dict(os.environ)
+        helper = None
+        while not self.done:
+            if helper is None:
+                helper = self.start_helper(env)
+            request = self.requests.get()
+            if request is None:
+                break
+            generation, cwd, path, line, words = request
+            # a newer request was made while this one was waiting
+            if generation != self.generation:
+                continue
+            # the shell's environment changed since this helper started - a fresh one has nothing left over from before
+            if helper.env_mtime != self.shell.env_mtime():
+                helper.close()
+                helper = self.start_helper(env)
+
+            try:
+                candidates, filenames = helper.complete(cwd, path, line, words)
+            except OSError:
+                helper.close()
+                helper = None
+                candidates, filenames = [], False
+            completion = Completion(line, cwd, words, candidates, filenames)
+            if candidates:
+                self.store(cwd, path, words, completion)
+            self.completed.emit(generation, completion)
+
+        if helper is not None:
+            helper.close()
+
+
+    def start_helper(self, env):
+        # the mtime is taken first, so a change while the helper is loading the file is picked up next time
+        return Helper(env, self.shell.env_file, self.shell.env_mtime())
+
+
+    ### cache
+
+    # the directories a completion's candidates came from, which have to be checked for changes
+    def directories_of(self, cwd, path, words):
+        current = words[-1]
+        if len(words) == 1 and '/' not in current:
+            # commands come from every directory on PATH - installing or removing a program changes one of them
+            # cwd is checked too, since it can be on PATH as '' or '.'
+            return (cwd,) + tuple(os.path.join(cwd, directory) for directory in path.split(':') if directory)
+        return (os.path.join(cwd, os.path.dirname(os.path.expanduser(current))),)
+
+
+    def mtimes(self, directories):
+        mtimes = []
+        for directory in directories:
+            try:
+                mtimes.append(os.stat(directory).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+
+    def store(self, cwd, path, words, completion):
+        directories = self.directories_of(cwd, path, words)
+        with self.cache_lock:
+            self.cache[(cwd, path, tuple(words))] = (completion, directories, self.mtimes(directories))
+            while len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+
+    # a cached completion for the line, or for the same line with less of the last word typed - the candidates of that only
+    # have to be narrowed down, as long as the extra characters did not move into another directory
+    def cached(self, cwd, path, line, words):
+        current = words[-1]
+        directories = self.directories_of(cwd, path, words)
+        mtimes = None
+        with self.cache_lock:
+            for length in range(len(current), -1, -1):
+                if '/' in current[length:]:
+                    break
+                key = (cwd, path, tuple(words[:-1]) + (current[:length],))
+                entry = self.cache.get(key)
+                if entry is None:
+                    continue
+                completion, cached_directories, cached_mtimes = entry
+                if mtimes is None:
+                    mtimes = self.mtimes(directories)
+                if cached_directories != directories or cached_mtimes != mtimes:
+                    del self.cache[key]
+                    return None
+                self.cache.move_to_end(key)
+                candidates = [candidate for candidate in completion.candidates if candidate.startswith(current)]
+                return Completion(line, cwd, words, candidates, completion.filenames)
+        return None
@@ -4,6 +4,7 @@ import subprocess, signal
 import threading
 import shlex
 import re
+import time
 
 from PySide6.QtCore import Qt, QSize, QEvent, QObject, Signal, QThread
 from PySide6.QtGui import QTextCursor, QFont, QColor, QScreen, QKeyEvent
@@ -14,50 +15,55 @@ from PySide6.QtWidgets import (QApplication, QMainWindow, QSizeGrip,
 from main_window import MainWindow
 from shell_handler import ShellHandler
 from key_handler import KeyHandler
+from pty_notifier import PtyNotifier
+from output_pipeline import FRAME_RATE, FrameBatcher
+from completion import Completer
 
 
 # TODO: need to configure TermInfo for programs that expect it
 # TODO: need to support shells other than bash
 # TODO: need to handle setPlainText() (and other functions?) clearing the undo/redo history
 # TODO: need to interpret ansi codes (colors, buffer management, cursor movement, etc...)   https://gist.github.com/fnky/458719343aabd01cfb17a3a4f7296797
-# TODO: need to interpret escape characters like '\r' to move cursor to beginning of line
 # TODO: need to pass signals (like ctrl+c to terminate process) to the shell subprocess
-# TODO: need to be able to interact with programs that "take over" the terminal - ex:  less, vim, htop
+# TODO: need mouse reporting (?1000h, ?1002h, ?1006h) for programs that take over the terminal - ex:  htop, vim with mouse=a
 # TODO: need to implement a "password mode" for the cmd area AND ensure that the handling of said password is secure (likely with a professional audit, someday)
 
 
 # TODO: might be useful to keep track of any child processes created from the shell -  "pgrep -P <bash.pid>"  or  "pstree"  may be helpful - "jobs" command for commands run with "&"
-# TODO: setting stdout to NONBLOCK might improve speed (if possible)  https://stackoverflow.com/questions/8980050/persistent-python-subprocess
 # TODO: speed optimizations everywhere - prioritize reading STDOUT and writing to the text area
 
 
-# constantly reads a given queue, and then sends the resulting text to a given function via qt signals
+# runs a FrameBatcher on its own thread, and hands its frames to func on the gui thread via a qt signal
 class QueueReader(QThread):
-    signal = Signal(str)
+    signal = Signal(object)
 
-    def __init__(self, queue, func):
+    def __init__(self, queue, pipeline, func, frame_rate=FRAME_RATE):
         super().__init__()
-        self.queue = queue
-        self.signal.connect(func)
-        self.done = False
+        self.func = func
+        self.signal.connect(self.deliver)
+        self.batcher = FrameBatcher(queue, pipeline, self.signal.emit, frame_rate)
+
+    # runs on the gui thread
+    def deliver(self, damage):
+        try:
+            self.func(damage)
+        finally:
+            self.batcher.delivered.set()
 
     def run(self):
-        q = self.queue
-        s = self.signal
-        while not self.done:
-            text = q.get().decode('utf-8')
-            s.emit(text)
+        self.batcher.run()
+
+    def stop(self):
+        self.batcher.stop()
 
 
-# constantly queries the background shell process to see if it is still alive
-def thread_monitor_subprocess():
-    global done
-    while not done:
-        return_code = shell.proc.poll()
-        if return_code is not None:
-            # communicate to the main thread that the shell has exited
-            done = True
-            cleanup(0)
+# relays the shell's exit code to the gui thread, since ShellHandler reports it from the io thread
+class ExitRelay(QObject):
+    signal = Signal(int)
+
+    def __init__(self, func):
+        super().__init__()
+        self.signal.connect(func, Qt.QueuedConnection)
 
 
 # click the button -> run the command
@@ -70,17 +76,16 @@ def btn_run_clicked():
 
 def cleanup(exit_code=0):
     for r in readers:
-        r.done = True
-        r.queue.put(b' ')
-    shell.proc.kill()
-    shell.done = True
-    app.exit()
-    exit(exit_code)
+        r.stop()
+    completer.stop()
+    shell.stop()
+    if shell.proc.poll() is None:
+        shell.proc.kill()
+    app.exit(exit_code)
 
 
 # entry point
 if __name__ == '__main__':
-    done = False
     readers = []
     shell = ShellHandler()
     #print(f'Starting process  {shell.proc.pid} : {" ".join(shell.proc.args)}')
@@ -94,24 +99,43 @@ if __name__ == '__main__':
     key_handler.win = win
     key_handler.shell = shell
 
+    # tab completion runs in its own helper shells, see Completer
+    completer = Completer(shell)
+    win.set_completer(completer)
+
+    # keep the pty the same size as the screen
+    win.text_area.resized.connect(shell.resize)
+    shell.resize(win.screen.rows, win.screen.cols)
+
+    # commands and pastes are sent the way the shell asks for them, and big pastes show their progress
+    shell.bracketed_paste = lambda: win.screen.bracketed_paste
+    shell.on_paste_progress = win.paste_progress
+
+    # close the window once the shell exits
+    exit_relay = ExitRelay(cleanup)
+    shell.on_exit = exit_relay.signal.emit
+
     win.show()
 
-    io_thread = threading.Thread(target=shell.thread_handle_io)
-    io_thread.start()
+    if '--single-thread' in sys.argv:
+        # read the pty directly on the qt event loop - no io or reader threads
+        notifier = PtyNotifier(shell, win.append_stdout_to_text_area, FRAME_RATE)
 
-    stdout_reader = QueueReader(shell.q_stdout, win.append_stdout_to_text_area)
-    readers.append(stdout_reader)
+    else:
+        io_thread = threading.Thread(target=shell.thread_handle_io)
+        io_thread.start()
 
-    stdout_reader_thread = threading.Thread(target=stdout_reader.run)
-    stdout_reader_thread.start()
+        stdout_reader = QueueReader(shell.q_stdout, win.output, win.show_output)
+        stdout_reader.batcher.on_error = win.status_message.emit
+        readers.append(stdout_reader)
 
-    monitor_thread = threading.Thread(target=thread_monitor_subprocess)
-    monitor_thread.start()
+        stdout_reader_thread = threading.Thread(target=stdout_reader.run)
+        stdout_reader_thread.start()
 
     try:
-        app.exec()
+        exit_code = app.exec()
     except:
         # TODO: this should probably be more robust
-        cleanup(1)
-        pass
-    cleanup(0)
+        exit_code = 1
+    cleanup(exit_code)
+    sys.exit(exit_code)
@@ -0,0 +1,31 @@
+# sourced by the shell that dterm starts, in place of ~/.bashrc
+# it loads the usual config, then marks prompts, commands, and their output so dterm can tell them apart  (OSC 133)
+
+if [ -f ~/.bashrc ]; then
+    source ~/.bashrc
+fi
+
+__dterm_prompt() {
+    # this has to run first, before anything else changes $?
+    local status=$?
+    printf '\e]133;D;%s\a\e]133;A\a' "$status"
+    # tab completion runs in separate shells, which need to know where to find commands
+    if [[ -n $DTERM_PATH_FILE && $PATH != "$__dterm_path" ]]; then
+        __dterm_path=$PATH
+        printf '%s' "$PATH" > "$DTERM_PATH_FILE"
+    fi
+    # and everything else they need to complete the same things - exported variables, aliases, and the names of functions
+    # it is only written when it changed, since the helpers start over every time it does
+    if [[ -n $DTERM_ENV_FILE ]]; then
+        local env
+        env=$(export -p; alias -p; printf '__dterm_functions=('; printf '%q ' $(compgen -A function); printf ')')
+        if [[ $env != "$__dterm_env" ]]; then
+            __dterm_env=$env
+            printf '%s\n' "$env" > "$DTERM_ENV_FILE"
+        fi
+    fi
+}
+
+PROMPT_COMMAND="__dterm_prompt${PROMPT_COMMAND:+; $PROMPT_COMMAND}"
+PS1="$PS1"'\[\e]133;B\a\]'
+PS0="$PS0"$'\e]133;C\a'
@@ -0,0 +1,274 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+
+
+HISTORY_FILE = os.path.join(os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'), 'dterm', 'history.sqlite3')
+BASH_HISTORY = os.path.expanduser('~/.bash_history')
+
+# when a prefix or substring matches fewer commands than this, the matches are looked up through an index and sorted
+# otherwise it is so common that walking back from the newest command finds the next match right away
+INDEXED_MATCHES = 5000
+
+# fuzzy matches are only looked for among this many of the newest commands
+FUZZY_SCAN = 10000
+
+# the import writes this many commands at a time, and pauses in between so other writers get a turn at the lock
+IMPORT_BATCH = 2000
+IMPORT_PAUSE = 0.01
+
+# how long the writer waits before trying again when another window held the write lock for too long
+RETRY_DELAY = 0.5
+
+# a position in history that is newer than every command, to step back from
+START = (float('inf'), 0)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL UNIQUE,
+    last_used REAL NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS history_last_used ON history(last_used);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+);
+'''
+
+# the trigram index used by search() - it needs sqlite 3.34 or newer, built with fts5
+SEARCH_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS history_search USING fts5(command, content='history', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_search(rowid, command) VALUES (new.id, new.command);
+END;
+CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history BEGIN
+    INSERT INTO history_search(history_search, rowid, command) VALUES ('delete', old.id, old.command);
+END;
+'''
+
+# a command that was run again only moves forward in time - an import of older history never moves it back
+UPSERT = '''
+INSERT INTO history(command, last_used) VALUES (?, ?)
+ON CONFLICT(command) DO UPDATE SET last_used = max(last_used, excluded.last_used), uses = uses + 1
+'''
+
+
+def connect(path):
+    if path != ':memory:':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=5, isolation_level=None)
+    # several dterm windows can share the file - readers never wait for a writer, and writers wait their turn
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+# escapes a string for LIKE ... ESCAPE '\'
+def like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# every command that has been run, in any dterm, kept in sqlite next to the rest of the user's data
+# each command is stored once, with the last time it was used, so stepping through history never repeats itself
+class History:
+    def __init__(self, path=HISTORY_FILE):
+        try:
+            self.db = connect(path)
+            self.db.executescript(SCHEMA)
+        except (sqlite3.Error, OSError):
+            # no usable history file - history still works, it just is not kept
+            path = ':memory:'
+            self.db = connect(path)
+            self.db.executescript(SCHEMA)
+        self.path = path
+        self.fts = self.create_search_index()
+
+        # commands are written on a background thread, so waiting for another window's write lock never freezes the gui
+        self.adds = queue.Queue()
+        if path != ':memory:':
+            threading.Thread(target=self.write_adds, daemon=True).start()
+
+
+    # returns whether the trigram index could be set up - without it, search() scans the table instead
+    def create_search_index(self):
+        db = self.db
+        try:
+            existed = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_insert'").fetchone()
+            db.executescript(SEARCH_SCHEMA)
+            # commands added while the index was missing are not in it yet
+            if not existed:
+                db.execute("INSERT INTO history_search(history_search) VALUES ('rebuild')")
+            return True
+        except sqlite3.Error:
+            pass
+        # the file may have been set up by a newer sqlite - its triggers would make every insert fail here
+        try:
+            db.executescript('DROP TRIGGER IF EXISTS history_insert; DROP TRIGGER IF EXISTS history_delete;')
+        except sqlite3.Error:
+            pass
+        return False
+
+
+    def add(self, command):
+        command = command.strip()
+        if not command:
+            return
+        if self.path == ':memory:':
+            # nothing else can hold the lock on a database of its own
+            self.db.execute(UPSERT, (command, time.time()))
+        else:
+            self.adds.put((command, time.time()))
+
+
+    # runs on a background thread with its own connection
+    def write_adds(self):
+        db = None
+        while True:
+            entries = [self.adds.get()]
+            while not self.adds.empty():
+                entries.append(self.adds.get_nowait())
+            # another window is importing or writing - keep the commands and try again, rather than losing them
+            while True:
+                try:
+                    if db is None:
+                        db = connect(self.path)
+                    with db:
+                        db.execute('BEGIN')
+                        db.executemany(UPSERT, entries)
+                    break
+                except sqlite3.Error:
+                    time.sleep(RETRY_DELAY)
+
+
+    ### importing ~/.bash_history
+
+    # reads whatever was added to the bash history since last time, on a background thread with its own connection
+    def start_import(self, path=BASH_HISTORY):
+        if self.path != ':memory:':
+            threading.Thread(target=self.import_bash_history, args=(path,), daemon=True).start()
+
+
+    def import_bash_history(self, path):
+        try:
+            db = connect(self.path)
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                mtime = os.fstat(f.fileno()).st_mtime
+                row = db.execute('SELECT offset FROM imports WHERE path = ?', (path,)).fetchone()
+                offset = row[0] if row else 0
+                # bash rewrites the file when it trims it, so everything has to be read again - duplicates are merged anyway
+                if offset > size:
+                    offset = 0
+                f.seek(offset)
+                data = f.read(size - offset)
+        except (OSError, sqlite3.Error):
+            return
+
+        # only whole lines - the rest is read next time
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].decode(errors='replace').split('\n')[:-1]
+
+        # with HISTTIMEFORMAT set, bash writes a "#<seconds>" line before each command
+        # otherwise commands are spaced out just before the time the file was written, in order
+        entries = []
+        stamp = None
+        for idx, line in enumerate(lines):
+            if line.startswith('#') and line[1:].isdigit():
+                stamp = float(line[1:])
+                continue
+            line = line.strip()
+            if line:
+                entries.append((line, stamp if stamp is not None else mtime - (len(lines) - idx) * 1e-6))
+            stamp = None
+
+        # a big history takes a while - it is written in batches, so other windows and the writer are never locked out for long
+        # the offset goes in with the last batch, and if the import is cut short, merging duplicates makes a redo harmless
+        try:
+            for start in range(0, max(len(entries), 1), IMPORT_BATCH):
+                with db:
+                    db.execute('BEGIN')
+                    db.executemany(UPSERT, entries[start:start + IMPORT_BATCH])
+                    if start + IMPORT_BATCH >= len(entries):
+                        db.execute('INSERT OR REPLACE INTO imports(path, offset) VALUES (?, ?)', (path, offset + end))
+                time.sleep(IMPORT_PAUSE)
+        except sqlite3.Error:
+            pass
+        db.close()
+
+
+    ### lookups
+
+    # a position in history is (last_used, id) - commands can share a last_used (an import without timestamps, or two
+    # windows at once), and the id breaks the tie so stepping never skips one of them
+    # the newest command that starts with prefix and comes before a position, as (command, position), or None
+    def previous(self, prefix, before):
+        return self.step(prefix, before, older=True)
+
+
+    # the oldest command that starts with prefix and comes after a position
+    def next(self, prefix, after):
+        return self.step(prefix, after, older=False)
+
+
+    def step(self, prefix, position, older):
+        compare, order = ('<', 'DESC') if older else ('>', 'ASC')
+        when, row_id = position
+        after = f'(last_used {compare} ? OR (last_used = ? AND id {compare} ?))'
+        sort = f'ORDER BY last_used {order}, id {order} LIMIT 1'
+        db = self.db
+        if not prefix:
+            row = db.execute(f'SELECT command, last_used, id FROM history WHERE {after} {sort}',
+                             (when, when, row_id)).fetchone()
+            return (row[0], row[1:]) if row else None
+
+        # the unique index on command is sorted, so every command with a prefix is in one range of it
+        # - prefix + U+10FFFF is past the end of that range
+        ids = db.execute('SELECT id FROM history WHERE command >= ? AND command < ? LIMIT ?',
+                         (prefix, prefix + '\U0010ffff', INDEXED_MATCHES)).fetchall()
+        if len(ids) < INDEXED_MATCHES:
+            if not ids:
+                return None
+            marks = ','.join('?' * len(ids))
+            row = db.execute(f'SELECT command, last_used, id FROM history WHERE id IN ({marks}) AND {after} {sort}',
+                             [row[0] for row in ids] + [when, when, row_id]).fetchone()
+        else:
+            row = db.execute(f'SELECT command, last_used, id FROM history WHERE {after} AND substr(command, 1, ?) = ? {sort}',
+                             (when, when, row_id, len(prefix), prefix)).fetchone()
+        return (row[0], row[1:]) if row else None
+
+
+    # up to limit commands that contain text, newest first, followed by commands that only match fuzzily -
+    # the characters of text in order, with anything in between  (case does not matter)
+    def search(self, text, limit=100):
+        db = self.db
+        if not text:
+            return [row[0] for row in db.execute('SELECT command FROM history ORDER BY last_used DESC LIMIT ?', (limit,))]
+
+        pattern = '%' + like_escape(text) + '%'
+        ids = None
+        if len(text) >= 3 and self.fts:
+            # the trigram index finds rare substrings without looking at every command
+            # a quoted phrase is matched as a plain substring
+            phrase = '"' + text.replace('"', '""') + '"'
+            ids = db.execute('SELECT rowid FROM history_search WHERE history_search MATCH ? LIMIT ?',
+                             (phrase, INDEXED_MATCHES)).fetchall()
+        if ids is not None and len(ids) < INDEXED_MATCHES:
+            marks = ','.join('?' * len(ids))
+            rows = db.execute(f'SELECT command FROM history WHERE id IN ({marks}) ORDER BY last_used DESC LIMIT ?',
+                              [row[0] for row in ids] + [limit]).fetchall()
+        else:
+            rows = db.execute('SELECT command FROM history WHERE command LIKE ? ESCAPE \'\\\' ORDER BY last_used DESC LIMIT ?',
+                              (pattern, limit)).fetchall()
+        results = [row[0] for row in rows]
+
+        if len(results) < limit and len(text) > 1:
+            fuzzy = '%' + '%'.join(like_escape(char) for char in text) + '%'
+            rows = db.execute('SELECT command FROM (SELECT command, last_used FROM history ORDER BY last_used DESC LIMIT ?) '
+                              'WHERE command LIKE ? ESCAPE \'\\\' AND command NOT LIKE ? ESCAPE \'\\\' ORDER BY last_used DESC LIMIT ?',
+                              (FUZZY_SCAN, fuzzy, pattern, limit - len(results))).fetchall()
+            results.extend(row[0] for row in rows)
+        return results
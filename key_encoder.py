@@ -0,0 +1,122 @@
+from PySide6.QtCore import Qt
+
+
+keys = Qt.Key
+mods = Qt.KeyboardModifier
+
+ESC = '\x1b'
+
+# keys that are sent as CSI/SS3 + a final character, like xterm - the ones that are affected by application cursor mode
+# (DECCKM) switch from CSI to SS3 while it is on
+CURSOR_KEYS = {
+    keys.Key_Up: 'A',
+    keys.Key_Down: 'B',
+    keys.Key_Right: 'C',
+    keys.Key_Left: 'D',
+    keys.Key_Home: 'H',
+    keys.Key_End: 'F',
+}
+
+FUNCTION_KEYS = {
+    keys.Key_F1: 'P',
+    keys.Key_F2: 'Q',
+    keys.Key_F3: 'R',
+    keys.Key_F4: 'S',
+}
+
+# keys that are sent as CSI + number + ~
+TILDE_KEYS = {
+    keys.Key_Insert: 2,
+    keys.Key_Delete: 3,
+    keys.Key_PageUp: 5,
+    keys.Key_PageDown: 6,
+    keys.Key_F5: 15,
+    keys.Key_F6: 17,
+    keys.Key_F7: 18,
+    keys.Key_F8: 19,
+    keys.Key_F9: 20,
+    keys.Key_F10: 21,
+    keys.Key_F11: 23,
+    keys.Key_F12: 24,
+}
+
+# the keypad in application keypad mode (DECKPAM) - SS3 + a final character
+KEYPAD_KEYS = {
+    keys.Key_0: 'p', keys.Key_1: 'q', keys.Key_2: 'r', keys.Key_3: 's', keys.Key_4: 't',
+    keys.Key_5: 'u', keys.Key_6: 'v', keys.Key_7: 'w', keys.Key_8: 'x', keys.Key_9: 'y',
+    keys.Key_Enter: 'M',
+    keys.Key_Plus: 'k',
+    keys.Key_Minus: 'm',
+    keys.Key_Asterisk: 'j',
+    keys.Key_Slash: 'o',
+    keys.Key_Period: 'n',
+    keys.Key_Comma: 'l',
+}
+
+SIMPLE_KEYS = {
+    keys.Key_Return: '\r',
+    keys.Key_Enter: '\r',
+    keys.Key_Backspace: '\x7f',
+    keys.Key_Tab: '\t',
+    keys.Key_Backtab: ESC + '[Z',
+    keys.Key_Escape: ESC,
+}
+
+
+# the xterm modifier parameter - 1 + shift 1 + alt 2 + ctrl 4, or 0 if there are none
+def modifier_code(modifiers):
+    code = 0
+    if modifiers & mods.ShiftModifier:
+        code |= 1
+    if modifiers & mods.AltModifier:
+        code |= 2
+    if modifiers & mods.ControlModifier:
+        code |= 4
+    return code + 1 if code else 0
+
+
+# the bytes a terminal sends for a key press, or None if it does not send anything
+# app_cursor and app_keypad are the screen's DECCKM and DECKPAM modes
+def encode_key(key, modifiers, text, app_cursor=False, app_keypad=False):
+    modifier = modifier_code(modifiers)
+
+    if app_keypad and modifiers & mods.KeypadModifier and key in KEYPAD_KEYS:
+        return (ESC + 'O' + KEYPAD_KEYS[key]).encode()
+
+    final = CURSOR_KEYS.get(key)
+    if final is not None:
+        if modifier:
+            return f'{ESC}[1;{modifier}{final}'.encode()
+        return (ESC + ('O' if app_cursor else '[') + final).encode()
+
+    final = FUNCTION_KEYS.get(key)
+    if final is not None:
+        if modifier:
+            return f'{ESC}[1;{modifier}{final}'.encode()
+        return (ESC + 'O' + final).encode()
+
+    number = TILDE_KEYS.get(key)
+    if number is not None:
+        if modifier:
+            return f'{ESC}[{number};{modifier}~'.encode()
+        return f'{ESC}[{number}~'.encode()
+
+    alt = ESC if modifiers & mods.AltModifier else ''
+    sequence = SIMPLE_KEYS.get(key)
+    if sequence is not None:
+        if key == keys.Key_Backspace and modifiers & mods.ControlModifier:
+            sequence = '\x08'
+        return (alt + sequence).encode()
+
+    if modifiers & mods.ControlModifier and not text:
+        # qt does not always fill in the control character itself
+        if keys.Key_A <= key <= keys.Key_Z:
+            text = chr(key - keys.Key_A + 1)
+        elif key in (keys.Key_Space, keys.Key_At):
+            text = '\x00'
+        elif keys.Key_BracketLeft <= key <= keys.Key_Underscore:
+            text = chr(key - keys.Key_BracketLeft + 0x1b)
+
+    if not text:
+        return None
+    return (alt + text).encode()
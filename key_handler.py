@@ -2,14 +2,24 @@ import sys, os, io, select
 import subprocess, signal
 import shlex
 import re
+import time
 
 from PySide6.QtCore import Qt, QSize, QEvent, QObject, Slot
 from PySide6.QtGui import QTextCursor, QFont, QColor, QScreen, QKeyEvent
+from PySide6.QtWidgets import QApplication
+
+from main_window import MAX_CMD_PASTE
+from key_encoder import encode_key
+from history import START
 
 
 keys = Qt.Key
 mods = Qt.KeyboardModifier
 
+# set DTERM_KEY_LATENCY=1 to have the time from a key press to its write to the pty printed every LATENCY_REPORT keys
+KEY_LATENCY = bool(os.environ.get('DTERM_KEY_LATENCY'))
+LATENCY_REPORT = 100
+
 
 class KeyHandler(QObject):
 
@@ -17,9 +27,44 @@ class KeyHandler(QObject):
         super().__init__()
         self.win = None
         self.shell = None
+        # nanoseconds, see KEY_LATENCY
+        self.latencies = []
+
+    # raw mode - while a full screen program is running, or a program is reading keys one at a time, every key press goes
+    # straight to it, the way a terminal would send it
+    def raw_mode(self):
+        return self.win.screen.alternate or self.shell.child_is_raw()
+
+
+    # returns False for keys that dterm keeps for itself even in raw mode - [CTRL] + [SHIFT] shortcuts
+    def send_raw_key(self, event, start):
+        modifiers = event.modifiers()
+        if modifiers & mods.ControlModifier and modifiers & mods.ShiftModifier:
+            return False
+        screen = self.win.screen
+        data = encode_key(event.key(), modifiers, event.text(), screen.app_cursor_keys, screen.app_keypad)
+        if data:
+            self.shell.write_key(data)
+            if KEY_LATENCY:
+                self.record_latency(time.perf_counter_ns() - start)
+        return True
+
+
+    def record_latency(self, latency):
+        latencies = self.latencies
+        latencies.append(latency)
+        if len(latencies) >= LATENCY_REPORT:
+            latencies.sort()
+            print(f'key latency over {len(latencies)} keys:  median {latencies[len(latencies) // 2] / 1000:.0f} us'
+                  f'  p99 {latencies[len(latencies) * 99 // 100] / 1000:.0f} us  max {latencies[-1] / 1000:.0f} us', file=sys.stderr)
+            latencies.clear()
+
 
     # handler for special keys pressed while the text area is in focus
     def text_edit_key_pressed(self, event):
+        start = time.perf_counter_ns()
+        if self.raw_mode() and self.send_raw_key(event, start):
+            return
         key = event.key()
         # print(f"KEY {key}")
         # text_cursor = self.text_area.textCursor()
@@ -28,6 +73,18 @@ class KeyHandler(QObject):
         if key == keys.Key_Down and event.modifiers() == (mods.ShiftModifier | mods.ControlModifier):
             self.win.cmd_area.setFocus()
 
+        # [CTRL] + [F]  search the output
+        elif key == keys.Key_F and event.modifiers() == mods.ControlModifier:
+            self.win.open_search()
+
+        # [CTRL] + [SHIFT] + [E]  open a command's elided output in its own window
+        elif key == keys.Key_E and event.modifiers() == (mods.ShiftModifier | mods.ControlModifier):
+            self.win.expand_output()
+
+        # [CTRL] + [SHIFT] + [S]  save a command's elided output to a file
+        elif key == keys.Key_S and event.modifiers() == (mods.ShiftModifier | mods.ControlModifier):
+            self.win.save_output()
+
         # If a non-special key is pressed, use default functionality of QTextEdit.keyPressEvent()
         else:
             self.win.text_area_keyPressEvent(event)
@@ -35,28 +92,22 @@ class KeyHandler(QObject):
 
     # handler for special keys pressed while the command line is in focus
     def command_line_key_pressed(self, event):
+        start = time.perf_counter_ns()
+        raw = self.raw_mode()
+        if raw and self.send_raw_key(event, start):
+            return
         key = event.key()
         # print(f"KEY {key}    MOD {event.modifiers()}")
         cmd = self.win.cmd_area.toPlainText()
 
-        # tab completion works by hitting [TAB] twice - check here if we are expecting the second tab
-        if self.win.first_tab and key == keys.Key_Tab and not event.modifiers():
-            self.win.first_tab = False
-            self.win.second_tab = True
-            self.shell.second_tab(cmd)
-            return
-
-        self.win.first_tab = False
-        self.win.first_tab_first_line = True
-        self.win.second_tab = False
-        self.win.second_tab_first_line = True
+        # the candidates of the last completion are only shown until something else is typed
+        if key != keys.Key_Tab:
+            self.win.hide_completions()
 
         # [ENTER]  execute the written command
         if key in [keys.Key_Enter, keys.Key_Return] and not event.modifiers():
             if not cmd:
                 # hitting enter with a blank command inserts a newline in the output area
-                # TODO: should also reset the html style to the default
-                #self.win.text_area.appendHtml('')
                 self.shell.run_command('')
                 self.win.text_area.moveCursor(QTextCursor.End)
             else:
@@ -68,10 +119,9 @@ class KeyHandler(QObject):
 
                 # run the command
                 self.win.cmd_area.setPlainText('')
-                # add the cmd to history (avoiding back-to-back duplicates)
-                if not self.win.cmd_history or cmd != self.win.cmd_history[-1]:
-                    self.win.cmd_history.append(cmd)
-                self.win.history_idx = -1
+                # add the cmd to history (it is only kept once, as the most recent use)
+                self.win.history.add(cmd)
+                self.win.history_position = None
                 self.win.in_progress_cmd = ''
                 self.shell.run_command(cmd)
 
@@ -84,22 +134,43 @@ class KeyHandler(QObject):
         elif key in [keys.Key_Enter, keys.Key_Return] and event.modifiers() == (mods.ShiftModifier | mods.ControlModifier):
             self.win.cmd_area.setPlainText('')
             self.shell.run_command(cmd)
-            # add the cmd to history (avoiding back-to-back duplicates)
-            if not self.win.cmd_history or cmd != self.win.cmd_history[-1]:
-                self.win.cmd_history.append(cmd)
-            self.win.history_idx = -1
+            # add the cmd to history (it is only kept once, as the most recent use)
+            self.win.history.add(cmd)
+            self.win.history_position = None
             self.win.in_progress_cmd = ''
 
         # [TAB]  use bash-completion rules to autofill the command text box
+        # the candidates are listed above the command line if there is more than one
         elif key == keys.Key_Tab and not event.modifiers():
-            self.win.first_tab = True
-            self.shell.first_tab(cmd)
+            self.win.complete()
+
+        # [CTRL] + [SHIFT] + [V]  run the clipboard in the shell, without putting it in the command line first
+        # it is streamed to the shell a chunk at a time, so even a paste of many megabytes does not hold up the window
+        elif key == keys.Key_V and event.modifiers() == (mods.ShiftModifier | mods.ControlModifier):
+            text = QApplication.clipboard().text()
+            if raw:
+                # a program reading keys gets the clipboard as a paste, without a line being cleared or entered
+                self.shell.paste(text)
+            elif text:
+                self.shell.run_command(text)
+
+        # [CTRL] + [V]  paste into the command line, unless the clipboard is too big for it
+        elif key == keys.Key_V and event.modifiers() == mods.ControlModifier and len(QApplication.clipboard().text()) > MAX_CMD_PASTE:
+            self.win.statusBar().showMessage('the clipboard is too big to edit - [CTRL] + [SHIFT] + [V] runs it in the shell directly', 5000)
 
         # [CTRL] + [SHIFT] + [c]  send SIGINT  (what ctrl+c does on standard terminals)
         elif key == keys.Key_C and event.modifiers() == (mods.ShiftModifier | mods.ControlModifier):
             # self.bash.send_signal(signal.SIGINT)
             os.killpg(os.getpgid(self.shell.proc.pid), signal.SIGINT)
 
+        # [CTRL] + [F]  search the output
+        elif key == keys.Key_F and event.modifiers() == mods.ControlModifier:
+            self.win.open_search()
+
+        # [CTRL] + [R]  search the command history
+        elif key == keys.Key_R and event.modifiers() == mods.ControlModifier:
+            self.win.open_history_search()
+
         # [CTRL] + [SHIFT] + [UP]  move cursor to text edit area
         elif key == keys.Key_Up and event.modifiers() == (mods.ShiftModifier | mods.ControlModifier):
             self.win.text_area.setFocus()
@@ -131,37 +202,81 @@ class KeyHandler(QObject):
         self.win.cmd_area.ensureCursorVisible()
 
 
-    def cmd_history_up(self, cmd):
-        history = self.win.cmd_history
-        # if no historical command is selected, save the in-progress cmd and cycle to previous command
-        if self.win.history_idx == -1 and history:
-            self.win.in_progress_cmd = cmd
-            self.win.history_idx = len(history) - 1
-            self.win.cmd_area.setPlainText(history[self.win.history_idx])
-            self.win.cmd_area.moveCursor(QTextCursor.End)
+    # handler for special keys pressed while the search bar is in focus
+    def search_bar_key_pressed(self, event):
+        key = event.key()
 
-        # if we are already cycling through history, and not on the first item, scroll back one more item
-        elif self.win.history_idx > 0 and history:
-            self.win.history_idx -= 1
-            self.win.cmd_area.setPlainText(history[self.win.history_idx])
-            self.win.cmd_area.moveCursor(QTextCursor.End)
+        # [ENTER]  go to the next older match,  [SHIFT] + [ENTER]  go back to the next newer one
+        if key in [keys.Key_Enter, keys.Key_Return]:
+            # a pending search has to run first, otherwise this would step through the old results
+            if self.win.search_timer.isActive():
+                self.win.search_timer.stop()
+                self.win.run_search()
+            elif event.modifiers() == mods.ShiftModifier:
+                self.win.show_search_match(-1)
+            else:
+                self.win.show_search_match(1)
+
+        # [ESC]  close the search bar and clear the highlights
+        elif key == keys.Key_Escape:
+            self.win.close_search()
+
+        else:
+            self.win.search_bar_keyPressEvent(event)
+
+
+    # steps back through the commands that start with whatever had been typed before the first step
+    def cmd_history_up(self, cmd):
+        win = self.win
+        # if no historical command is selected, save the in-progress cmd and use it as the prefix
+        if win.history_position is None:
+            win.in_progress_cmd = cmd
+            entry = win.history.previous(cmd, START)
+        else:
+            entry = win.history.previous(win.in_progress_cmd, win.history_position)
+        # nothing older matches - stay on the oldest one
+        if entry is None:
+            return
+        command, win.history_position = entry
+        win.cmd_area.setPlainText(command)
+        win.cmd_area.moveCursor(QTextCursor.End)
 
 
     def cmd_history_down(self, cmd):
-        history = self.win.cmd_history
-        # if no historical command is selected,do nothing
-        if self.win.history_idx == -1:
+        win = self.win
+        # if no historical command is selected, do nothing
+        if win.history_position is None:
             return
         # otherwise cycle to the next most recent command
-        self.win.history_idx += 1
+        entry = win.history.next(win.in_progress_cmd, win.history_position)
         # if we cycled past the most recent command, instead load the saved in-progress command
-        if self.win.history_idx == len(history):
-            self.win.history_idx = -1
-            self.win.cmd_area.setPlainText(self.win.in_progress_cmd)
-            self.win.cmd_area.moveCursor(QTextCursor.EndOfBlock)
+        if entry is None:
+            win.history_position = None
+            win.cmd_area.setPlainText(win.in_progress_cmd)
+        else:
+            command, win.history_position = entry
+            win.cmd_area.setPlainText(command)
+        win.cmd_area.moveCursor(QTextCursor.EndOfBlock)
+
+
+    # handler for special keys pressed while the history search bar is in focus
+    def history_bar_key_pressed(self, event):
+        key = event.key()
+
+        # [ENTER]  take the command that was found,  [ESC]  go back to what was there before
+        if key in [keys.Key_Enter, keys.Key_Return]:
+            self.win.close_history_search(True)
+        elif key == keys.Key_Escape:
+            self.win.close_history_search(False)
+
+        # [CTRL] + [R] or [UP]  the next older match,  [DOWN]  the next newer one
+        elif (key == keys.Key_R and event.modifiers() == mods.ControlModifier) or (key == keys.Key_Up and not event.modifiers()):
+            self.win.show_history_match(1)
+        elif key == keys.Key_Down and not event.modifiers():
+            self.win.show_history_match(-1)
+
         else:
-            self.win.cmd_area.setPlainText(history[self.win.history_idx])
-            self.win.cmd_area.moveCursor(QTextCursor.EndOfBlock)
+            self.win.history_bar_keyPressEvent(event)
 
 
     # checks if quotes, parens, and brackets are closed
@@ -1,20 +1,38 @@
-import html
 import re
 import datetime
 import os, sys
 import subprocess
 
-from PySide6.QtCore import Qt, QSize, QEvent, QObject, Slot
+import threading
+
+from PySide6.QtCore import Qt, QSize, QEvent, QObject, QTimer, Signal, Slot
 from PySide6.QtGui import QTextCursor, QFont, QColor, QScreen, QKeyEvent
 from PySide6.QtWidgets import (QApplication, QMainWindow, QSizeGrip,
                                QWidget, QTextEdit, QPlainTextEdit, QPushButton, QLineEdit,
-                               QVBoxLayout, QHBoxLayout, QLabel)
+                               QVBoxLayout, QHBoxLayout, QLabel, QFileDialog)
 
 from ansi_to_html import HtmlStyle
 from ansi_parser import AnsiParser
+from screen import Screen
+from terminal_view import TerminalView
+from search import Searcher
+from output_limiter import OutputLimiter
+from output_viewer import OutputViewer
+from output_pipeline import OutputPipeline, InlineSink
+from history import History
+
+
+# how many tab completion candidates are listed at most
+MAX_CANDIDATES = 200
+
+# a bigger clipboard than this would freeze the command line, so it has to be sent straight to the shell instead
+MAX_CMD_PASTE = 262144  # 256 KiB
 
 
 class MainWindow(QMainWindow):
+    # a message for the status bar, from a background thread
+    status_message = Signal(str)
+
     def __init__(self, key_handler):
         super().__init__()
 
@@ -28,8 +46,9 @@ class MainWindow(QMainWindow):
         geo.moveCenter(center)
         self.move(geo.topLeft())
 
+        self.status_message.connect(lambda message: self.statusBar().showMessage(message, 5000))
+
         # TODO: consider implementing:
-        #self.statusBar()
         #self.setMinimumSize()
         #self.setMaximumSize()
 
@@ -38,19 +57,74 @@ class MainWindow(QMainWindow):
         self.font.setPointSize(12)
 
         ### Text editor area
-        self.text_area = QPlainTextEdit()
-        self.text_area.setFont(self.font)
+        # output is applied to a Screen, and the view only paints the part of it that is visible
+        self.screen = Screen()
+        self.text_area = TerminalView(self.screen, self.font)
+        self.text_area.resized.connect(self.screen.resize)
         self.stdout_html_style = HtmlStyle()
-        self.stdout_ansi_parser = AnsiParser(self.stdout_html_style)
-        self.stderr_html_style = HtmlStyle()
-        self.stderr_ansi_parser = AnsiParser(self.stderr_html_style)
+        self.stdout_ansi_parser = AnsiParser(self.stdout_html_style, self.screen)
+        # cuts each command's output short once it goes over budget, see OutputLimiter
+        self.output_limiter = OutputLimiter()
+        self.output_viewers = []
+        # limiter -> parser -> screen, run on the reader thread so the gui thread only paints, see OutputPipeline
+        self.output = OutputPipeline(self.screen, self.stdout_ansi_parser, self.output_limiter)
+        self.output_sink = InlineSink(self.show_output)
         #self.default_text_color = QColor(248, 248, 255)  # GhostWhite
         #self.text_area.setTextColor(self.default_text_color)  # TODO: PlainTextEdit does not have this setTextColor option
 
+        ### Search bar
+        # hidden until [CTRL] + [F] - the actual searching happens in the background, see Searcher
+        self.searcher = Searcher(self.screen)
+        self.searcher.found.connect(self.search_results_found)
+        self.searcher.finished.connect(self.search_results_found)
+        self.text_area.searcher = self.searcher
+
+        self.search_bar = QLineEdit()
+        self.search_bar.setFont(self.font)
+        self.search_bar.setPlaceholderText('search output (regex)')
+        self.search_bar.textChanged.connect(lambda text: self.search_timer.start())
+        self.search_bar_keyPressEvent = self.search_bar.keyPressEvent
+        self.search_bar.keyPressEvent = key_handler.search_bar_key_pressed
+        self.search_label = QLabel()
+        self.search_label.setFixedWidth(200)
+
+        # wait for a pause in typing before starting a new search
+        self.search_timer = QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.run_search)
+
+        self.search_layout = QHBoxLayout()
+        self.search_layout.setContentsMargins(0, 0, 0, 0)
+        self.search_layout.addWidget(self.search_bar)
+        self.search_layout.addWidget(self.search_label)
+        self.search_area = QWidget()
+        self.search_area.setLayout(self.search_layout)
+        self.search_area.hide()
+
         # TODO: making copies of existing keyPressEvent functions is probably a bad practice
         self.text_area_keyPressEvent = self.text_area.keyPressEvent  # this saves original functionality of keyPressEvent()
         self.text_area.keyPressEvent = key_handler.text_edit_key_pressed  # this overrides keyPressEvent() for special functionality
 
+        ### History search bar
+        # hidden until [CTRL] + [R] in the command line - the match is shown in the command line itself
+        self.history_bar = QLineEdit()
+        self.history_bar.setFont(self.font)
+        self.history_bar.setPlaceholderText('search history')
+        self.history_bar.textChanged.connect(self.run_history_search)
+        self.history_bar_keyPressEvent = self.history_bar.keyPressEvent
+        self.history_bar.keyPressEvent = key_handler.history_bar_key_pressed
+        self.history_label = QLabel()
+        self.history_label.setFixedWidth(200)
+
+        self.history_layout = QHBoxLayout()
+        self.history_layout.setContentsMargins(0, 0, 0, 0)
+        self.history_layout.addWidget(self.history_bar)
+        self.history_layout.addWidget(self.history_label)
+        self.history_area = QWidget()
+        self.history_area.setLayout(self.history_layout)
+        self.history_area.hide()
+
         ### Command line area
         self.cmd_area = QPlainTextEdit()
         self.cmd_area.setFont(self.font)
@@ -67,6 +141,12 @@ class MainWindow(QMainWindow):
         self.ps1_area.setFixedHeight(30)
         self.ps1_area.setPlainText(os.environ.get('PS1'))
 
+        # the candidates of a tab completion that could not be narrowed down to one, hidden until then
+        self.completion_label = QLabel()
+        self.completion_label.setFont(self.font)
+        self.completion_label.setWordWrap(True)
+        self.completion_label.hide()
+
         ### Run button
         self.run_button = QPushButton('Run')
         self.run_button.setFixedWidth(100)
@@ -79,7 +159,10 @@ class MainWindow(QMainWindow):
 
         self.window_layout = QVBoxLayout()
         self.window_layout.addWidget(self.text_area)
+        self.window_layout.addWidget(self.search_area)
         #self.window_layout.addWidget(self.ps1_area)
+        self.window_layout.addWidget(self.completion_label)
+        self.window_layout.addWidget(self.history_area)
         self.window_layout.addLayout(self.cmd_layout)
 
         self.window_layout.setContentsMargins(10, 10, 10, 10)
@@ -92,102 +175,228 @@ class MainWindow(QMainWindow):
         self.cmd_area.setFocus()
 
         ### Backend functionality
-        self.cmd_history = []
-        self.history_idx = -1
+        # every command ever run, kept on disk and shared with other windows, see History
+        self.history = History()
+        self.history.start_import()
+        # the (last_used, id) of the command being shown while stepping through history, or None
+        self.history_position = None
         self.in_progress_cmd = ''
+        # the results of a history search, and which one is in the command line
+        self.history_matches = []
+        self.history_match = -1
+
+        # tab completion, see Completer
+        self.completer = None
+
+
+    # single-thread mode - the output is applied to the screen right here on the gui thread
+    @Slot(bytes)
+    def append_stdout_to_text_area(self, data):
+        self.output.process(data, self.output_sink)
+
+
+    # a frame from OutputPipeline - the screen has already been written to, so only the changed lines need repainting
+    def show_output(self, damage):
+        current = self.output_limiter.current
+        if current:
+            self.statusBar().showMessage(f'output #{current.number} is over budget - {current.lines} lines not shown so far')
+        elif self.statusBar().currentMessage().startswith('output #'):
+            self.statusBar().clearMessage()
+
+        self.text_area.refresh(damage)
+
+
+    ### tab completion
+
+    def set_completer(self, completer):
+        self.completer = completer
+        completer.completed.connect(self.completion_found)
+
+
+    # completes the word in front of the cursor - the answer comes back to completion_found()
+    def complete(self):
+        if self.completer is None:
+            return
+        cursor = self.cmd_area.textCursor()
+        line = self.cmd_area.toPlainText()[:cursor.position()]
+        self.completer.request(line)
+
+
+    def completion_found(self, generation, completion):
+        if generation != self.completer.generation:
+            return
+        cursor = self.cmd_area.textCursor()
+        # the command line changed while the completion was being worked out
+        if self.cmd_area.toPlainText()[:cursor.position()] != completion.line:
+            return
+
+        text = completion.insertion()
+        if text:
+            self.cmd_area.insertPlainText(text)
+            self.cmd_area.ensureCursorVisible()
+            self.hide_completions()
+        elif len(completion.candidates) > 1:
+            self.show_completions(completion.candidates)
+
+
+    def show_completions(self, candidates):
+        shown = '   '.join(os.path.basename(candidate.rstrip('/')) or candidate for candidate in candidates[:MAX_CANDIDATES])
+        if len(candidates) > MAX_CANDIDATES:
+            shown += f'   ... and {len(candidates) - MAX_CANDIDATES} more'
+        self.completion_label.setText(shown)
+        self.completion_label.show()
+
+
+    def hide_completions(self):
+        self.completion_label.hide()
 
-        # flags to assist with parsing tab-completion output
-        self.first_tab = False
-        self.first_tab_first_line = True
-        self.second_tab = False
-        self.second_tab_first_line = True
 
+    # called from the io thread while a big paste is written to the shell
+    def paste_progress(self, sent, size):
+        if sent < size:
+            self.status_message.emit(f'pasting... {sent / 1048576:.1f} of {size / 1048576:.1f} MB')
+        else:
+            self.status_message.emit(f'pasted {size / 1048576:.1f} MB')
 
-    @Slot(str)
-    def append_stdout_to_text_area(self, text):
-        self.text_area.moveCursor(QTextCursor.End)
 
-        # parse text for any ansi color codes and convert them to html styles
-        self.stdout_ansi_parser.new(html.escape(text))
-        parsed = self.stdout_ansi_parser.parse_ansi()
+    ### history search
+
+    def open_history_search(self):
+        self.in_progress_cmd = self.cmd_area.toPlainText()
+        self.history_area.show()
+        self.history_bar.setFocus()
+        self.history_bar.selectAll()
+        self.run_history_search()
+
+
+    # keeps the command that was found, or puts back what was in the command line before
+    def close_history_search(self, accept):
+        if not accept:
+            self.cmd_area.setPlainText(self.in_progress_cmd)
+        self.history_position = None
+        self.history_area.hide()
+        self.cmd_area.setFocus()
+        self.cmd_area.moveCursor(QTextCursor.End)
+
+
+    # this is fast enough to run on every keystroke, see History.search()
+    def run_history_search(self):
+        self.history_matches = self.history.search(self.history_bar.text())
+        self.history_match = -1
+        self.show_history_match(1)
+
+
+    # moves to an older match with step 1, or a newer one with step -1
+    def show_history_match(self, step):
+        matches = self.history_matches
+        if matches:
+            self.history_match = min(max(self.history_match + step, 0), len(matches) - 1)
+            self.cmd_area.setPlainText(matches[self.history_match])
+            self.history_label.setText(f'{self.history_match + 1} of {len(matches)}')
+        else:
+            self.cmd_area.setPlainText(self.in_progress_cmd)
+            self.history_label.setText('no matches')
+
+
+    ### search
+
+    def open_search(self):
+        self.search_area.show()
+        self.search_bar.setFocus()
+        self.search_bar.selectAll()
+        # get a head start on indexing the scrollback while the pattern is being typed
+        self.searcher.build_index()
+
+
+    def close_search(self):
+        self.search_timer.stop()
+        self.searcher.search('')
+        self.search_area.hide()
+        self.text_area.viewport().update()
+        self.cmd_area.setFocus()
+
+
+    def run_search(self):
+        self.searcher.search(self.search_bar.text())
+        self.search_results_found()
+        self.text_area.viewport().update()
+
+
+    # jumps to the newest match as soon as there is one, and keeps the count up to date as more matches arrive
+    def search_results_found(self, *args):
+        searcher = self.searcher
+        if searcher.current == -1 and searcher.matches:
+            self.show_search_match(0)
+        self.update_search_label()
+        self.text_area.viewport().update()
+
+
+    # moves to an older match with step 1, or a newer one with step -1
+    def show_search_match(self, step):
+        match = self.searcher.step(step)
+        if match:
+            self.text_area.show_line(match[0])
+        self.update_search_label()
+
+
+    def update_search_label(self):
+        searcher = self.searcher
+        if searcher.error:
+            text = 'invalid pattern'
+        elif not searcher.matches:
+            text = 'no matches' if searcher.complete else 'searching...'
+        else:
+            text = f'{searcher.current + 1} of {len(searcher.matches)}' + ('' if searcher.complete else '+')
+        self.search_label.setText(text)
+
+
+    ### elided output
+
+    # the elided output in the current command, or else the most recent one
+    def current_elision(self):
+        elisions = self.output_limiter.elisions
+        if not elisions:
+            return None
+        with self.screen.lock:
+            output = self.screen.blocks.output_range(self.text_area.current_block())
+        if output and self.text_area.current_block_line is not None:
+            for elision in elisions:
+                if elision.line is not None and output[0] <= elision.line < output[1]:
+                    return elision
+        return elisions[-1]
+
+
+    def expand_output(self):
+        elision = self.current_elision()
+        if elision is None:
+            return
+        viewer = OutputViewer(elision, self.font)
+        viewer.destroyed.connect(lambda: self.output_viewers.remove(viewer))
+        viewer.setAttribute(Qt.WA_DeleteOnClose)
+        self.output_viewers.append(viewer)
+        viewer.show()
+
 
-        # when expecting results from tab-completion, handle them differently than regular text
-        if self.first_tab:
-            self.handle_first_tab_completion(parsed)
+    def save_output(self):
+        elision = self.current_elision()
+        if elision is None:
             return
-        elif self.second_tab:
-            parsed = self.handle_second_tab_completion(parsed)
-
-        html_text = str(self.stdout_html_style) + parsed.replace('\x07', '')
-
-        # appendHtml() inserts a newline at the start of its output
-        # to delete that newline, we need to keep track of the current EOF position and return to it after appending
-        cursor = self.text_area.textCursor()
-        pos = cursor.position()
-        self.text_area.appendHtml(html_text)
-
-        # return to the beginning of the new html and delete the inserted newline
-        # TODO: this action is saved in the undo/redo history - see if it can be deleted from there
-        cursor.setPosition(pos)
-        self.text_area.setTextCursor(cursor)
-        self.text_area.textCursor().deleteChar()
-
-        self.text_area.moveCursor(QTextCursor.End)
-
-
-    # TODO: tab completion is a mess, even though current iteration (seemingly) works (on my machine)
-    # TODO: the biggest issue comes from the incomplete command being printed out twice - at both the start and end
-    # TODO: the second biggest issue is that the output is a stream and it does not always arrive all at once, and it is laced with escape characters
-    # TODO: should implement a more easy to understand solution that captures output and filters out these repeated commands and escape characters
-    # TODO: maybe can get this working:  # https://unix.stackexchange.com/questions/25935/how-to-output-string-completions-to-stdout/31023#31023
-    # if [TAB] is pressed once, auto-complete the current command as much as possible
-    def handle_first_tab_completion(self, parsed):
-
-        for text in parsed.split('\x07'):
-
-            # tab completion output comes in two parts:
-            # 1 - a repeat of the command, with some possible escape codes
-            # 2 - the viable auto-complete text (if available), with some possible escape codes
-            if self.first_tab_first_line:
-                text = text.replace('\r', '')
-
-                # once we see the repeated command, set flag to parse completion results next time
-                if text == self.cmd_area.toPlainText():
-                    self.first_tab_first_line = False
-
-                # if we see a line at this point that begins with our command, then the completed command is already appeneded
-                elif text.startswith(self.cmd_area.toPlainText()):
-                    text = text.replace(self.cmd_area.toPlainText(), '')
-                    self.cmd_area.textCursor().movePosition(QTextCursor.End)
-                    self.cmd_area.insertPlainText(text)
-                    self.first_tab = False
-                    self.first_tab_first_line = True
-                    return
-
-            else:
-                # after the repeated command is found and removed, any remaining text is a completion result
-                if text:
-                    # if we get completion results, append them to the current command
-                    self.cmd_area.textCursor().movePosition(QTextCursor.End)
-                    self.cmd_area.insertPlainText(text)
-                    self.first_tab = False
-                    self.first_tab_first_line = True
-                    return
-
-
-    def handle_second_tab_completion(self, text):
-        cmd = self.cmd_area.toPlainText()
-        text = text.replace('\x07', '').replace('\r', '')
-
-        # there is a repeat of the command at the start and end of the completion results that we want to remove
-        if self.second_tab_first_line:
-            if text.startswith(cmd):
-                text = text.replace(cmd, '', 1)
-                self.second_tab_first_line = False
-
-        if not self.second_tab_first_line and text.endswith(cmd):
-            # replace once from the right
-            text = ''.join(text.rsplit(cmd, 1))
-            self.second_tab = False
-            self.second_tab_first_line = True
-        return text
+        path, _ = QFileDialog.getSaveFileName(self, f'Save output #{elision.number}')
+        if path:
+            threading.Thread(target=self.write_output, args=(elision, path), daemon=True).start()
+
+
+    # runs on a background thread, since an elided output can be gigabytes
+    def write_output(self, elision, path):
+        try:
+            with open(path, 'wb') as f:
+                offset = 0
+                while offset < elision.size:
+                    data = elision.read(offset, 1048576)
+                    if not data:
+                        break
+                    f.write(data)
+                    offset += len(data)
+            self.status_message.emit(f'saved output #{elision.number} to {path}')
+        except (OSError, ValueError) as e:
+            self.status_message.emit(f'could not save output #{elision.number}: {e}')
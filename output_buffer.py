@@ -0,0 +1,100 @@
+import threading
+from collections import deque
+
+
+# default limits for how much unread output is held between the pty and the renderer
+HIGH_WATERMARK = 4 * 1048576  # 4 MiB
+LOW_WATERMARK = 1048576  # 1 MiB
+
+# the most the renderer gets from one get() - it drains the buffer a piece at a time, so the reader stays paused until it
+# is really down to the low watermark, instead of starting again as soon as the renderer takes anything
+MAX_TAKE = 1048576  # 1 MiB
+
+
+# a byte-counted buffer between the pty reader and the renderer
+# when it holds HIGH_WATERMARK bytes the reader should stop reading the pty, which makes the kernel block the child
+# once the renderer drains it back down to LOW_WATERMARK, on_drain() is called so the reader can start again
+class OutputBuffer:
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK, on_drain=None, max_take=MAX_TAKE):
+        if low_watermark > high_watermark:
+            raise ValueError('low_watermark must not be larger than high_watermark')
+
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.on_drain = on_drain
+        self.max_take = max_take
+
+        self.chunks = deque()
+        self.size = 0
+        self.paused = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+
+    # called by the reader - adds data and returns True if the reader should pause until on_drain() is called
+    def put(self, data):
+        with self.cond:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.size >= self.high_watermark:
+                self.paused = True
+            self.cond.notify()
+            return self.paused
+
+
+    # called by the renderer - blocks until there is data, then returns the oldest max_take bytes of it, or all of it
+    # returns an empty bytes object once the buffer is closed
+    def get(self):
+        with self.cond:
+            while not self.chunks and not self.closed:
+                self.cond.wait()
+            return self._take()
+
+
+    # same as get(), but returns an empty bytes object instead of waiting
+    def get_nowait(self):
+        with self.cond:
+            return self._take()
+
+
+    def _take(self):
+        if not self.chunks:
+            return b''
+
+        chunks = self.chunks
+        taken = []
+        length = 0
+        while chunks and length < self.max_take:
+            chunk = chunks.popleft()
+            # the rest of a big chunk stays at the front for next time
+            if length + len(chunk) > self.max_take:
+                split = self.max_take - length
+                chunks.appendleft(chunk[split:])
+                chunk = chunk[:split]
+            taken.append(chunk)
+            length += len(chunk)
+        data = b''.join(taken)
+        self.size -= length
+
+        # let the reader know that it can start reading again
+        if self.paused and self.size <= self.low_watermark:
+            self.paused = False
+            if self.on_drain:
+                self.on_drain()
+        return data
+
+
+    # how many more bytes can be read before hitting the high watermark
+    def free_space(self):
+        return max(self.high_watermark - self.size, 0)
+
+
+    def is_full(self):
+        return self.paused
+
+
+    # wakes up anyone waiting in get()
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
@@ -0,0 +1,224 @@
+import os
+import tempfile
+from collections import deque
+
+
+# each command gets this much output rendered before the rest is set aside
+BUDGET_BYTES = 8 * 1048576  # MiB
+BUDGET_LINES = 100000
+
+# how much of the end of an elided output is still shown once the command finishes
+TAIL_BYTES = 65536
+TAIL_LINES = 200
+
+# spill files are kept for the most recent elided outputs only
+MAX_ELISIONS = 16
+
+# the shell integration marks that start and end a command's output, see CommandBlocks
+OUTPUT_MARK = b'\x1b]133;C'
+FINISHED_MARK = b'\x1b]133;D'
+
+
+# the part of one command's output that was not rendered - every byte of it is in an unnamed temp file
+class Elision:
+    def __init__(self, number):
+        self.number = number
+        self.file = tempfile.TemporaryFile(prefix='dterm-output-')
+        self.size = 0
+        self.lines = 0
+        # the screen line of the note that replaced the output, set once it has been rendered
+        self.line = None
+
+    def write(self, data):
+        os.write(self.file.fileno(), data)
+        self.size += len(data)
+        self.lines += data.count(b'\n')
+
+    # reads from the spill file without moving a shared file position, so several readers can stream it at once
+    def read(self, offset, size):
+        return os.pread(self.file.fileno(), size, offset)
+
+    def close(self):
+        self.file.close()
+
+    def note(self):
+        if self.size >= 1048576:
+            size = f'{self.size / 1048576:.1f} MB'
+        else:
+            size = f'{self.size / 1024:.1f} KB'
+        return (f'\r\n\x1b[0;7m [ output #{self.number}: {self.lines} lines, {size} not shown'
+                f' - Ctrl+Shift+E to expand, Ctrl+Shift+S to save ] \x1b[0m\r\n').encode()
+
+
+# sits between the pty and the parser, and stops rendering a command's output once it goes over budget
+# from then on, output is only scanned for the end of the command and appended to a spill file, so the command keeps
+# running at full speed - nothing is parsed or drawn until it finishes, and then only a note and the last few lines are
+class OutputLimiter:
+    def __init__(self, budget_bytes=BUDGET_BYTES, budget_lines=BUDGET_LINES):
+        self.budget_bytes = budget_bytes
+        self.budget_lines = budget_lines
+
+        # set between the OUTPUT_MARK and FINISHED_MARK of a command
+        self.in_command = False
+        self.used_bytes = 0
+        self.used_lines = 0
+
+        # the elision in progress, and the end of it that will be shown
+        self.current = None
+        self.tail = deque()
+        self.tail_size = 0
+        # the end of the last chunk, which could be the start of a FINISHED_MARK that was split in two
+        self.partial = b''
+
+        self.elisions = []
+        self.count = 0
+
+
+    def eliding(self):
+        return self.current is not None
+
+
+    # returns [(data, elision)] - each piece of data should be parsed in order
+    # an elision comes with the piece that ends in its note, so the caller can find out which line that ended up on
+    def filter(self, data):
+        if self.current is not None:
+            return self.elide(data)
+
+        data = self.partial + data
+        self.partial = b''
+        pieces = []
+        while data:
+            if not self.in_command:
+                idx = data.find(OUTPUT_MARK)
+                if idx == -1:
+                    data = self.hold_partial(data, OUTPUT_MARK)
+                    if data:
+                        pieces.append((data, None))
+                    break
+                self.start_command()
+                idx += len(OUTPUT_MARK)
+                pieces.append((data[:idx], None))
+                data = data[idx:]
+                continue
+
+            end = data.find(FINISHED_MARK)
+            if end == -1:
+                data = self.hold_partial(data, FINISHED_MARK)
+            chunk = data if end == -1 else data[:end]
+            keep = self.take_budget(chunk)
+            if keep < len(chunk):
+                pieces.append((chunk[:keep], None))
+                self.current = self.new_elision()
+                # a held back partial mark comes after the rest of this chunk, not before it
+                rest = data[keep:] + self.partial
+                self.partial = b''
+                pieces.extend(self.elide(rest))
+                break
+
+            if chunk:
+                pieces.append((chunk, None))
+            if end == -1:
+                break
+            self.in_command = False
+            data = data[end:]
+
+        return pieces
+
+
+    def start_command(self):
+        self.in_command = True
+        self.reset_budget()
+
+
+    # full screen programs repaint over and over - none of that stays on screen, so it does not count
+    def reset_budget(self):
+        self.used_bytes = 0
+        self.used_lines = 0
+
+
+    # keeps back the end of a chunk if it could be the start of a mark that was split between two reads
+    # returns the rest, and the part that was kept back is put in front of the next chunk
+    def hold_partial(self, data, mark):
+        idx = data.find(b'\x1b', max(len(data) - len(mark) + 1, 0))
+        while idx != -1:
+            if mark.startswith(data[idx:]):
+                self.partial = data[idx:]
+                return data[:idx]
+            idx = data.find(b'\x1b', idx + 1)
+        return data
+
+
+    # how much of a chunk fits in what is left of the budget - once it runs out, the cut is made after a newline
+    def take_budget(self, chunk):
+        lines = chunk.count(b'\n')
+        if self.used_bytes + len(chunk) <= self.budget_bytes and self.used_lines + lines <= self.budget_lines:
+            self.used_bytes += len(chunk)
+            self.used_lines += lines
+            return len(chunk)
+
+        keep = max(min(len(chunk), self.budget_bytes - self.used_bytes), 0)
+        lines_left = self.budget_lines - self.used_lines
+        if chunk.count(b'\n', 0, keep) > lines_left:
+            # only the first few lines fit
+            idx = -1
+            for _ in range(lines_left):
+                idx = chunk.find(b'\n', idx + 1)
+            keep = idx + 1
+        else:
+            keep = chunk.rfind(b'\n', 0, keep) + 1
+
+        self.used_bytes += keep
+        self.used_lines += chunk.count(b'\n', 0, keep)
+        return keep
+
+
+    def new_elision(self):
+        self.count += 1
+        elision = Elision(self.count)
+        self.elisions.append(elision)
+        if len(self.elisions) > MAX_ELISIONS:
+            self.elisions.pop(0).close()
+        return elision
+
+
+    # output is only scanned for the end of the command here - nothing is handed on to be parsed until that shows up
+    def elide(self, data):
+        data = self.partial + data
+        self.partial = b''
+        end = data.find(FINISHED_MARK)
+        if end == -1:
+            self.spill(self.hold_partial(data, FINISHED_MARK))
+            return []
+
+        self.spill(data[:end])
+        elision = self.current
+        self.current = None
+        self.in_command = False
+        pieces = [(elision.note(), elision), (self.take_tail(), None)]
+        pieces.extend(self.filter(data[end:]))
+        return pieces
+
+
+    def spill(self, data):
+        if not data:
+            return
+        self.current.write(data)
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size - len(self.tail[0]) >= TAIL_BYTES:
+            self.tail_size -= len(self.tail.popleft())
+
+
+    # the last TAIL_LINES whole lines that were elided, starting with the style reset so they are not drawn in a
+    # style that was set somewhere in the middle
+    def take_tail(self):
+        tail = b''.join(self.tail)[-TAIL_BYTES:]
+        self.tail.clear()
+        self.tail_size = 0
+
+        start = len(tail)
+        for _ in range(TAIL_LINES + 1):
+            start = tail.rfind(b'\n', 0, start)
+            if start == -1:
+                break
+        return b'\x1b[0m' + tail[start + 1:]
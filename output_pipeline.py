@@ -0,0 +1,165 @@
+import time
+import threading
+import traceback
+
+
+# how many frames per second are handed to the gui thread
+FRAME_RATE = 60
+
+# output is applied to the screen in slices of this many bytes, and the screen lock is let go in between,
+# so the gui thread never waits long to paint
+SLICE_SIZE = 16384
+
+
+# once this much output is waiting, the reader stops pacing itself to the frame rate and hands batches over as fast as
+# the gui thread can take them - the screen is still updated with every byte, but the view only gets to repaint the
+# final state of each batch, at most once per refresh of the display  (jump scrolling)
+JUMP_THRESHOLD = 262144  # 256 KiB
+
+
+# everything that happens to pty output before it can be painted: the output limiter, the parser, and the screen
+# this runs on a worker thread (see QueueReader), or inline on the gui thread in single-thread mode
+# the gui thread only ever gets frames - the damage to repaint
+class OutputPipeline:
+    def __init__(self, screen, parser, limiter, frame_rate=FRAME_RATE):
+        self.screen = screen
+        self.parser = parser
+        self.limiter = limiter
+        self.frame_time = 1 / frame_rate
+        self.last_frame = 0.0
+        # set when the screen has changed since the last frame went out
+        self.dirty = False
+
+
+    # sink is anything with ready() and send(damage)
+    # a frame is sent at most once per frame time while a big batch is being worked through, and once at the end if
+    # the sink is ready for it - otherwise the damage keeps piling up in the screen until flush() is called again
+    def process(self, data, sink):
+        screen = self.screen
+        parser = self.parser
+        limiter = self.limiter
+        if screen.alternate:
+            limiter.reset_budget()
+        for piece, elision in limiter.filter(data):
+            for start in range(0, len(piece), SLICE_SIZE):
+                with screen.lock:
+                    parser.feed(piece[start:start + SLICE_SIZE])
+                self.dirty = True
+                if time.monotonic() - self.last_frame >= self.frame_time:
+                    self.flush(sink)
+
+            if elision:
+                with screen.lock:
+                    # the note about the elided output is on the line above the cursor
+                    elision.line = screen.scrollback.trimmed + screen.cursor_line() - 1
+
+        if screen.alternate:
+            limiter.reset_budget()
+        # nothing is parsed while output is being elided, but the count of lines not shown still has to reach the status bar
+        if limiter.eliding():
+            self.dirty = True
+        self.flush(sink)
+
+
+    # sends a frame if there is anything new and the sink is ready for it
+    def flush(self, sink):
+        if not self.dirty or not sink.ready():
+            return False
+        screen = self.screen
+        with screen.lock:
+            damage = screen.take_damage()
+            # the runs of changed lines are worked out here, so the gui thread only has to lay out their glyphs
+            if damage is None:
+                rows = range(screen.rows)
+            else:
+                rows = (idx - screen.offset() for idx in damage)
+            for row in rows:
+                if 0 <= row < screen.rows:
+                    screen.grid[row].runs()
+        self.dirty = False
+        self.last_frame = time.monotonic()
+        sink.send(damage)
+        return True
+
+
+# hands frames straight to a function, for when the pipeline runs on the gui thread itself
+class InlineSink:
+    def __init__(self, func):
+        self.func = func
+
+    def ready(self):
+        return True
+
+    def send(self, damage):
+        self.func(damage)
+
+
+# constantly reads a given output buffer, and runs it through an OutputPipeline on whatever thread calls run()
+# the gui thread is only sent frames - the damage to repaint - through send_frame, so it never parses anything itself
+# everything that arrives within one display frame is joined and processed as a single batch, and a batch that takes
+# longer than a frame to process sends a frame along the way, so a flood still shows up at FRAME_RATE
+# only one frame is handed over at a time - while the gui thread is busy painting, damage piles up in the screen and goes
+# out with the next frame, rather than frames piling up in qt's event queue
+# the gui thread sets delivered once it is done with a frame, see QueueReader
+class FrameBatcher:
+    def __init__(self, queue, pipeline, send_frame, frame_rate=FRAME_RATE):
+        self.queue = queue
+        self.pipeline = pipeline
+        self.send_frame = send_frame
+        self.frame_time = 1 / frame_rate
+        self.done = False
+        # called with a message when output could not be processed - see run()
+        self.on_error = None
+
+        # set once the gui thread has finished with the last frame
+        self.delivered = threading.Event()
+        self.delivered.set()
+
+    # the sink interface of OutputPipeline
+    def ready(self):
+        return self.delivered.is_set()
+
+    def send(self, damage):
+        self.delivered.clear()
+        self.send_frame(damage)
+
+    # wakes up run() and makes it return
+    def stop(self):
+        self.done = True
+        self.queue.close()
+
+    def run(self):
+        q = self.queue
+        pipeline = self.pipeline
+        frame_time = self.frame_time
+        last_batch = 0.0
+        while not self.done:
+            data = q.get()
+            if not data:
+                continue
+
+            # if the last batch came in less than a frame ago, wait out the rest of the frame and let more output pile up
+            # otherwise go right away, so a single echoed keystroke is not delayed
+            # when output is flooding in there is already plenty to process, so there is no reason to wait
+            wait = last_batch + frame_time - time.monotonic()
+            if wait > 0 and len(data) < JUMP_THRESHOLD:
+                time.sleep(wait)
+
+            # take everything that is currently buffered
+            data += q.get_nowait()
+            last_batch = time.monotonic()
+            # this is the only thread that drains the buffer - if it died, the screen would freeze and the shell would block
+            # once the buffer filled up, so a bug in handling one batch only costs that batch
+            try:
+                pipeline.process(data, self)
+
+                # the gui thread was still busy with the last frame, so the rest goes out once it is done
+                while pipeline.dirty and not self.done:
+                    self.delivered.wait(frame_time)
+                    pipeline.flush(self)
+            except Exception as error:
+                traceback.print_exc()
+                # whatever did change on screen before it went wrong goes out with the next frame
+                pipeline.dirty = True
+                if self.on_error:
+                    self.on_error(f'error while processing output: {error!r}')
@@ -0,0 +1,62 @@
+from PySide6.QtCore import QTimer
+from PySide6.QtWidgets import QMainWindow
+
+from ansi_to_html import HtmlStyle
+from ansi_parser import AnsiParser
+from screen import Screen
+from terminal_view import TerminalView
+
+
+# how much of the spill file is parsed per tick, so the window stays responsive while a huge output loads
+CHUNK_SIZE = 1048576  # MiB
+
+
+# a separate window showing the full output of a command that was cut short by OutputLimiter
+# it is streamed from the spill file a chunk at a time, into its own screen and scrollback
+class OutputViewer(QMainWindow):
+    def __init__(self, elision, font, parent=None):
+        super().__init__(parent)
+        self.elision = elision
+        self.offset = 0
+        self.setGeometry(0, 0, 1000, 800)
+
+        self.screen = Screen()
+        self.parser = AnsiParser(HtmlStyle(), self.screen)
+        self.text_area = TerminalView(self.screen, font)
+        self.text_area.resized.connect(self.screen.resize)
+        # start at the top, since this is being read from the start
+        self.text_area.follow = False
+        self.setCentralWidget(self.text_area)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.read_chunk)
+        self.timer.start(0)
+        self.update_title()
+
+
+    def read_chunk(self):
+        try:
+            data = self.elision.read(self.offset, CHUNK_SIZE)
+        except (OSError, ValueError):
+            # the spill file was closed because newer outputs took its place
+            data = b''
+        if not data:
+            self.timer.stop()
+        else:
+            self.offset += len(data)
+            self.parser.feed(data)
+            self.text_area.refresh(self.screen.take_damage())
+        self.update_title()
+
+
+    def update_title(self):
+        elision = self.elision
+        title = f'dterm - output #{elision.number}'
+        if self.timer.isActive() and elision.size:
+            title += f' (loading {self.offset * 100 // elision.size}%)'
+        self.setWindowTitle(title)
+
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        super().closeEvent(event)
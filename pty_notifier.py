@@ -0,0 +1,112 @@
+import os
+import time
+
+from PySide6.QtCore import QObject, QSocketNotifier, QTimer
+
+from shell_handler import MIN_READ_SIZE, MAX_READ_SIZE
+
+
+# single-threaded alternative to ShellHandler.thread_handle_io + QueueReader
+# the pty is read directly on the qt event loop through QSocketNotifier, so output never hops across queues or threads
+# output is still batched to at most one delivery per display frame, the same as QueueReader
+class PtyNotifier(QObject):
+    def __init__(self, shell, func, frame_rate):
+        super().__init__()
+        self.shell = shell
+        self.func = func
+        self.frame_time = 1 / frame_rate
+
+        # the pty is non-blocking (see ShellHandler), so a notification can be drained without ever stalling the gui
+        self.eof = False
+
+        self.pending = []
+        self.pending_size = 0
+        self.read_size = MIN_READ_SIZE
+        self.last_flush = 0.0
+
+        self.read_notifier = QSocketNotifier(shell.std_io, QSocketNotifier.Type.Read, self)
+        self.read_notifier.activated.connect(self.read_ready)
+
+        # like the io thread, only listen for "writable" while input is waiting
+        self.write_notifier = QSocketNotifier(shell.std_io, QSocketNotifier.Type.Write, self)
+        self.write_notifier.setEnabled(False)
+        self.write_notifier.activated.connect(self.write_ready)
+
+        # ShellHandler.wake() is called whenever a command is queued
+        self.wake_notifier = QSocketNotifier(shell.wake_read, QSocketNotifier.Type.Read, self)
+        self.wake_notifier.activated.connect(self.wake_ready)
+
+        # the shell's pidfd becomes readable when it exits - without one, SIGCHLD arrives through the wake pipe instead
+        self.exit_notifier = None
+        if shell.exit_fd is not None:
+            self.exit_notifier = QSocketNotifier(shell.exit_fd, QSocketNotifier.Type.Read, self)
+            self.exit_notifier.activated.connect(self.exit_ready)
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.timeout.connect(self.flush)
+
+
+    def read_ready(self):
+        shell = self.shell
+        high_watermark = shell.q_stdout.high_watermark
+
+        # read until the pty is empty, or until a full buffer's worth of output is waiting to be rendered
+        while self.pending_size < high_watermark:
+            data = shell.read_stdout(min(self.read_size, high_watermark - self.pending_size))
+            if data is None:
+                break
+            if not data:
+                # nobody is left on the other side of the pty - the exit notification will follow
+                self.eof = True
+                self.read_notifier.setEnabled(False)
+                self.flush()
+                return
+
+            self.pending.append(data)
+            self.pending_size += len(data)
+
+            if len(data) == self.read_size:
+                self.read_size = min(self.read_size * 2, MAX_READ_SIZE)
+            elif len(data) < self.read_size // 4:
+                self.read_size = max(self.read_size // 2, MIN_READ_SIZE)
+
+        # stop reading until the pending output is rendered - the kernel will hold back the shell in the meantime
+        if self.pending_size >= high_watermark:
+            self.read_notifier.setEnabled(False)
+
+        # send right away if the last batch is more than a frame old, otherwise wait for the rest of the frame
+        if not self.flush_timer.isActive():
+            wait = self.last_flush + self.frame_time - time.monotonic()
+            if wait > 0:
+                self.flush_timer.start(int(wait * 1000) + 1)
+            else:
+                self.flush()
+
+
+    def flush(self):
+        self.flush_timer.stop()
+        if self.pending:
+            data = b''.join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            self.last_flush = time.monotonic()
+            self.func(data)
+        self.read_notifier.setEnabled(not self.eof)
+
+
+    def write_ready(self):
+        self.shell.write_stdin()
+        self.write_notifier.setEnabled(self.shell.stdin_pending())
+
+
+    def wake_ready(self):
+        self.shell.drain_wakeups()
+        self.write_notifier.setEnabled(self.shell.stdin_pending())
+        if self.exit_notifier is None:
+            self.shell.check_exit()
+
+
+    def exit_ready(self):
+        self.exit_notifier.setEnabled(False)
+        self.shell.check_exit()
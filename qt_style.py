@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QColor, QFont, QTextCharFormat
+
+from ansi_to_html import style_colors, BOLD, ITALIC, UNDERLINE
+
+
+# turns the css colors used by ansi_to_html into QColors  ex:  'Crimson'  'rgb(1,2,3)'  'transparent'
+@lru_cache(maxsize=1024)
+def css_to_qcolor(css):
+    if css == 'transparent':
+        return QColor(Qt.transparent)
+    if css.startswith('rgb('):
+        return QColor(*(int(value) for value in css[4:-1].split(',')))
+    return QColor(css)
+
+
+# the QTextCharFormat for a style_id - built once per distinct style
+@lru_cache(maxsize=1024)
+def style_format(style_id):
+    text_color, background_color = style_colors(style_id)
+
+    text_format = QTextCharFormat()
+    text_format.setForeground(css_to_qcolor(text_color))
+    if background_color != 'transparent':
+        text_format.setBackground(css_to_qcolor(background_color))
+    text_format.setFontWeight(QFont.Bold if style_id & BOLD else QFont.Normal)
+    text_format.setFontItalic(bool(style_id & ITALIC))
+    text_format.setFontUnderline(bool(style_id & UNDERLINE))
+    return text_format
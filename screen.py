@@ -0,0 +1,545 @@
+import threading
+from itertools import groupby
+
+from ansi_to_html import DEFAULT_STYLE, BACKGROUND_SHIFT, COLOR_MASK
+from scrollback import ScrollbackStore
+from blocks import CommandBlocks
+
+
+TAB_WIDTH = 8
+
+# erased cells keep the current background color, but none of the other attributes
+ERASE_MASK = COLOR_MASK << BACKGROUND_SHIFT
+
+
+# one row of cells - each cell is a character and the style_id it was written with
+class Line:
+    __slots__ = ('chars', 'styles', 'version', 'runs_cache')
+
+    def __init__(self, cols, style_id=DEFAULT_STYLE):
+        self.chars = [' '] * cols
+        self.styles = [style_id] * cols
+        # bumped on every change, so that anything cached about this line knows when it is out of date
+        self.version = 0
+        self.runs_cache = None
+
+    def __len__(self):
+        return len(self.chars)
+
+    def text(self):
+        return ''.join(self.chars).rstrip()
+
+    # the line as (style_id, text) runs, the same format that AnsiParser used to produce
+    # blank default-styled cells at the end of the line are left out
+    def runs(self):
+        if self.runs_cache is None:
+            chars = self.chars
+            styles = self.styles
+            text = ''.join(chars)
+            end = len(text.rstrip(' '))
+            if styles.count(DEFAULT_STYLE) != len(styles) and styles[end:].count(DEFAULT_STYLE) != len(styles) - end:
+                # blanks with a background color are kept
+                last = len(styles)
+                while last > end and styles[last - 1] == DEFAULT_STYLE:
+                    last -= 1
+                end = last
+
+            first = styles[0] if end else DEFAULT_STYLE
+            if styles[:end].count(first) == end:
+                # most lines are a single style
+                runs = [(first, text[:end])] if end else []
+            else:
+                runs = []
+                start = 0
+                for style_id, group in groupby(styles[:end]):
+                    length = len(list(group))
+                    runs.append((style_id, text[start:start + length]))
+                    start += length
+            self.runs_cache = runs
+        return self.runs_cache
+
+    def write(self, col, text, style_id):
+        end = col + len(text)
+        self.chars[col:end] = text
+        self.styles[col:end] = [style_id] * len(text)
+        self.changed()
+
+    def erase(self, start, end, style_id):
+        end = min(end, len(self.chars))
+        if start < end:
+            self.chars[start:end] = [' '] * (end - start)
+            self.styles[start:end] = [style_id] * (end - start)
+            self.changed()
+
+    def insert(self, col, count, style_id):
+        cols = len(self.chars)
+        # anything pushed past the end is dropped anyway
+        count = max(min(count, cols - col), 0)
+        self.chars[col:col] = [' '] * count
+        self.styles[col:col] = [style_id] * count
+        del self.chars[cols:]
+        del self.styles[cols:]
+        self.changed()
+
+    def delete(self, col, count, style_id):
+        cols = len(self.chars)
+        del self.chars[col:col + count]
+        del self.styles[col:col + count]
+        self.chars.extend([' '] * (cols - len(self.chars)))
+        self.styles.extend([style_id] * (cols - len(self.styles)))
+        self.changed()
+
+    def resize(self, cols):
+        if cols < len(self.chars):
+            del self.chars[cols:]
+            del self.styles[cols:]
+        else:
+            self.chars.extend([' '] * (cols - len(self.chars)))
+            self.styles.extend([DEFAULT_STYLE] * (cols - len(self.styles)))
+        self.changed()
+
+    def changed(self):
+        self.version += 1
+        self.runs_cache = None
+
+
+# the terminal's screen - a rows x cols grid of cells with a cursor, plus the lines that have scrolled off the top of it
+# lines are numbered from the oldest line of scrollback, so the grid starts at line len(scrollback)
+class Screen:
+    def __init__(self, rows=24, cols=80, scrollback=None):
+        self.rows = rows
+        self.cols = cols
+        # output is applied on a worker thread while the gui thread paints, so anything that reads or changes the screen
+        # from outside of the parser has to hold this - see OutputPipeline
+        self.lock = threading.RLock()
+        # older lines are compressed and eventually dropped, see ScrollbackStore
+        self.scrollback = scrollback if scrollback is not None else ScrollbackStore()
+        # the commands that have been run, found through the shell's prompt marks
+        self.blocks = CommandBlocks()
+        self.grid = [Line(cols) for _ in range(rows)]
+
+        # the style that AnsiParser is currently writing with
+        self.style_id = DEFAULT_STYLE
+
+        self.cursor_row = 0
+        self.cursor_col = 0
+        self.cursor_visible = True
+        # set after writing to the last column - the cursor only moves to the next line once another character is written
+        self.wrap_pending = False
+        self.auto_wrap = True
+        self.saved_cursor = (0, 0, DEFAULT_STYLE)
+        # set while the program wants pasted text wrapped in markers, so it is not mistaken for typing - see ShellHandler
+        self.bracketed_paste = False
+        # how cursor keys and the keypad are sent while keys go straight to a program - see encode_key()
+        self.app_cursor_keys = False
+        self.app_keypad = False
+
+        # set while a program is drawing a frame that should be shown all at once - see TerminalView.refresh()
+        self.synchronized = False
+
+        # rows that take part in scrolling, inclusive
+        self.scroll_top = 0
+        self.scroll_bottom = rows - 1
+
+        # full-screen programs draw on a separate grid with no scrollback, and the main grid is put back when they exit
+        self.alternate = False
+        self.main_state = None
+
+        # line number -> [first col, last col + 1] of the cells that changed since the last take_damage()
+        self.damaged = {}
+        # set when every row of the screen has changed, which is what happens on every line of a flood of output
+        # per-cell damage is not tracked at all until the next take_damage()
+        self.damaged_all = False
+
+
+    # the line number of the top row of the grid - scrollback is hidden while the alternate screen is up
+    def offset(self):
+        return 0 if self.alternate else len(self.scrollback)
+
+
+    def line_count(self):
+        return self.offset() + self.rows
+
+
+    def line(self, idx):
+        offset = self.offset()
+        if idx < offset:
+            return self.scrollback[idx]
+        return self.grid[idx - offset]
+
+
+    # the line number of the cursor
+    def cursor_line(self):
+        return self.offset() + self.cursor_row
+
+
+    # returns {line number: [first col, last col + 1]} for every line that changed since the last call
+    # or None if the whole screen changed
+    def take_damage(self):
+        damaged = None if self.damaged_all else self.damaged
+        self.damaged = {}
+        self.damaged_all = False
+        return damaged
+
+
+    # marks the cells from start up to end on one row as changed
+    def damage(self, row, start, end):
+        if self.damaged_all:
+            return
+        idx = self.offset() + row
+        span = self.damaged.get(idx)
+        if span is None:
+            self.damaged[idx] = [start, end]
+        else:
+            if start < span[0]:
+                span[0] = start
+            if end > span[1]:
+                span[1] = end
+
+
+    def damage_rows(self, first, last):
+        if self.damaged_all:
+            return
+        if first == 0 and last == self.rows - 1:
+            self.damaged_all = True
+            self.damaged = {}
+            return
+        offset = self.offset()
+        cols = self.cols
+        damaged = self.damaged
+        for idx in range(offset + first, offset + last + 1):
+            damaged[idx] = [0, cols]
+
+
+    def erase_style(self):
+        return self.style_id & ERASE_MASK
+
+
+    ### text
+
+    def draw(self, text):
+        style_id = self.style_id
+        cols = self.cols
+        col = self.cursor_col
+        end = col + len(text)
+        # most text fits on the rest of the line, which can skip all of the wrapping below
+        if end < cols and not self.wrap_pending:
+            line = self.grid[self.cursor_row]
+            line.chars[col:end] = text
+            line.styles[col:end] = [style_id] * len(text)
+            line.version += 1
+            line.runs_cache = None
+            self.damage(self.cursor_row, col, end)
+            self.cursor_col = end
+            return
+
+        while text:
+            if self.wrap_pending:
+                self.wrap_pending = False
+                if self.auto_wrap:
+                    self.cursor_col = 0
+                    self.linefeed()
+
+            col = self.cursor_col
+            chunk = text[:cols - col]
+            text = text[len(chunk):]
+            if not self.auto_wrap:
+                # without wrapping, everything past the edge overwrites the last column
+                if text:
+                    chunk = chunk[:-1] + text[-1]
+                    text = ''
+
+            self.grid[self.cursor_row].write(col, chunk, style_id)
+            self.damage(self.cursor_row, col, col + len(chunk))
+
+            col += len(chunk)
+            if col >= cols:
+                self.cursor_col = cols - 1
+                self.wrap_pending = True
+            else:
+                self.cursor_col = col
+
+
+    ### control characters
+
+    def carriage_return(self):
+        self.cursor_col = 0
+        self.wrap_pending = False
+
+
+    def linefeed(self):
+        self.wrap_pending = False
+        if self.cursor_row == self.scroll_bottom:
+            self.scroll_up(1)
+        elif self.cursor_row < self.rows - 1:
+            self.cursor_row += 1
+
+
+    def reverse_index(self):
+        self.wrap_pending = False
+        if self.cursor_row == self.scroll_top:
+            self.scroll_down(1)
+        elif self.cursor_row > 0:
+            self.cursor_row -= 1
+
+
+    def backspace(self):
+        if self.wrap_pending:
+            self.wrap_pending = False
+        elif self.cursor_col > 0:
+            self.cursor_col -= 1
+
+
+    def tab(self):
+        self.cursor_col = min((self.cursor_col // TAB_WIDTH + 1) * TAB_WIDTH, self.cols - 1)
+
+
+    ### cursor movement - rows and columns here count from 0
+
+    def move_cursor(self, row, col):
+        self.cursor_row = min(max(row, 0), self.rows - 1)
+        self.cursor_col = min(max(col, 0), self.cols - 1)
+        self.wrap_pending = False
+
+
+    def cursor_up(self, count):
+        top = self.scroll_top if self.cursor_row >= self.scroll_top else 0
+        self.move_cursor(max(self.cursor_row - count, top), self.cursor_col)
+
+
+    def cursor_down(self, count):
+        bottom = self.scroll_bottom if self.cursor_row <= self.scroll_bottom else self.rows - 1
+        self.move_cursor(min(self.cursor_row + count, bottom), self.cursor_col)
+
+
+    def cursor_forward(self, count):
+        self.move_cursor(self.cursor_row, self.cursor_col + count)
+
+
+    def cursor_back(self, count):
+        self.move_cursor(self.cursor_row, self.cursor_col - count)
+
+
+    def save_cursor(self):
+        self.saved_cursor = (self.cursor_row, self.cursor_col, self.style_id)
+
+
+    def restore_cursor(self):
+        row, col, self.style_id = self.saved_cursor
+        self.move_cursor(row, col)
+
+
+    ### scrolling
+
+    def set_scroll_region(self, top, bottom):
+        if bottom is None or bottom >= self.rows:
+            bottom = self.rows - 1
+        if top < bottom:
+            self.scroll_top = top
+            self.scroll_bottom = bottom
+            self.move_cursor(0, 0)
+
+
+    def scroll_up(self, count, keep=True):
+        top = self.scroll_top
+        bottom = self.scroll_bottom
+        grid = self.grid
+        for _ in range(min(count, bottom - top + 1)):
+            line = grid.pop(top)
+            # lines that scroll off the very top of the main screen are kept as scrollback
+            if top == 0 and keep and not self.alternate:
+                self.scrollback.append(line)
+            grid.insert(bottom, Line(self.cols, self.erase_style()))
+        self.damage_rows(top, bottom)
+
+
+    def scroll_down(self, count):
+        top = self.scroll_top
+        bottom = self.scroll_bottom
+        grid = self.grid
+        for _ in range(min(count, bottom - top + 1)):
+            grid.pop(bottom)
+            grid.insert(top, Line(self.cols, self.erase_style()))
+        self.damage_rows(top, bottom)
+
+
+    # inserting and deleting lines only affects the scroll region below the cursor
+    def insert_lines(self, count):
+        if self.scroll_top <= self.cursor_row <= self.scroll_bottom:
+            top = self.scroll_top
+            self.scroll_top = self.cursor_row
+            self.scroll_down(count)
+            self.scroll_top = top
+            self.cursor_col = 0
+
+
+    def delete_lines(self, count):
+        if self.scroll_top <= self.cursor_row <= self.scroll_bottom:
+            top = self.scroll_top
+            self.scroll_top = self.cursor_row
+            # these lines are not scrolling off the top of the screen, so they do not become scrollback
+            self.scroll_up(count, keep=False)
+            self.scroll_top = top
+            self.cursor_col = 0
+
+
+    ### erasing
+
+    # 0 - cursor to end of line,  1 - start of line to cursor,  2 - whole line
+    def erase_in_line(self, mode):
+        line = self.grid[self.cursor_row]
+        if mode == 0:
+            start, end = self.cursor_col, self.cols
+        elif mode == 1:
+            start, end = 0, self.cursor_col + 1
+        elif mode == 2:
+            start, end = 0, self.cols
+        else:
+            return
+        line.erase(start, end, self.erase_style())
+        self.damage(self.cursor_row, start, end)
+
+
+    # 0 - cursor to end of screen,  1 - start of screen to cursor,  2 - whole screen,  3 - scrollback
+    def erase_in_display(self, mode):
+        style_id = self.erase_style()
+        if mode == 0:
+            self.erase_in_line(0)
+            rows = range(self.cursor_row + 1, self.rows)
+        elif mode == 1:
+            self.erase_in_line(1)
+            rows = range(0, self.cursor_row)
+        elif mode == 2:
+            rows = range(0, self.rows)
+        elif mode == 3:
+            if not self.alternate:
+                self.scrollback.clear()
+                self.damage_rows(0, self.rows - 1)
+            return
+        else:
+            return
+
+        for row in rows:
+            self.grid[row].erase(0, self.cols, style_id)
+        if rows:
+            self.damage_rows(rows[0], rows[-1])
+
+
+    # a count can never reach past the end of the line, however big the program asks for
+    def chars_left(self, count):
+        return max(min(count, self.cols - self.cursor_col), 0)
+
+
+    def erase_chars(self, count):
+        count = self.chars_left(count)
+        self.grid[self.cursor_row].erase(self.cursor_col, self.cursor_col + count, self.erase_style())
+        self.damage(self.cursor_row, self.cursor_col, self.cursor_col + count)
+
+
+    # inserting and deleting shifts everything to the right of the cursor
+    def insert_chars(self, count):
+        self.grid[self.cursor_row].insert(self.cursor_col, self.chars_left(count), self.erase_style())
+        self.damage(self.cursor_row, self.cursor_col, self.cols)
+
+
+    def delete_chars(self, count):
+        self.grid[self.cursor_row].delete(self.cursor_col, self.chars_left(count), self.erase_style())
+        self.damage(self.cursor_row, self.cursor_col, self.cols)
+
+
+    ### shell integration
+
+    # an OSC 133 mark at the cursor - full-screen programs have nothing to do with the shell's commands, so they are ignored there
+    def mark(self, kind, args):
+        if self.alternate:
+            return
+        trimmed = self.scrollback.trimmed
+        self.blocks.prune(trimmed)
+        self.blocks.mark(kind, args, trimmed + self.cursor_line(), self.cursor_col)
+
+
+    ### alternate screen
+
+    # switches to a blank alternate grid - the main grid, cursor and scroll region are kept exactly as they were
+    def enter_alternate(self):
+        if self.alternate:
+            return
+        self.main_state = (self.grid, self.cursor_row, self.cursor_col, self.style_id, self.saved_cursor,
+                           self.scroll_top, self.scroll_bottom, self.auto_wrap, self.rows, self.cols)
+        self.alternate = True
+        self.grid = [Line(self.cols) for _ in range(self.rows)]
+        self.scroll_top = 0
+        self.scroll_bottom = self.rows - 1
+        self.wrap_pending = False
+        self.damage_rows(0, self.rows - 1)
+
+
+    def exit_alternate(self):
+        if not self.alternate:
+            return
+        (grid, self.cursor_row, self.cursor_col, self.style_id, self.saved_cursor,
+         self.scroll_top, self.scroll_bottom, self.auto_wrap, rows, cols) = self.main_state
+        self.main_state = None
+        self.alternate = False
+        self.grid = grid
+        self.wrap_pending = False
+        # the screen may have been resized in the meantime - the old scroll region would reach past the bottom
+        if rows != self.rows or cols != self.cols:
+            self.fit_grid(self.rows, self.cols)
+            self.scroll_top = 0
+            self.scroll_bottom = self.rows - 1
+        self.move_cursor(self.cursor_row, self.cursor_col)
+        self.damage_rows(0, self.rows - 1)
+
+
+    def reset(self):
+        self.exit_alternate()
+        self.style_id = DEFAULT_STYLE
+        self.scroll_top = 0
+        self.scroll_bottom = self.rows - 1
+        self.auto_wrap = True
+        self.cursor_visible = True
+        self.synchronized = False
+        self.bracketed_paste = False
+        self.app_cursor_keys = False
+        self.app_keypad = False
+        self.erase_in_display(2)
+        self.move_cursor(0, 0)
+
+
+    ### size
+
+    def resize(self, rows, cols):
+        rows = max(rows, 1)
+        cols = max(cols, 1)
+        if rows == self.rows and cols == self.cols:
+            return
+
+        # the main grid is fitted once the alternate screen exits
+        self.fit_grid(rows, cols)
+        self.rows = rows
+        self.cols = cols
+
+        self.scroll_top = 0
+        self.scroll_bottom = rows - 1
+        self.move_cursor(self.cursor_row, self.cursor_col)
+        self.damage_rows(0, rows - 1)
+
+
+    def fit_grid(self, rows, cols):
+        grid = self.grid
+        # TODO: lines are cut off or padded rather than re-wrapped
+        for line in grid:
+            if len(line) != cols:
+                line.resize(cols)
+
+        # when the screen gets shorter, keep the cursor on screen by pushing lines from the top into scrollback
+        if rows < len(grid):
+            overflow = max(self.cursor_row - rows + 1, 0)
+            if not self.alternate:
+                self.scrollback.extend(grid[:overflow])
+            del grid[:overflow]
+            del grid[rows:]
+            self.cursor_row -= overflow
+        else:
+            grid.extend(Line(cols) for _ in range(rows - len(grid)))
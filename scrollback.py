@@ -0,0 +1,201 @@
+import os
+import zlib, marshal
+import tempfile
+from collections import OrderedDict, deque
+
+
+# lines are stored in pages - the newest pages stay as the Line objects that scrolled off the screen,
+# and older pages are packed into compressed blocks of (style_id, text) runs
+PAGE_SIZE = 256
+LIVE_PAGES = 8
+
+# compressed pages that have been unpacked again, because they were scrolled to or searched
+CACHED_PAGES = 16
+
+# the oldest pages are dropped once there are more lines than this, or the compressed blocks take up more bytes than this
+MAX_LINES = 1000000
+MAX_BYTES = 256 * 1048576  # MiB
+
+COMPRESSION_LEVEL = 1
+
+
+# the compressed bytes of a block, which are either the block itself or an (offset, length) in the spill file
+# a spill file that has since been replaced is closed, so reading from it raises ValueError
+def read_block(block, spill_file):
+    if spill_file is None:
+        return block
+    offset, length = block
+    return os.pread(spill_file.fileno(), length, offset)
+
+
+# the (style_id, text) runs of every line in a block
+def unpack_block(data):
+    return marshal.loads(zlib.decompress(data))
+
+
+# a line that has been unpacked from a compressed page - it is read-only, so its version never changes
+class FrozenLine:
+    __slots__ = ('runs_list',)
+
+    version = 0
+
+    def __init__(self, runs):
+        self.runs_list = runs
+
+    def runs(self):
+        return self.runs_list
+
+    def text(self):
+        return ''.join(text for style_id, text in self.runs_list).rstrip()
+
+
+# the lines that have scrolled off the top of the screen, oldest first
+# it can be indexed like a list, but only ever grows at the end and shrinks from the front
+class ScrollbackStore:
+    def __init__(self, max_lines=MAX_LINES, max_bytes=MAX_BYTES, spill=False):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+        # compressed pages, oldest first - either the compressed bytes or, once spilled, an (offset, length) in the spill file
+        self.blocks = deque()
+        self.block_bytes = 0
+
+        # the newest lines, which are still Line objects
+        self.live = []
+
+        # page number -> [FrozenLine] for recently unpacked pages
+        # page numbers count every page ever frozen, so they stay the same when old pages are dropped
+        self.cache = OrderedDict()
+
+        # how many lines have been dropped from the front - anything holding on to line numbers can use this to adjust them
+        self.trimmed = 0
+
+        # with spill set, compressed pages are written to an unnamed temp file instead of being kept in memory
+        self.spill_file = tempfile.TemporaryFile(prefix='dterm-scrollback-') if spill else None
+        self.spill_end = 0
+        self.spill_dead = 0
+
+
+    def __len__(self):
+        return len(self.blocks) * PAGE_SIZE + len(self.live)
+
+
+    def __getitem__(self, idx):
+        frozen = len(self.blocks) * PAGE_SIZE
+        if idx >= frozen:
+            return self.live[idx - frozen]
+        if idx < 0:
+            raise IndexError(idx)
+        return self.page(idx // PAGE_SIZE)[idx % PAGE_SIZE]
+
+
+    def append(self, line):
+        self.live.append(line)
+        if len(self.live) >= (LIVE_PAGES + 1) * PAGE_SIZE:
+            self.freeze_page()
+
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+
+    def clear(self):
+        # rounded up to a whole page, so that line numbers and page numbers keep lining up
+        self.trimmed += (len(self) + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+        self.blocks.clear()
+        self.block_bytes = 0
+        self.live = []
+        self.cache.clear()
+        if self.spill_file:
+            self.spill_file.truncate(0)
+            self.spill_end = 0
+            self.spill_dead = 0
+
+
+    ### pages
+
+    def page_count(self):
+        return len(self.blocks) + (len(self.live) + PAGE_SIZE - 1) // PAGE_SIZE
+
+
+    # the lines of one page, counting from the oldest page that is still kept
+    # compressed pages are only unpacked here, when something actually needs to look at them
+    def page(self, idx):
+        if idx >= len(self.blocks):
+            start = (idx - len(self.blocks)) * PAGE_SIZE
+            return self.live[start:start + PAGE_SIZE]
+
+        page_num = self.trimmed // PAGE_SIZE + idx
+        cache = self.cache
+        lines = cache.get(page_num)
+        if lines is None:
+            lines = [FrozenLine(runs) for runs in unpack_block(self.read_block(self.blocks[idx]))]
+            cache[page_num] = lines
+            if len(cache) > CACHED_PAGES:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(page_num)
+        return lines
+
+
+    # packs the oldest live page into a compressed block
+    def freeze_page(self):
+        page = self.live[:PAGE_SIZE]
+        del self.live[:PAGE_SIZE]
+        block = zlib.compress(marshal.dumps([line.runs() for line in page]), COMPRESSION_LEVEL)
+        self.block_bytes += len(block)
+        self.blocks.append(self.write_block(block))
+        self.trim()
+
+
+    # drops the oldest pages until the store is back under its limits
+    def trim(self):
+        while self.blocks and (len(self) > self.max_lines or self.block_bytes > self.max_bytes):
+            block = self.blocks.popleft()
+            size = block[1] if self.spill_file else len(block)
+            self.block_bytes -= size
+            self.spill_dead += size if self.spill_file else 0
+            self.cache.pop(self.trimmed // PAGE_SIZE, None)
+            self.trimmed += PAGE_SIZE
+
+        # dropped blocks leave a dead region at the start of the spill file - rewrite the file once that is most of it
+        if self.spill_file and self.spill_dead > self.block_bytes:
+            self.compact_spill_file()
+
+
+    ### spilling
+
+    def write_block(self, block):
+        if self.spill_file is None:
+            return block
+        os.pwrite(self.spill_file.fileno(), block, self.spill_end)
+        location = (self.spill_end, len(block))
+        self.spill_end += len(block)
+        return location
+
+
+    def read_block(self, block):
+        return read_block(block, self.spill_file)
+
+
+    # everything another thread needs to read the compressed pages on its own: (first page number, blocks, spill file)
+    # blocks never change once written, so the copy stays readable while new output keeps arriving
+    def snapshot(self):
+        return self.trimmed // PAGE_SIZE, list(self.blocks), self.spill_file
+
+
+    def compact_spill_file(self):
+        new_file = tempfile.TemporaryFile(prefix='dterm-scrollback-')
+        blocks = deque()
+        end = 0
+        for block in self.blocks:
+            data = self.read_block(block)
+            os.pwrite(new_file.fileno(), data, end)
+            blocks.append((end, len(data)))
+            end += len(data)
+        self.spill_file.close()
+        self.spill_file = new_file
+        self.blocks = blocks
+        self.spill_end = end
+        self.spill_dead = 0
@@ -0,0 +1,275 @@
+import re
+import zlib
+import threading
+
+from PySide6.QtCore import QObject, Signal
+
+from scrollback import PAGE_SIZE, read_block, unpack_block
+
+
+# every compressed page also gets a search index: just its plain text, compressed on its own
+# searching that skips unpacking the style runs, and a literal part of the pattern can rule out a whole page with one `in`
+def index_page(texts):
+    return zlib.compress('\n'.join(texts).encode(), 1)
+
+
+def read_index(data):
+    return zlib.decompress(data).decode()
+
+
+# the literal strings that every match of a regex has to contain
+# this only looks at plain characters outside of groups, and gives up on alternation - an empty list filters nothing
+def required_literals(pattern):
+    if '|' in pattern:
+        return []
+    # inline flags like (?i) change how everything else matches
+    if re.search(r'\(\?[aiLmsux]+\)', pattern):
+        return []
+
+    literals = []
+    current = ''
+    depth = 0
+    i = 0
+    length = len(pattern)
+    while i < length:
+        char = pattern[i]
+        if char == '\\' and i + 1 < length:
+            escaped = pattern[i + 1]
+            # \x41 \u0041 \101 \1 and \N{...} stand for characters (or a group) that are not spelled out - stop here
+            if escaped in 'xuUN0123456789':
+                break
+            # \d \w \b and the like are classes or anchors, not characters
+            if escaped.isalnum():
+                literals.append(current)
+                current = ''
+            elif depth == 0:
+                current += escaped
+            i += 2
+            continue
+
+        if char == '[':
+            # skip the whole character class
+            i += 2 if pattern.startswith('[]', i) or pattern.startswith('[^]', i) else 1
+            while i < length and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            literals.append(current)
+            current = ''
+        elif char == '(':
+            depth += 1
+            literals.append(current)
+            current = ''
+        elif char == ')':
+            depth = max(depth - 1, 0)
+        elif char in '?*{':
+            # the character before an optional quantifier might not be there at all
+            literals.append(current[:-1])
+            current = ''
+            if char == '{':
+                end = pattern.find('}', i)
+                i = end if end != -1 else i
+        elif char in '+.^$':
+            literals.append(current)
+            current = ''
+        elif depth == 0:
+            current += char
+        i += 1
+    literals.append(current)
+
+    return [literal for literal in literals if literal]
+
+
+# searches the screen and its scrollback for a regex
+# lines that are still live are searched right away, and compressed pages are searched newest first on a background thread
+# matches are kept as (line, start col, end col), where line counts every line ever written, so dropping old scrollback does not move them
+class Searcher(QObject):
+    # (generation, [(line, start, end)]) - generation is bumped by every new search, so late results from an old one can be dropped
+    found = Signal(int, object)
+    finished = Signal(int)
+
+    def __init__(self, screen):
+        super().__init__()
+        self.screen = screen
+        self.generation = 0
+        self.regex = None
+        self.error = ''
+        self.complete = True
+
+        # newest first
+        self.matches = []
+        # line -> [(start, end)] for highlighting
+        self.match_spans = {}
+        self.current = -1
+
+        # page number -> index_page(), built the first time a page is read
+        # jobs add to it from their own threads, so it is only touched while holding index_lock
+        self.index = {}
+        self.index_lock = threading.Lock()
+
+        self.found.connect(self.add_matches)
+        self.finished.connect(self.search_finished)
+
+
+    # the line number the view uses for an absolute line, or the other way around
+    def line_offset(self):
+        screen = self.screen
+        return 0 if screen.alternate else screen.scrollback.trimmed
+
+
+    def search(self, pattern):
+        self.generation += 1
+        self.matches = []
+        self.match_spans = {}
+        self.current = -1
+        self.error = ''
+        self.regex = None
+        self.complete = True
+        if not pattern:
+            return
+
+        # smart case - only case sensitive when the pattern has uppercase letters
+        flags = re.MULTILINE if pattern != pattern.lower() else re.MULTILINE | re.IGNORECASE
+        try:
+            self.regex = re.compile(pattern, flags)
+        except re.error as e:
+            self.error = str(e)
+            return
+
+        # the lines that are not compressed yet are few enough to search here, and they hold the newest output
+        screen = self.screen
+        with screen.lock:
+            offset = self.line_offset()
+            first = 0 if screen.alternate else len(screen.scrollback.blocks) * PAGE_SIZE
+            text = '\n'.join(screen.line(idx).text() for idx in range(first, screen.line_count()))
+            matches = text_matches(self.regex, text, offset + first)
+            matches.reverse()
+            self.add_matches(self.generation, matches)
+
+            if not screen.alternate:
+                literals = required_literals(pattern)
+                if flags & re.IGNORECASE:
+                    literals = [literal.lower() for literal in literals]
+                self.start_job(self.regex, literals)
+
+
+    # builds the index for every page in the background, without searching for anything
+    def build_index(self):
+        if self.complete:
+            self.start_job(None, [])
+
+
+    def start_job(self, regex, literals):
+        self.complete = False
+        with self.screen.lock:
+            self.prune_index()
+            first_page, blocks, spill_file = self.screen.scrollback.snapshot()
+        pages = list(enumerate(blocks, first_page))
+        pages.reverse()
+        thread = threading.Thread(target=self.run_job, args=(self.generation, regex, literals, pages, spill_file), daemon=True)
+        thread.start()
+
+
+    # runs on a background thread
+    def run_job(self, generation, regex, literals, pages, spill_file):
+        index = self.index
+        index_lock = self.index_lock
+        ignore_case = regex is not None and regex.flags & re.IGNORECASE
+        for page_num, block in pages:
+            if self.generation != generation:
+                return
+
+            with index_lock:
+                indexed = index.get(page_num)
+            if indexed is None:
+                try:
+                    runs_list = unpack_block(read_block(block, spill_file))
+                except (OSError, ValueError, zlib.error):
+                    # the page was dropped from the scrollback while this was running
+                    break
+                texts = [''.join(text for style_id, text in runs) for runs in runs_list]
+                indexed = index_page(texts)
+                with index_lock:
+                    index[page_num] = indexed
+                text = '\n'.join(texts)
+            elif regex is None:
+                continue
+            else:
+                text = read_index(indexed)
+
+            if regex is None:
+                continue
+
+            lowered = text.lower() if ignore_case else text
+            if not all(literal in lowered for literal in literals):
+                continue
+
+            matches = text_matches(regex, text, page_num * PAGE_SIZE)
+            if matches:
+                matches.reverse()
+                self.found.emit(generation, matches)
+
+        self.finished.emit(generation)
+
+
+    # forgets the index of pages that have been dropped from the scrollback
+    def prune_index(self):
+        first_page = self.screen.scrollback.trimmed // PAGE_SIZE
+        with self.index_lock:
+            for page_num in [page_num for page_num in self.index if page_num < first_page]:
+                del self.index[page_num]
+
+
+    def add_matches(self, generation, matches):
+        if generation != self.generation:
+            return
+        self.matches.extend(matches)
+        spans = self.match_spans
+        for line, start, end in matches:
+            spans.setdefault(line, []).append((start, end))
+
+
+    def search_finished(self, generation):
+        if generation == self.generation:
+            self.complete = True
+
+
+    # the (start, end) of every match on a line, as the view numbers it
+    def spans_on(self, idx):
+        return self.match_spans.get(idx + self.line_offset())
+
+
+    # the current match as (line, start, end), as the view numbers lines, or None
+    def current_match(self):
+        if not 0 <= self.current < len(self.matches):
+            return None
+        line, start, end = self.matches[self.current]
+        return line - self.line_offset(), start, end
+
+
+    # moves to the next older match, or back towards newer ones with a negative step
+    def step(self, step):
+        if not self.matches:
+            return None
+        self.current = min(max(self.current + step, 0), len(self.matches) - 1)
+        return self.current_match()
+
+
+# (line, start, end) for every match in some consecutive lines of text, oldest first
+# the lines are searched as one block of text, which is much faster than one regex call per line
+def text_matches(regex, text, first_line):
+    matches = []
+    line = 0
+    line_start = 0
+    for match in regex.finditer(text):
+        start = match.start()
+        if start == match.end():
+            continue
+        # count the newlines between the last match and this one
+        newlines = text.count('\n', line_start, start)
+        if newlines:
+            line += newlines
+            line_start = text.rfind('\n', 0, start) + 1
+        # a match that runs across lines is only highlighted up to the end of the first one
+        line_end = text.find('\n', start)
+        end = match.end() if line_end == -1 else min(match.end(), line_end)
+        matches.append((first_line + line, start - line_start, end - line_start))
+    return matches
@@ -1,67 +1,398 @@
 import pty
-import sys, os, io, select
+import sys, os, io, select, selectors
 import subprocess, signal
 import queue
+import shlex
+import tempfile
+import time
+import threading
+import fcntl, termios, struct
+
+from output_buffer import OutputBuffer, HIGH_WATERMARK, LOW_WATERMARK
+
+
+# the size of each pty read grows while reads keep coming back full, and shrinks again when output slows down
+MIN_READ_SIZE = 4096
+MAX_READ_SIZE = 1048576  # MiB
+
+# stdin is written at most this much at a time, and only a few times before going back to reading output - the shell
+# may have to print something (like an echo) before it reads any more input
+WRITE_SIZE = 65536
+WRITES_PER_WAKEUP = 16
+
+# pasted text is encoded this many characters at a time, so a huge paste is never copied as a whole
+PASTE_CHUNK = 65536
+# pastes at least this big report their progress, at most once per interval
+PROGRESS_SIZE = 1048576  # MiB
+PROGRESS_INTERVAL = 0.1
+
+# sent around pasted text once the shell has turned on bracketed paste mode (CSI ? 2004 h)
+BRACKETED_PASTE_START = b'\x1b[200~'
+BRACKETED_PASTE_END = b'\x1b[201~'
+
+INIT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dterm_init.bash')
+
+
+# runs in the child before the shell starts - makes the pty its controlling terminal, so the shell is told about resizes
+def take_controlling_terminal():
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+# text on its way to the shell's stdin, encoded a chunk at a time as the pty has room for it
+class Paste:
+    def __init__(self, text, bracketed, end=b''):
+        self.size = len(text)
+        # how many characters have been handed out so far
+        self.sent = 0
+        self.chunks = self.encode(text, bracketed, end)
+
+    def encode(self, text, bracketed, end):
+        if bracketed:
+            yield BRACKETED_PASTE_START
+        for start in range(0, len(text), PASTE_CHUNK):
+            piece = text[start:start + PASTE_CHUNK]
+            if bracketed:
+                # a pasted ESC could end the paste early, and have the rest run as if it were typed
+                piece = piece.replace('\x1b', '')
+            else:
+                # commands with tab characters will trigger tab-completion - add the "verbatim" character to actually print a tab
+                piece = piece.replace('\t', '\x16\t')
+            self.sent = min(start + PASTE_CHUNK, self.size)
+            yield piece.encode()
+        if bracketed:
+            yield BRACKETED_PASTE_END
+        yield end
 
 
 class ShellHandler:
-    def __init__(self):
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK):
         # could instead use separate ptys for stdin/stdout, but doing so seems to make the shell think there is no "controlling terminal"
         self.std_io, std_io_write = pty.openpty()
+        # nothing ever waits on the pty itself - a write that does not fit is finished once the pty is writable again
+        os.set_blocking(self.std_io, False)
 
+        # self-pipe used to wake the io thread when stdin is queued, stdout is drained, or the handler is stopped
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+
+        # bytes and Pastes, in order - written out by write_stdin()
         self.q_stdin = queue.Queue()
-        self.q_stdout = queue.Queue()
+        # what is left of the chunk being written, and the paste it came from
+        # stdin_lock is held while writing, so keys written straight from the gui thread never jump ahead of queued input
+        self.stdin_lock = threading.Lock()
+        self.stdin_data = None
+        self.current_paste = None
+        self.last_progress = 0.0
+        # called with (characters sent, characters in all) while a big paste is written - note that this is called from the io thread
+        self.on_paste_progress = None
+        # returns True while the shell has bracketed paste mode on - set to the screen's flag once there is one
+        self.bracketed_paste = lambda: False
+        # stdout is bounded - when the renderer falls behind, the io thread stops reading and the shell is blocked by the kernel
+        self.q_stdout = OutputBuffer(high_watermark, low_watermark, on_drain=self.wake)
+
+        self.selector = selectors.DefaultSelector()
 
         self.done = False
 
-        # this runs a custom config on startup in addition to .bashrc
-        #self.proc = subprocess.Popen(['/bin/bash --init-file <(echo "source ~/.bashrc ; source .dtermrc")'],
-        self.proc = subprocess.Popen(['/bin/bash -i'],
+        # the shell writes its PATH here whenever it changes, so tab completion can look in the same places, see Completer
+        path_fd, self.path_file = tempfile.mkstemp(prefix='dterm-path-')
+        os.close(path_fd)
+        self.path_mtime = None
+        self.path_value = os.environ.get('PATH', '')
+        # and its exported variables, aliases and function names, which the completion helpers load
+        env_fd, self.env_file = tempfile.mkstemp(prefix='dterm-env-')
+        os.close(env_fd)
+
+        # this runs a custom config on startup that sources .bashrc and then sets up the prompt marks, see dterm_init.bash
+        # exec replaces the intermediate sh, so proc.pid is the shell itself
+        self.proc = subprocess.Popen([f'exec /bin/bash --init-file {shlex.quote(INIT_FILE)} -i'],
                                                           shell=True,
                                                           start_new_session=True,
+                                                          preexec_fn=take_controlling_terminal,
                                                           stdin=std_io_write,
                                                           stdout=std_io_write,
-                                                          stderr=std_io_write)
+                                                          stderr=std_io_write,
+                                                          env=dict(os.environ, DTERM_PATH_FILE=self.path_file, DTERM_ENV_FILE=self.env_file))
+
+        # the shell has its own copy of the pty - closing ours means reads return EOF once the shell (and its children) exit
+        os.close(std_io_write)
+
+        # called with the shell's exit code once it exits - note that this is called from the io thread
+        self.on_exit = None
+        self.exit_code = None
+
+        # a pidfd becomes readable when the shell exits, so it can be waited on alongside the pty
+        try:
+            self.exit_fd = os.pidfd_open(self.proc.pid)
+        except (AttributeError, OSError):
+            # no pidfd support - instead have SIGCHLD write to the self-pipe, and check the shell whenever it wakes up
+            # python only runs signal handlers on the main thread, but the wakeup fd is written to as soon as the signal arrives
+            self.exit_fd = None
+            signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+            signal.set_wakeup_fd(self.wake_write)
 
     # writes a command to stdin, followed by a newline, which triggers the background process to run that command
+    # it is sent as a paste, so a shell with bracketed paste on takes newlines and tabs in it literally
     def run_command(self, cmd):
         # ctrl+u  to clear any in-progress commands  # TODO: this will overwrite any currently yanked strings
         self.q_stdin.put(b'\x15')
-        # commands with tab characters will trigger tab-completion - add the "verbatim" character to actually print a tab
-        self.q_stdin.put(str.encode(cmd.replace('\t', '\x16\t') + '\n'))
+        self.q_stdin.put(Paste(cmd, self.bracketed_paste(), b'\n'))
+        self.wake()
 
 
-    # writes an incomplete command to stdin, followed by a tab, which triggers tab completion in the shell
-    def first_tab(self, cmd):
-        # ctrl+u  to clear any in-progress commands  # TODO: this will overwrite any currently yanked strings
-        self.q_stdin.put(b'\x15')
-        self.q_stdin.put(str.encode(cmd + '\t'))
+    # sends text as if it were pasted into a terminal
+    def paste(self, text):
+        if text:
+            self.q_stdin.put(Paste(text, self.bracketed_paste()))
+            self.wake()
 
 
-    def second_tab(self, cmd):
-        # ctrl+u  to clear any in-progress commands  # TODO: this will overwrite any currently yanked strings
-        self.q_stdin.put(b'\x15')
-        self.q_stdin.put(str.encode(cmd + '\t\t'))  # yes, this has to be two MORE tab characters
+    # the shell's current directory, straight from the kernel - it is right even while a command is running
+    def cwd(self):
+        try:
+            return os.readlink(f'/proc/{self.proc.pid}/cwd')
+        except OSError:
+            return os.getcwd()
+
+
+    # the shell's PATH, as of its last prompt
+    def path(self):
+        try:
+            mtime = os.stat(self.path_file).st_mtime_ns
+            if mtime != self.path_mtime:
+                with open(self.path_file) as f:
+                    path = f.read()
+                if path:
+                    self.path_value = path
+                self.path_mtime = mtime
+        except OSError:
+            pass
+        return self.path_value
+
+
+    # changes whenever the shell writes a different environment to env_file, or None if it cannot be read
+    def env_mtime(self):
+        try:
+            return os.stat(self.env_file).st_mtime_ns
+        except OSError:
+            return None
+
+
+    # tells the shell (and whatever is running in it) how big the screen is - they are sent SIGWINCH
+    def resize(self, rows, cols):
+        fcntl.ioctl(self.std_io, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+
+    # reads whatever the shell has written so far
+    # returns None if there is nothing to read yet, or an empty bytes object once the shell has closed the pty
+    def read_stdout(self, size):
+        try:
+            return os.read(self.std_io, size)
+        except BlockingIOError:
+            return None
+        except OSError:
+            # linux reports EIO on the pty once there is nobody left on the other side
+            return b''
+
+
+    # writes a key press straight to the pty, from the gui thread, without waking up the io thread
+    # it only has to wait its turn if other input is still going out - then it is queued behind it
+    def write_key(self, data):
+        with self.stdin_lock:
+            if not self.stdin_pending():
+                try:
+                    written = os.write(self.std_io, data)
+                except BlockingIOError:
+                    written = 0
+                if written == len(data):
+                    return
+                data = data[written:]
+            self.q_stdin.put(data)
+        self.wake()
+
+
+    # True while a program other than the shell is in the foreground and reading keys one at a time, like vim or less
+    # (the shell turns off canonical mode too, while readline is editing the prompt, but that is what the command line is for)
+    def child_is_raw(self):
+        try:
+            if os.tcgetpgrp(self.std_io) == self.proc.pid:
+                return False
+            return not termios.tcgetattr(self.std_io)[3] & termios.ICANON
+        except (OSError, termios.error):
+            return False
+
+
+    def stdin_pending(self):
+        return self.stdin_data is not None or self.current_paste is not None or self.q_stdin.qsize() > 0
+
+
+    # writes as much queued input as the pty will take right now, and never blocks
+    # a partial write leaves the rest in stdin_data, which goes out the next time the pty is writable
+    def write_stdin(self):
+        with self.stdin_lock:
+            self.write_pending()
+
+
+    def write_pending(self):
+        for _ in range(WRITES_PER_WAKEUP):
+            if self.stdin_data is None and not self.next_stdin():
+                return
+            data = self.stdin_data[:WRITE_SIZE]
+            try:
+                written = os.write(self.std_io, data)
+            except BlockingIOError:
+                # the pty's input buffer is full until the shell reads some of it
+                return
+            self.stdin_data = self.stdin_data[written:] if written < len(self.stdin_data) else None
+            if written < len(data):
+                return
+
+
+    # moves on to the next chunk of input, returns False if there is none
+    def next_stdin(self):
+        while True:
+            paste = self.current_paste
+            if paste is not None:
+                data = next(paste.chunks, None)
+                if data is None:
+                    self.current_paste = None
+                    if paste.size >= PROGRESS_SIZE and self.on_paste_progress:
+                        self.on_paste_progress(paste.size, paste.size)
+                    continue
+                if paste.size >= PROGRESS_SIZE and self.on_paste_progress and time.monotonic() - self.last_progress >= PROGRESS_INTERVAL:
+                    self.last_progress = time.monotonic()
+                    self.on_paste_progress(paste.sent, paste.size)
+                if data:
+                    self.stdin_data = memoryview(data)
+                    return True
+                continue
+
+            try:
+                item = self.q_stdin.get_nowait()
+            except queue.Empty:
+                return False
+            if isinstance(item, Paste):
+                self.current_paste = item
+            else:
+                self.stdin_data = memoryview(item)
+                return True
+
+
+    # interrupts the io thread's select() so it can notice new stdin or a stop request
+    def wake(self):
+        try:
+            os.write(self.wake_write, b'\x00')
+        except BlockingIOError:
+            # the pipe is full, so a wakeup is already pending
+            pass
+
+
+    # reaps the shell if it has exited, and reports its exit code to on_exit()
+    # returns the exit code, or None if the shell is still running
+    def check_exit(self):
+        if self.exit_code is None:
+            exit_code = self.proc.poll()
+            if exit_code is not None:
+                self.exit_code = exit_code
+                if self.exit_fd is not None:
+                    os.close(self.exit_fd)
+                    self.exit_fd = None
+                if self.on_exit:
+                    self.on_exit(exit_code)
+        return self.exit_code
+
+
+    # empties the self-pipe so it does not stay readable
+    def drain_wakeups(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def stop(self):
+        self.done = True
+        self.wake()
+        for path in (self.path_file, self.env_file):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 
     def thread_handle_io(self):
         # creating local variables here rather than calling self.obj over and over again (I wonder how many nanoseconds this saves?)
         std_io = self.std_io
+        wake_read = self.wake_read
+        selector = self.selector
 
-        q_stdin = self.q_stdin
         q_stdout = self.q_stdout
 
-        while not self.done:
-            # returns lists of files which are non-blocked and available for read or write
-            rlist, wlist, xlist = select.select([std_io], [std_io], [])
+        # the pty is almost always writable, so only ask to hear about it while there is something to write
+        # otherwise select() returns immediately on every loop and the thread spins even when the shell is idle
+        # likewise, stop asking to read while the stdout buffer is full so that the kernel applies backpressure to the shell
+        interest = 0
+        read_size = MIN_READ_SIZE
+        eof = False
 
-            # read from stdout/stderr
-            if rlist:
-                data = os.read(std_io, 1048576)  # MiB
-                if data:
-                    q_stdout.put(data)
+        # the shell may have exited before there was anything to notice it
+        self.check_exit()
+
+        selector.register(wake_read, selectors.EVENT_READ)
+        exit_fd = self.exit_fd
+        if exit_fd is not None:
+            selector.register(exit_fd, selectors.EVENT_READ)
+
+        while not self.done and self.exit_code is None:
+            wanted = 0
+            if not q_stdout.is_full() and not eof:
+                wanted |= selectors.EVENT_READ
+            if self.stdin_pending():
+                wanted |= selectors.EVENT_WRITE
+
+            if wanted != interest:
+                if not wanted:
+                    selector.unregister(std_io)
+                elif not interest:
+                    selector.register(std_io, wanted)
+                else:
+                    selector.modify(std_io, wanted)
+                interest = wanted
+
+            # blocks until stdout has data, stdin can accept a pending command, or someone calls wake()
+            for key, events in selector.select():
+                if key.fd == wake_read:
+                    self.drain_wakeups()
+                    # without a pidfd, SIGCHLD shows up as a wakeup
+                    if exit_fd is None:
+                        self.check_exit()
                     continue
 
-            # if stdin is available for writing, and there is a command in the queue, write that command
-            if q_stdin.qsize() and wlist:
-                os.write(std_io, q_stdin.get())
+                if key.fd == exit_fd:
+                    selector.unregister(exit_fd)
+                    self.check_exit()
+                    break
+
+                # read from stdout/stderr, never reading more than the buffer has room for
+                if events & selectors.EVENT_READ:
+                    data = self.read_stdout(min(read_size, q_stdout.free_space()))
+                    if data == b'':
+                        # nobody is left on the other side of the pty - stop reading and wait for the shell to be reaped
+                        eof = True
+                        continue
+                    if data:
+                        q_stdout.put(data)
+
+                        # a full read means there is probably more waiting, a small one means output has slowed down
+                        if len(data) == read_size:
+                            read_size = min(read_size * 2, MAX_READ_SIZE)
+                        elif len(data) < read_size // 4:
+                            read_size = max(read_size // 2, MIN_READ_SIZE)
+
+                # if stdin is available for writing, write as much of the pending input as it will take
+                if events & selectors.EVENT_WRITE:
+                    self.write_stdin()
+
+        selector.close()
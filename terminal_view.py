@@ -0,0 +1,571 @@
+import time
+from collections import OrderedDict
+
+from PySide6.QtCore import Qt, QRect, QTimer, Signal
+from PySide6.QtGui import QColor, QFont, QFontMetrics, QPainter, QStaticText, QTextCursor, QGuiApplication, QTransform
+from PySide6.QtWidgets import QAbstractScrollArea
+
+from ansi_to_html import BOLD, ITALIC, UNDERLINE, DEFAULT_STYLE
+from qt_style import style_format
+
+
+# how many lines worth of prepared glyphs are kept around
+GLYPH_CACHE_SIZE = 2048
+
+# how long a synchronized update (?2026h) can hold back repaints before whatever has been drawn so far is shown anyway
+SYNC_TIMEOUT = 150  # ms
+
+
+# a scrollable view of a Screen that only lays out and paints the lines that are actually visible
+# it replaces QPlainTextEdit, which lays out the entire document and gets slower the longer the output gets
+class TerminalView(QAbstractScrollArea):
+    # emitted with the number of (rows, cols) that fit in the view whenever it is resized
+    resized = Signal(int, int)
+
+    def __init__(self, screen, font):
+        super().__init__()
+        self.screen = screen
+        self.setFont(font)
+        self.setFocusPolicy(Qt.StrongFocus)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.viewport().setCursor(Qt.IBeamCursor)
+
+        metrics = QFontMetrics(font)
+        self.char_width = metrics.horizontalAdvance('M')
+        self.line_height = metrics.lineSpacing()
+
+        # one font per combination of bold/italic/underline
+        self.fonts = {}
+
+        # Line -> (line version, [(x, width, QStaticText, style_id)])
+        self.glyph_cache = OrderedDict()
+
+        # the (line, col) the cursor was last painted on, so it can be cleared when the cursor moves
+        self.cursor_cell = (0, 0)
+        self.line_count = 0
+        self.trimmed = 0
+
+        # repaints are held while the screen is in synchronized mode, but never for longer than SYNC_TIMEOUT
+        self.sync_timer = QTimer(self)
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(SYNC_TIMEOUT)
+        self.sync_timer.timeout.connect(self.present)
+
+        # the view is presented at most once per refresh of the display, however often refresh() is called
+        refresh_rate = QGuiApplication.primaryScreen().refreshRate() if QGuiApplication.primaryScreen() else 0
+        self.frame_time = 1 / (refresh_rate or 60)
+        self.last_present = 0.0
+        self.present_timer = QTimer(self)
+        self.present_timer.setSingleShot(True)
+        self.present_timer.timeout.connect(self.present)
+
+        # damage that has been handed to refresh() but not presented yet - None if everything needs repainting
+        self.damage = {}
+
+        # stay scrolled to the bottom as output arrives, unless the user has scrolled up
+        self.follow = True
+
+        # set to a Searcher to highlight its matches
+        self.searcher = None
+
+        # the command that Alt+F and Ctrl+Shift+O act on, as the line of its prompt - the newest finished command if None
+        self.current_block_line = None
+
+        # selection is a pair of (line, col) positions
+        self.selection_start = None
+        self.selection_end = None
+
+
+    def rows(self):
+        return max(self.viewport().height() // self.line_height, 1)
+
+
+    def cols(self):
+        return max(self.viewport().width() // self.char_width, 1)
+
+
+    # call with the damage taken from the screen after writing to it
+    # while a program is in the middle of a synchronized update, the damage keeps piling up
+    # and is presented all at once when the update ends, so a half-drawn frame is never shown
+    def refresh(self, damage):
+        self.add_damage(damage)
+        if self.screen.synchronized:
+            if not self.sync_timer.isActive():
+                self.sync_timer.start()
+            return
+        self.sync_timer.stop()
+
+        # when output is flooding in, everything written in between frames is skipped over and only the latest state is shown
+        wait = self.last_present + self.frame_time - time.monotonic()
+        if wait > 0:
+            if not self.present_timer.isActive():
+                self.present_timer.start(int(wait * 1000) + 1)
+            return
+        self.present()
+
+
+    # damage from several frames is merged until it is presented
+    def add_damage(self, damage):
+        if damage is None or self.damage is None:
+            self.damage = None
+            return
+        pending = self.damage
+        for idx, (start, end) in damage.items():
+            span = pending.get(idx)
+            if span is None:
+                pending[idx] = [start, end]
+            else:
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], end)
+
+
+    # repaints whatever cells changed and are visible
+    def present(self):
+        with self.screen.lock:
+            self.present_damage()
+
+
+    def present_damage(self):
+        self.present_timer.stop()
+        self.last_present = time.monotonic()
+        screen = self.screen
+        damaged = self.damage
+        self.damage = {}
+        scrollbar = self.verticalScrollBar()
+        old_first = scrollbar.value()
+        old_count = self.line_count
+        self.line_count = self.display_count()
+
+        # when the oldest scrollback is dropped, every line number shifts - keep a scrolled-up view on the same lines
+        trimmed = screen.scrollback.trimmed - self.trimmed
+        self.trimmed = screen.scrollback.trimmed
+        if trimmed and not self.follow:
+            scrollbar.setValue(max(old_first - trimmed, 0))
+            old_first = -1
+        self.update_scrollbar()
+
+        # scrolling, or switching to or from the alternate screen, moves every row
+        if damaged is None or scrollbar.value() != old_first or self.line_count < old_count:
+            self.viewport().update()
+            return
+
+        # the cursor cell it was painted on, and the one it is on now
+        old_cursor = self.cursor_cell
+        self.cursor_cell = (screen.cursor_line(), screen.cursor_col)
+        for idx, col in (old_cursor, self.cursor_cell):
+            span = damaged.get(idx)
+            if span is None:
+                damaged[idx] = [col, col + 1]
+            else:
+                span[0] = min(span[0], col)
+                span[1] = max(span[1], col + 1)
+
+        first = scrollbar.value()
+        last = first + self.rows()
+        char_width = self.char_width
+        line_height = self.line_height
+        viewport = self.viewport()
+        folding = self.folding()
+        for idx, (start, end) in damaged.items():
+            row = self.row_of_line(idx) if folding else idx
+            if row is not None and first <= row <= last:
+                viewport.update(QRect(start * char_width, (row - first) * line_height, (end - start) * char_width, line_height))
+
+
+    ### folding - folded command output is skipped over, so rows of the view only match lines of the screen when nothing is folded
+
+    def folding(self):
+        screen = self.screen
+        return not screen.alternate and bool(screen.blocks.fold_starts)
+
+
+    # the line shown on a row of the view, counting from the top of the scrollbar's range
+    def line_at_row(self, row):
+        if not self.folding():
+            return row
+        blocks = self.screen.blocks
+        trimmed = self.screen.scrollback.trimmed
+        return blocks.line_at_row(row + blocks.row_of_line(trimmed)) - trimmed
+
+
+    # the row a line is shown on, or None if it is folded away
+    def row_of_line(self, idx):
+        if not self.folding():
+            return idx
+        blocks = self.screen.blocks
+        trimmed = self.screen.scrollback.trimmed
+        if blocks.is_hidden(idx + trimmed):
+            return None
+        return blocks.row_of_line(idx + trimmed) - blocks.row_of_line(trimmed)
+
+
+    # how many rows there are to scroll through
+    def display_count(self):
+        count = self.screen.line_count()
+        if not self.folding():
+            return count
+        blocks = self.screen.blocks
+        trimmed = self.screen.scrollback.trimmed
+        return count - (blocks.hidden_before(trimmed + count) - blocks.hidden_before(trimmed))
+
+
+    def update_scrollbar(self):
+        scrollbar = self.verticalScrollBar()
+        rows = self.rows()
+        maximum = max(self.display_count() - rows, 0)
+        scrollbar.setPageStep(rows)
+        scrollbar.setSingleStep(1)
+        scrollbar.setRange(0, maximum)
+        if self.follow:
+            scrollbar.setValue(maximum)
+
+
+    def scroll_to_bottom(self):
+        self.follow = True
+        with self.screen.lock:
+            self.update_scrollbar()
+        self.viewport().update()
+
+
+    # scrolls just far enough to bring a line into view, and stops following new output
+    def show_line(self, idx):
+        with self.screen.lock:
+            # a line inside folded output is unfolded first
+            row = self.row_of_line(idx)
+            if row is None:
+                blocks = self.screen.blocks
+                blocks.toggle_fold(blocks.block_at(idx + self.screen.scrollback.trimmed))
+                self.update_scrollbar()
+                row = self.row_of_line(idx)
+
+            scrollbar = self.verticalScrollBar()
+            first = scrollbar.value()
+            rows = self.rows()
+            if not first <= row < first + rows:
+                scrollbar.setValue(row - rows // 2)
+            self.follow = scrollbar.value() == scrollbar.maximum()
+            self.viewport().update()
+
+
+    # lets the view stand in for QPlainTextEdit.moveCursor(QTextCursor.End)
+    def moveCursor(self, operation):
+        if operation in (QTextCursor.End, QTextCursor.EndOfBlock):
+            self.scroll_to_bottom()
+
+
+    def scrollContentsBy(self, dx, dy):
+        scrollbar = self.verticalScrollBar()
+        self.follow = scrollbar.value() == scrollbar.maximum()
+        self.viewport().update()
+
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # the screen is resized by whatever is connected to this, so the worker has to be kept out of it until then
+        with self.screen.lock:
+            self.update_scrollbar()
+            self.resized.emit(self.rows(), self.cols())
+
+
+    def font_for(self, style_id):
+        attributes = style_id & (BOLD | ITALIC | UNDERLINE)
+        font = self.fonts.get(attributes)
+        if font is None:
+            font = QFont(self.font())
+            font.setBold(bool(attributes & BOLD))
+            font.setItalic(bool(attributes & ITALIC))
+            font.setUnderline(bool(attributes & UNDERLINE))
+            self.fonts[attributes] = font
+        return font
+
+
+    # the prepared glyph runs for one line, rebuilt only when the line has changed
+    def glyph_runs(self, line):
+        cache = self.glyph_cache
+        cached = cache.get(line)
+        if cached is not None and cached[0] == line.version:
+            cache.move_to_end(line)
+            return cached[1]
+
+        glyphs = []
+        x = 0
+        for style_id, text in line.runs():
+            static_text = QStaticText(text)
+            static_text.setTextFormat(Qt.PlainText)
+            static_text.prepare(QTransform(), self.font_for(style_id))
+            width = len(text) * self.char_width
+            glyphs.append((x, width, static_text, style_id))
+            x += width
+
+        cache[line] = (line.version, glyphs)
+        cache.move_to_end(line)
+        if len(cache) > GLYPH_CACHE_SIZE:
+            cache.popitem(last=False)
+        return glyphs
+
+
+    def paintEvent(self, event):
+        with self.screen.lock:
+            self.paint(event)
+
+
+    def paint(self, event):
+        painter = QPainter(self.viewport())
+        rect = event.rect()
+        painter.fillRect(rect, self.palette().base())
+
+        screen = self.screen
+        line_height = self.line_height
+        first = self.verticalScrollBar().value()
+        count = screen.line_count()
+        folding = self.folding()
+        cursor_line = screen.cursor_line()
+        left = rect.left()
+        right = rect.right()
+
+        # only the rows that intersect the area being repainted are drawn
+        for row in range(rect.top() // line_height, rect.bottom() // line_height + 1):
+            idx = self.line_at_row(first + row) if folding else first + row
+            if idx >= count:
+                break
+            y = row * line_height
+
+            for x, width, static_text, style_id in self.glyph_runs(screen.line(idx)):
+                # only the runs that overlap the damaged cells need to be drawn
+                if x + width <= left or x > right:
+                    continue
+                text_format = style_format(style_id)
+                if text_format.background().style() != Qt.NoBrush:
+                    painter.fillRect(x, y, width, line_height, text_format.background())
+                painter.setFont(self.font_for(style_id))
+                painter.setPen(text_format.foreground().color())
+                painter.drawStaticText(x, y, static_text)
+
+            if idx == cursor_line and screen.cursor_visible:
+                self.paint_cursor(painter, y)
+            if self.searcher:
+                self.paint_matches(painter, idx, y)
+            if not screen.alternate:
+                self.paint_block_tag(painter, idx, y)
+            self.paint_selection(painter, idx, y)
+
+        painter.end()
+
+
+    # a block cursor, with the character under it drawn in the background color
+    def paint_cursor(self, painter, y):
+        screen = self.screen
+        x = screen.cursor_col * self.char_width
+        color = style_format(DEFAULT_STYLE).foreground().color()
+        painter.fillRect(x, y, self.char_width, self.line_height, color)
+
+        line = screen.line(screen.cursor_line())
+        char = line.chars[screen.cursor_col]
+        if char != ' ':
+            painter.setFont(self.font_for(line.styles[screen.cursor_col]))
+            painter.setPen(self.palette().base().color())
+            painter.drawText(QRect(x, y, self.char_width, self.line_height), Qt.AlignLeft | Qt.AlignTop, char)
+
+
+    # a note at the end of a command's line when it failed or its output is folded
+    def paint_block_tag(self, painter, idx, y):
+        screen = self.screen
+        blocks = screen.blocks
+        line = idx + screen.scrollback.trimmed
+        block = blocks.block_at(line)
+        if block < 0 or blocks.commands[block] != line or blocks.ends[block] is None:
+            return
+
+        tags = []
+        if blocks.is_folded(block):
+            start, end = blocks.output_range(block)
+            tags.append(f'[{end - start} lines folded]')
+        if blocks.exit_codes[block]:
+            tags.append(f'[exit {blocks.exit_codes[block]}]')
+        if not tags:
+            return
+
+        text = ' '.join(tags)
+        x = self.viewport().width() - (len(text) + 1) * self.char_width
+        painter.setFont(self.font_for(DEFAULT_STYLE))
+        painter.setPen(QColor(255, 140, 0) if blocks.exit_codes[block] else self.palette().placeholderText().color())
+        painter.drawText(QRect(x, y, (len(text) + 1) * self.char_width, self.line_height), Qt.AlignLeft | Qt.AlignTop, text)
+
+
+    # search matches are only looked up for the lines being painted
+    def paint_matches(self, painter, idx, y):
+        spans = self.searcher.spans_on(idx)
+        if not spans:
+            return
+        current = self.searcher.current_match()
+        for start, end in spans:
+            if current == (idx, start, end):
+                color = QColor(255, 140, 0, 170)
+            else:
+                color = QColor(255, 215, 0, 90)
+            painter.fillRect(start * self.char_width, y, (end - start) * self.char_width, self.line_height, color)
+
+
+    def paint_selection(self, painter, idx, y):
+        selection = self.ordered_selection()
+        if selection is None:
+            return
+        (start_line, start_col), (end_line, end_col) = selection
+        if not start_line <= idx <= end_line:
+            return
+
+        left = start_col if idx == start_line else 0
+        right = end_col if idx == end_line else self.screen.cols
+        highlight = self.palette().highlight().color()
+        highlight.setAlpha(110)
+        painter.fillRect(left * self.char_width, y, (right - left) * self.char_width, self.line_height, highlight)
+
+
+    ### selection and copying
+
+    # the (line, col) under a point in the viewport
+    def position_at(self, point):
+        with self.screen.lock:
+            return self.line_col_at(point)
+
+
+    def line_col_at(self, point):
+        idx = self.line_at_row(self.verticalScrollBar().value() + max(point.y(), 0) // self.line_height)
+        idx = min(idx, self.screen.line_count() - 1)
+        col = max(round(point.x() / self.char_width), 0)
+        return idx, col
+
+
+    def ordered_selection(self):
+        if self.selection_start is None or self.selection_end is None or self.selection_start == self.selection_end:
+            return None
+        return tuple(sorted((self.selection_start, self.selection_end)))
+
+
+    def selected_text(self):
+        with self.screen.lock:
+            selection = self.ordered_selection()
+            if selection is None:
+                return ''
+            (start_line, start_col), (end_line, end_col) = selection
+            lines = []
+            for idx in range(start_line, end_line + 1):
+                text = self.screen.line(idx).text()
+                if idx == end_line:
+                    text = text[:end_col]
+                if idx == start_line:
+                    text = text[start_col:]
+                lines.append(text.rstrip())
+            return '\n'.join(lines)
+
+
+    def copy(self):
+        text = self.selected_text()
+        if text:
+            QGuiApplication.clipboard().setText(text)
+
+
+    ### commands
+
+    # scrolls the prompt of the previous (-1) or next (1) command to the top of the view
+    def jump_to_command(self, direction):
+        with self.screen.lock:
+            screen = self.screen
+            if screen.alternate:
+                return
+            blocks = screen.blocks
+            trimmed = screen.scrollback.trimmed
+            top = self.line_at_row(self.verticalScrollBar().value()) + trimmed
+            line = blocks.previous_prompt(top) if direction < 0 else blocks.next_prompt(top)
+            if line is None:
+                if direction > 0:
+                    self.scroll_to_bottom()
+                return
+
+            self.current_block_line = line
+            scrollbar = self.verticalScrollBar()
+            scrollbar.setValue(self.row_of_line(max(line - trimmed, 0)))
+            self.follow = scrollbar.value() == scrollbar.maximum()
+            self.viewport().update()
+
+
+    def current_block(self):
+        blocks = self.screen.blocks
+        if self.current_block_line is None:
+            return blocks.last_finished()
+        return blocks.block_at(self.current_block_line)
+
+
+    def toggle_fold(self):
+        with self.screen.lock:
+            if self.screen.alternate:
+                return
+            if self.screen.blocks.toggle_fold(self.current_block()):
+                self.line_count = self.display_count()
+                self.update_scrollbar()
+                self.viewport().update()
+
+
+    def copy_command_output(self):
+        with self.screen.lock:
+            screen = self.screen
+            output = screen.blocks.output_range(self.current_block())
+            if output is None or screen.alternate:
+                return
+            trimmed = screen.scrollback.trimmed
+            start = max(output[0] - trimmed, 0)
+            end = min(output[1] - trimmed, screen.line_count())
+            text = '\n'.join(screen.line(idx).text() for idx in range(start, end))
+            QGuiApplication.clipboard().setText(text)
+
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.selection_start = self.position_at(event.position().toPoint())
+            self.selection_end = self.selection_start
+            # clicking on a command's output makes it the current command
+            with self.screen.lock:
+                blocks = self.screen.blocks
+                block = blocks.block_at(self.selection_start[0] + self.screen.scrollback.trimmed)
+                self.current_block_line = blocks.prompts[block] if block >= 0 else None
+            self.viewport().update()
+        self.setFocus()
+
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() & Qt.LeftButton and self.selection_start is not None:
+            self.selection_end = self.position_at(event.position().toPoint())
+            self.viewport().update()
+
+
+    ### keyboard
+
+    def keyPressEvent(self, event):
+        key = event.key()
+        mods = event.modifiers()
+        scrollbar = self.verticalScrollBar()
+
+        if key == Qt.Key_C and mods in (Qt.ControlModifier, Qt.ControlModifier | Qt.ShiftModifier):
+            self.copy()
+        elif key == Qt.Key_Up and mods == Qt.AltModifier:
+            self.jump_to_command(-1)
+        elif key == Qt.Key_Down and mods == Qt.AltModifier:
+            self.jump_to_command(1)
+        elif key == Qt.Key_F and mods == Qt.AltModifier:
+            self.toggle_fold()
+        elif key == Qt.Key_O and mods == Qt.ControlModifier | Qt.ShiftModifier:
+            self.copy_command_output()
+        elif key == Qt.Key_PageUp:
+            scrollbar.setValue(scrollbar.value() - scrollbar.pageStep())
+        elif key == Qt.Key_PageDown:
+            scrollbar.setValue(scrollbar.value() + scrollbar.pageStep())
+        elif key == Qt.Key_Up:
+            scrollbar.setValue(scrollbar.value() - 1)
+        elif key == Qt.Key_Down:
+            scrollbar.setValue(scrollbar.value() + 1)
+        elif key == Qt.Key_Home and mods == Qt.ControlModifier:
+            scrollbar.setValue(0)
+        elif key == Qt.Key_End and mods == Qt.ControlModifier:
+            self.scroll_to_bottom()
+        else:
+            super().keyPressEvent(event)